@@ -1,13 +1,36 @@
-from flask import Flask, render_template, request, url_for, flash, redirect, jsonify
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask import Flask, Response, render_template, request, url_for, flash, redirect, jsonify, abort, stream_with_context
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.orm import scoped_session, sessionmaker
-from werkzeug.utils import secure_filename
 import os
+import re
 import pytz
-from PIL import Image, ExifTags
-import io
+from PIL import Image, ImageOps, features
+from query_metrics import QueryMetrics
+from compression import Compression
+from assets import IMMUTABLE_MAX_AGE, StaticAssets
+from cache import TTLCache, cache_metrics, create_cache
+from markupsafe import Markup
+from storage import create_engines
+from queries import (
+    BROWSE_SORTS, DELETE_LISTING_MESSAGES_SQL, DELETE_LISTING_SAVES_SQL, DELETE_SIMILAR_TO_LISTING_SQL, INBOX_KEYSET,
+    INBOX_SQL, MARK_CHAT_READ_SQL, NEW_MESSAGES_SQL, READ_UPTO_SQL, SAVED_LISTINGS_SQL, SEARCH_SQL, SIMILAR_LISTINGS_SQL,
+    browse_query, feed_query, forget_cached_rows, get_listing, get_listing_detail, get_listing_with_seller, get_user,
+    profile_query,
+)
+import base64
+import json
+import math
+import threading
+import hashlib
+import tempfile
+import types
+import zipfile
+import bulk
+import similar
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 
 app = Flask(__name__)
@@ -19,73 +42,682 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-DATABASE_URI = 'sqlite:///marketplace.db'
-engine = create_engine(DATABASE_URI, connect_args={'timeout': 15})  # Set a 15-second timeout
+# Separate read and write engines, configured from HAWKSWAP_* environment
+# variables (see storage.py). Routes that change data use a write session.
+engine, write_engine = create_engines()
 db_session = scoped_session(sessionmaker(bind=engine))
+write_sessionmaker = sessionmaker(bind=write_engine)
+db_write_session = scoped_session(write_sessionmaker)
+# Rows cached for the request (queries.py) may be out of date once a write commits
+event.listen(write_sessionmaker, 'after_commit', forget_cached_rows)
+
+# Query counts and timings per endpoint, served at /metrics
+app.config['SERVER_TIMING'] = os.environ.get('HAWKSWAP_SERVER_TIMING') == '1'
+query_metrics = QueryMetrics(app, engine)
+if write_engine is not engine:
+    query_metrics.instrument(write_engine)
+
+# gzip/Brotli for pages and JSON (see compression.py for the COMPRESS_* settings).
+# Registered ahead of conditional_page so ETags and 304s are settled first.
+compression = Compression(app)
+# Fingerprinted, precompressed copies of static/ once `python assets.py build` has run
+static_assets = StaticAssets(app)
 
 # Function to get the current time in UTC
 def get_utc_now():
     return datetime.datetime.now(pytz.utc)
 
-def compress_image(image, quality=65):
+class MessageNotifier:
     """
-    Compress the image, reducing its quality to the specified level,
-    handle EXIF orientation, and return a BytesIO object with the compressed image data.
+    Wakes long-polling /get_messages requests when a chat changes (a new message
+    or a read receipt). Each chat has a version counter; a waiting request sleeps
+    until the version moves past the one it saw or its timeout runs out, so idle
+    chats cost no queries at all. This is in-process: with several app processes,
+    a waiting client in another process picks the change up on its next poll.
+    `publish`, if given, is also called with the chat id of every change, to
+    tell processes that are not this one (see chat_ws.py).
     """
-    img = Image.open(image)  # Open the image file
-    # Handle EXIF orientation data
+
+    def __init__(self, publish=None):
+        self.publish = publish
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conditions = {}
+        self._waiters = {}
+
+    def version(self, chat_id):
+        with self._lock:
+            return self._versions.get(chat_id, 0)
+
+    def notify(self, chat_id):
+        with self._lock:
+            self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+            if chat_id in self._conditions:
+                self._conditions[chat_id].notify_all()
+        if self.publish:
+            self.publish(chat_id)
+
+    def wait(self, chat_id, version, timeout):
+        """Block until the chat's version differs from `version`; True if it changed."""
+        with self._lock:
+            condition = self._conditions.setdefault(chat_id, threading.Condition(self._lock))
+            self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+            try:
+                return condition.wait_for(lambda: self._versions.get(chat_id, 0) != version, timeout)
+            finally:
+                self._waiters[chat_id] -= 1
+                if not self._waiters[chat_id]:
+                    del self._waiters[chat_id]
+                    del self._conditions[chat_id]
+
+# Redis pub/sub channel a change to a chat is announced on, when
+# HAWKSWAP_PUBSUB_URL points at a Redis-compatible server
+CHAT_CHANNEL_PREFIX = 'hawkswap:chat:'
+
+def redis_publisher(url):
+    import redis
+    client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def publish(chat_id):
+        try:
+            client.publish(f'{CHAT_CHANNEL_PREFIX}{chat_id}', '')
+        except redis.RedisError as e:
+            app.logger.warning('Publishing chat %s failed: %s', chat_id, e)
+    return publish
+
+message_notifier = MessageNotifier(publish=redis_publisher(os.environ['HAWKSWAP_PUBSUB_URL']) if os.environ.get('HAWKSWAP_PUBSUB_URL') else None)
+# Base URL of the WebSocket chat service (chat_ws.py), e.g. ws://127.0.0.1:8765.
+# Without one, chat pages long-poll /get_messages.
+app.config['CHAT_WS_URL'] = os.environ.get('HAWKSWAP_CHAT_WS_URL')
+# Longest a /get_messages request may wait for something to happen
+LONG_POLL_TIMEOUT = 25
+# Largest message id a client can pass; anything bigger won't bind as a 64-bit integer
+MAX_MESSAGE_ID = 2**63 - 1
+
+# Longest edge in pixels of each size generated for an uploaded listing image.
+# Grids show 'card', the inbox 'thumb' and the listing page 'full'.
+IMAGE_VARIANTS = {'full': 1600, 'card': 480, 'thumb': 160}
+IMAGE_FORMATS = ['jpg', 'webp'] if features.check('webp') else ['jpg']
+# Pillow releases the GIL while decoding and encoding, so threads are enough
+image_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('HAWKSWAP_IMAGE_WORKERS', 2)), thread_name_prefix='images')
+
+# Largest upload accepted, in pixels (a 48 MP phone photo is ~49 million).
+# Pillow refuses anything bigger too, so a crafted header can't make us allocate it.
+MAX_UPLOAD_PIXELS = 64_000_000
+Image.MAX_IMAGE_PIXELS = MAX_UPLOAD_PIXELS
+
+def check_upload_image(path):
+    """Reject files Pillow can't read and images over MAX_UPLOAD_PIXELS. Only the header is read."""
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-        exif = dict(img._getexif().items())
-
-        if exif[orientation] == 3:
-            img = img.rotate(180, expand=True)
-        elif exif[orientation] == 6:
-            img = img.rotate(270, expand=True)
-        elif exif[orientation] == 8:
-            img = img.rotate(90, expand=True)
-    except (AttributeError, KeyError, IndexError):
-        pass
-    # Convert RGBA to RGB (remove alpha channel) if necessary
-    if img.mode == 'RGBA':
+        with Image.open(path) as img:
+            width, height = img.size
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError('That file is not an image we can read.') from e
+    if width * height > MAX_UPLOAD_PIXELS:
+        raise ValueError('That image is too large, please upload one under %d megapixels.' % (MAX_UPLOAD_PIXELS // 1_000_000))
+
+def open_upload_image(path, max_size):
+    """
+    Open an uploaded image at no more than max_size on its longest edge, handle
+    EXIF orientation, and convert it to RGB (JPEG has no alpha channel, so
+    transparency goes onto white).
+
+    JPEGs are decoded with draft(), which lets libjpeg scale by 1/2, 1/4 or 1/8
+    while decoding, so a 48 MP photo never exists in memory at full size. The
+    rotation and mode conversion run after the downscale, on the small image.
+    """
+    img = Image.open(path)
+    img.draft('RGB', (max_size, max_size))  # no-op for formats other than JPEG
+    img.thumbnail((max_size, max_size))
+    ImageOps.exif_transpose(img, in_place=True)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
         # Create a white background image (since JPEG doesn't support transparency)
         background = Image.new("RGB", img.size, (255, 255, 255))
-        background.paste(img, mask=img.split()[3])  # 3 is the index of the alpha channel in the RGBA format
+        background.paste(img, mask=img.getchannel('A'))
         img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+def generate_image_variants(source, dest_dir, quality=65):
+    """
+    Write every size in IMAGE_VARIANTS to dest_dir as a progressive JPEG (and
+    WebP where Pillow supports it), encoding straight into the files. Sizes are
+    made largest first, each shrunk in place from the previous one. Files are
+    written under temporary names and renamed with full.jpg last, so once
+    full.jpg exists the whole set does.
+    """
+    img = open_upload_image(source, max(IMAGE_VARIANTS.values()))
+    written = []
+    for name, size in IMAGE_VARIANTS.items():
+        img.thumbnail((size, size))
+        path = os.path.join(dest_dir, name + '.jpg')
+        img.save(path + '.tmp', 'JPEG', quality=quality, progressive=True, optimize=True)
+        written.append(path)
+        if 'webp' in IMAGE_FORMATS:
+            path = os.path.join(dest_dir, name + '.webp')
+            img.save(path + '.tmp', 'WEBP', quality=quality)
+            written.append(path)
+    for path in reversed(written):
+        os.replace(path + '.tmp', path)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Name prefix of an upload still being written; maintenance.py sweeps abandoned ones
+UPLOAD_TEMP_PREFIX = '.upload-'
+# Content-addressed image directories: uploads/ab/cd/abcd...ef/
+IMAGE_DIR_PATTERN = re.compile(r'^%s/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}/' % re.escape(app.config['UPLOADED_IMAGES_DEST']))
+
+def image_dir(key):
+    """
+    Directory (relative to static/) holding the files of the image whose
+    contents hash to `key`, sharded on the first two bytes of the hash so no
+    single directory grows too large.
+    """
+    return os.path.join(app.config['UPLOADED_IMAGES_DEST'], key[:2], key[2:4], key)
+
+def save_upload(image):
+    """
+    Store an upload under the SHA-256 of its contents and return the key, its
+    path relative to static/, and whether its variants already exist. An image
+    that was uploaded before reuses the existing variants and nothing is
+    written; otherwise the path is the original, which the listing shows until
+    the variants are ready. Raises ValueError if the file is not a usable image.
+    """
+    upload_root = os.path.join('static', app.config['UPLOADED_IMAGES_DEST'])
+    os.makedirs(upload_root, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=upload_root, prefix=UPLOAD_TEMP_PREFIX, delete=False) as tmp:
+        for chunk in iter(lambda: image.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            tmp.write(chunk)
+    key = digest.hexdigest()
+    full_path = os.path.join(image_dir(key), 'full.jpg')
+    if os.path.exists(os.path.join('static', full_path)):
+        os.remove(tmp.name)
+        # In use again: keeps maintenance.py from sweeping it as an orphan
+        os.utime(os.path.join('static', image_dir(key)))
+        return key, full_path, True
+    try:
+        check_upload_image(tmp.name)
+    except ValueError:
+        os.remove(tmp.name)
+        raise
+    extension = image.filename.rsplit('.', 1)[1].lower()
+    image_path = os.path.join(image_dir(key), 'original.' + extension)
+    os.makedirs(os.path.join('static', image_dir(key)), exist_ok=True)
+    os.replace(tmp.name, os.path.join('static', image_path))
+    return key, image_path, False
+
+def store_image_file(file, filename):
+    """save_upload() for a photo that isn't a form upload, e.g. one read out of an import archive."""
+    if not allowed_file(filename):
+        raise ValueError(f'{filename!r} is not a png, jpg or gif')
+    return save_upload(types.SimpleNamespace(stream=file, filename=filename))
+
+# key -> [lock, number of jobs holding or waiting for it]
+_image_locks = {}
+_image_locks_guard = threading.Lock()
+
+@contextmanager
+def image_lock(key):
+    """
+    Serializes jobs for the same image, e.g. when two listings upload it at
+    once. A key's lock is dropped once no job holds or waits for it, so the
+    next job can't end up with a second lock while another still holds the first.
+    """
+    with _image_locks_guard:
+        entry = _image_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _image_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _image_locks[key]
+
+def process_listing_image(listing_id, key, original_path):
+    """
+    Worker job: build the variant set for an upload unless an earlier job for
+    the same image already has, then point the listing at it (if the listing
+    still shows this upload) and drop the original.
+    """
+    try:
+        with image_lock(key):
+            if not os.path.exists(os.path.join('static', image_dir(key), 'full.jpg')):
+                generate_image_variants(os.path.join('static', original_path), os.path.join('static', image_dir(key)))
+        conn = get_db_connection(write=True)
+        conn.execute('UPDATE listings SET image_key = :key, image_path = :image_path, version = version + 1 WHERE id = :id AND image_path = :original_path', {'key': key, 'image_path': os.path.join(image_dir(key), 'full.jpg'), 'id': listing_id, 'original_path': original_path})
+        conn.commit()
+        try:
+            os.remove(os.path.join('static', original_path))
+        except FileNotFoundError:
+            pass  # removed by an earlier job for the same image
+    except Exception:
+        app.logger.exception('Processing image for listing %s failed', listing_id)
+    finally:
+        db_write_session.remove()
+
+def queue_listing_image(listing_id, key, original_path):
+    return image_executor.submit(process_listing_image, listing_id, key, original_path)
+
+# Precomputed "similar listings" (see similar.py). One worker applies changes
+# in order against the index saved by `python similar.py build`.
+SIMILAR_INDEX_PATH = os.environ.get('HAWKSWAP_SIMILAR_INDEX', 'similar-index.npz')
+similar_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='similar')
+similar_listings = similar.SimilarListings(SIMILAR_INDEX_PATH)
+
+def refresh_similar_listings(listing_id):
+    try:
+        similar_listings.refresh(get_db_connection, listing_id)
+    except Exception:
+        app.logger.exception('Refreshing similar listings of %s failed', listing_id)
+    finally:
+        db_session.remove()
+        db_write_session.remove()
+
+def queue_similar_listings(listing_id):
+    if similar.np is None:
+        return None
+    return similar_executor.submit(refresh_similar_listings, listing_id)
+
+app.jinja_env.globals['image_formats'] = IMAGE_FORMATS
 
-    img_io = io.BytesIO()  # Create a BytesIO object to save the compressed image
-    img.save(img_io, 'JPEG', quality=quality)  
-    img_io.seek(0)  
-    return img_io
+# Shown for listings posted without a photo
+PLACEHOLDER_IMAGE = 'hawkswap.png'
+
+@app.template_global()
+def listing_image(listing, size='full', fmt='jpg'):
+    """
+    URL of one variant of a listing's image, of the original if it has none
+    (yet), or of the placeholder if the listing has no photo at all.
+    """
+    key = getattr(listing, 'image_key', None)
+    if key:
+        return url_for('static', filename=f'{image_dir(key)}/{size}.{fmt}')
+    return url_for('static', filename=getattr(listing, 'image_path', None) or PLACEHOLDER_IMAGE)
+
+@app.after_request
+def cache_uploaded_images(response):
+    """A content-addressed file never changes, so browsers may keep it for good."""
+    if request.endpoint == 'static' and IMAGE_DIR_PATTERN.match(request.view_args.get('filename', '')):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+# Rendered single-listing.html cards. A card depends only on the listing row,
+# so it is keyed by the listing's id and version, and every UPDATE that changes
+# how a listing renders bumps its version. Set HAWKSWAP_CACHE_URL=redis://...
+# to share cards between app processes instead of keeping them in memory.
+fragment_cache = create_cache('fragments', url=os.environ.get('HAWKSWAP_CACHE_URL'),
+                              maxsize=int(os.environ.get('HAWKSWAP_FRAGMENT_CACHE_SIZE', 10000)),
+                              ttl=float(os.environ.get('HAWKSWAP_FRAGMENT_CACHE_TTL', 3600)))
+
+def listing_card_key(listing):
+    return f"listing-card:{listing['id']}:{listing['version']}"
+
+@app.template_global()
+def listing_card(listing):
+    html = fragment_cache.get_or_load(listing_card_key(listing),
+                                      lambda: app.jinja_env.get_template('single-listing.html').render(listing=listing))
+    return Markup(html)
+
+@app.after_request
+def conditional_page(response):
+    """
+    Tag rendered pages with an ETag so a browser revalidating a page it already
+    has (Cache-Control: no-cache) gets an empty 304 when nothing changed.
+    """
+    if (request.method == 'GET' and response.status_code == 200 and response.mimetype == 'text/html'
+            and not response.direct_passthrough and not response.is_streamed):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.add_etag()
+        response.make_conditional(request)
+    return response
 
 
 
 date_posted = get_utc_now().strftime("%Y-%m-%d %H:%M:%S")
 
-def get_db_connection():
-    return db_session()
+def get_db_connection(write=False):
+    """
+    Session for this thread. Pass write=True for any route that changes data:
+    its statements, reads included, then run on the single writer connection.
+    Commit or close promptly so the next writer isn't kept waiting.
+    """
+    return db_write_session() if write else db_session()
+
+class User:
+    """
+    The logged-in user as Flask-Login sees it. Instances are shared between
+    requests through user_cache, so treat them as read-only.
+    """
+    __slots__ = ('id', 'username', 'name_first')
+
+    # Everyone who can log in is active; AnonymousUserMixin covers the rest
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
 
-class User(UserMixin):
     def __init__(self, id, username, name_first):
         self.id = id
         self.username = username
         self.name_first = name_first
 
+    def get_id(self):
+        return str(self.id)
 
-@login_manager.user_loader
-def load_user(user_id):
-    session = get_db_connection() 
-    user = session.execute('SELECT * FROM users WHERE id = :user_id', {'user_id': user_id}).fetchone()
+    def __eq__(self, other):
+        return isinstance(other, User) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+# Users by id for load_user, which otherwise queries on every authenticated
+# request (chat polls included). Username and name never change, so the TTL
+# only bounds how long a deleted account keeps working in other processes.
+user_cache = TTLCache('users', maxsize=int(os.environ.get('HAWKSWAP_USER_CACHE_SIZE', 4096)),
+                      ttl=float(os.environ.get('HAWKSWAP_USER_CACHE_TTL', 300)))
+query_metrics.add_collector(lambda: cache_metrics(user_cache, fragment_cache))
+
+def fetch_user(user_id):
+    session = get_db_connection()
+    user = get_user(session, user_id)
     session.close()
     if user:
         return User(user['id'], user['username'], user['name_first'])
     return None
 
+@login_manager.user_loader
+def load_user(user_id):
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    return user_cache.get_or_load(user_id, lambda: fetch_user(user_id))
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
+    db_write_session.remove()
+
+SEARCH_PAGE_SIZE = 24
+# Deeper pages make the database skip ever more matches; nobody pages this far
+MAX_SEARCH_PAGE = 100
+
+def fts_query(search_query):
+    """
+    Turn free text into an FTS5 query where every word has to match, either
+    exactly or as a prefix. Quoting each term keeps FTS5 syntax out of user input.
+    """
+    terms = re.findall(r'\w+', search_query)
+    return ' '.join('"%s"*' % term for term in terms)
+
+def ts_query(search_query):
+    """The PostgreSQL to_tsquery equivalent of fts_query(): every word, each as a prefix."""
+    terms = re.findall(r'\w+', search_query)
+    return ' & '.join('%s:*' % term for term in terms)
+
+# Each backend's free-text to query translation and its ranked search SQL
+SEARCH_QUERIES = {
+    'sqlite': (fts_query, SEARCH_SQL['sqlite']),
+    'postgresql': (ts_query, SEARCH_SQL['postgresql']),
+}
+
+FEED_PAGE_SIZE = 24
+INBOX_PAGE_SIZE = 30
+
+def encode_cursor(*values):
+    """Pack the sort key of the last row on a page into an opaque URL-safe token."""
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def cursor_value(kind, value):
+    """Check one decoded cursor value against the type its sort column needs."""
+    if kind is datetime.datetime:
+        datetime.datetime.fromisoformat(value)  # raises TypeError/ValueError for anything else
+    elif kind is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(value)
+    elif type(value) is not kind or (kind is int and not -2**63 <= value < 2**63):
+        raise TypeError(value)
+    return value
+
+def decode_cursor(cursor, *kinds):
+    """
+    Unpack a cursor from encode_cursor, expecting one value of each of `kinds`
+    (int, float, bool, or datetime.datetime for a timestamp string). A missing,
+    garbled or forged cursor gives None, so the caller serves the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(kinds):
+            return None
+        return [cursor_value(kind, value) for kind, value in zip(kinds, values)]
+    except (ValueError, TypeError):
+        return None
+
+def fetch_feed_page(conn, cursor=None, seller_id=None):
+    """
+    Return one page of listing cards plus the cursor for the next page (or None).
+    Keyset pagination: the cursor is the sort key of the last row shown, so each
+    page is a bounded index range scan no matter how deep the user scrolls.
+    """
+    if seller_id is None:
+        sql, params = feed_query(decode_cursor(cursor, datetime.datetime, int))
+    else:
+        sql, params = profile_query(seller_id, decode_cursor(cursor, bool, datetime.datetime, int))
+    params['limit'] = FEED_PAGE_SIZE + 1
+    listings = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(listings) > FEED_PAGE_SIZE:
+        listings = listings[:FEED_PAGE_SIZE]
+        last = listings[-1]
+        if seller_id is None:
+            next_cursor = encode_cursor(last['dateposted'], last['id'])
+        else:
+            next_cursor = encode_cursor(bool(last['is_sold']), last['dateposted'], last['id'])
+    return listings, next_cursor
+
+def fetch_similar_listings(conn, listing_id):
+    """The unsold listings most like this one, from the precomputed similar_listings table."""
+    return conn.execute(SIMILAR_LISTINGS_SQL, {'id': listing_id, 'limit': similar.SHOWN}).fetchall()
+
+def browse_filters(args):
+    """
+    The /browse filters in a request's query string. Raises ValueError for a
+    value that can't be used. `seller` stays a username; the caller resolves it.
+    """
+    def price(name):
+        value = args.get(name, '').strip()
+        if not value:
+            return None
+        value = float(value)
+        if not 0 <= value < 1e9:
+            raise ValueError(f'{name} out of range')
+        return value
+
+    since = args.get('since', '').strip()
+    filters = {
+        'sort': args.get('sort') or 'newest',
+        'sold': args.get('sold') == '1',
+        'min_price': price('min_price'),
+        'max_price': price('max_price'),
+        'since': datetime.date.fromisoformat(since).isoformat() if since else None,
+        'seller': args.get('seller', '').strip() or None,
+    }
+    if filters['sort'] not in BROWSE_SORTS:
+        raise ValueError('unknown sort')
+    return filters
+
+def fetch_browse_page(conn, filters, seller_id=None, cursor=None):
+    """
+    One page of listing cards matching the filters (see queries.browse_query),
+    plus the next page's cursor.
+    """
+    column, direction, kind = BROWSE_SORTS[filters['sort']]
+    sql, params = browse_query(filters, seller_id, decode_cursor(cursor, kind, int), engine.dialect.name)
+    params['limit'] = FEED_PAGE_SIZE + 1
+    listings = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(listings) > FEED_PAGE_SIZE:
+        listings = listings[:FEED_PAGE_SIZE]
+        next_cursor = encode_cursor(listings[-1][column], listings[-1]['id'])
+    return listings, next_cursor
+
+def unread_column(chat, user_id):
+    """The chats column holding user_id's unread count in this chat."""
+    return 'buyer_unread' if user_id == chat['buyer_id'] else 'seller_unread'
+
+def last_read_column(chat, user_id):
+    """The chats column holding the id of the last message user_id has read in this chat."""
+    return 'buyer_last_read' if user_id == chat['buyer_id'] else 'seller_last_read'
+
+def begin_write(conn):
+    """
+    Take the write lock now, so the checks made before writing still hold at
+    commit. Only needed on SQLite, where a transaction otherwise starts with
+    its first write.
+    """
+    if write_engine.dialect.name == 'sqlite':
+        conn.execute('BEGIN IMMEDIATE')
+
+def lock_chats(conn, where, params):
+    """
+    Lock the chats matching `where` until commit, so the unread counters read
+    from them can't change before the users' counters are adjusted. On SQLite
+    begin_write() has already locked the whole database.
+    """
+    if write_engine.dialect.name != 'sqlite':
+        conn.execute(f'SELECT chat_id FROM chats WHERE {where} FOR UPDATE', params)
+
+def mark_chat_read(conn, chat_id, user_id):
+    """
+    Move the user's read watermark in a chat up to its latest message and take
+    the chat's unread messages off the user's counter. Returns True if anything
+    was unread. The chat's own counter is checked on the (read) connection
+    passed in, so the writer is only taken, and the UPDATEs only run, when
+    there is something to mark.
+    """
+    chat = conn.execute("SELECT buyer_id, seller_id, buyer_unread, seller_unread FROM chats WHERE chat_id = :chat_id", {'chat_id': chat_id}).fetchone()
+    if not chat or user_id not in (chat['buyer_id'], chat['seller_id']):
+        return False
+    column = unread_column(chat, user_id)
+    if not chat[column]:
+        return False
+    write = get_db_connection(write=True)
+    # Re-read the counter under the write lock, so no send can land between
+    # reading it and taking it off the user's counter
+    begin_write(write)
+    lock_chats(write, 'chat_id = :chat_id', {'chat_id': chat_id})
+    unread = write.execute(f'SELECT {column} FROM chats WHERE chat_id = :chat_id', {'chat_id': chat_id}).scalar()
+    if not unread:
+        write.close()
+        return False
+    write.execute(MARK_CHAT_READ_SQL.format(last_read=last_read_column(chat, user_id), unread=column), {'chat_id': chat_id})
+    write.execute("""
+        UPDATE users
+        SET unread_count = CASE WHEN unread_count > :unread THEN unread_count - :unread ELSE 0 END
+        WHERE id = :user_id
+    """, {'unread': unread, 'user_id': user_id})
+    write.commit()
+    write.close()
+    return True
+
+def send_message(conn, chat_id, sender_id, message_content):
+    """
+    Insert a message, make it the chat's latest, and count it as unread for the
+    other participant. Returns False (and inserts nothing) if the sender is not
+    in the chat.
+    """
+    chat = conn.execute("SELECT buyer_id, seller_id FROM chats WHERE chat_id = :chat_id", {'chat_id': chat_id}).fetchone()
+    if not chat or sender_id not in (chat['buyer_id'], chat['seller_id']):
+        return False
+    recipient_id = chat['seller_id'] if sender_id == chat['buyer_id'] else chat['buyer_id']
+    column = unread_column(chat, recipient_id)
+    sent_at = get_utc_now().strftime("%Y-%m-%d %H:%M:%S")
+    message_id = conn.execute('INSERT INTO messages (chat_id, sender_id, message_content, sent_at) VALUES (:chat_id, :sender_id, :message_content, :sent_at) RETURNING message_id', {'chat_id': chat_id, 'sender_id': sender_id, 'message_content': message_content, 'sent_at': sent_at}).scalar()
+    # Concurrent sends can commit out of id order, so only ever move the latest message forward
+    conn.execute(f"""
+        UPDATE chats
+        SET last_message_id = CASE WHEN last_message_id > :message_id THEN last_message_id ELSE :message_id END,
+            last_activity = CASE WHEN last_message_id > :message_id THEN last_activity ELSE :sent_at END,
+            {column} = {column} + 1
+        WHERE chat_id = :chat_id
+    """, {'message_id': message_id, 'sent_at': sent_at, 'chat_id': chat_id})
+    conn.execute('UPDATE users SET unread_count = unread_count + 1 WHERE id = :recipient_id', {'recipient_id': recipient_id})
+    return True
+
+def fetch_new_messages(conn, chat_id, after, user_id):
+    """Messages in a chat after message_id `after`, and the id up to which the other participant has read them."""
+    messages = conn.execute(NEW_MESSAGES_SQL, {'chat_id': chat_id, 'after': after}).fetchall()
+    # The other side's watermark: every message up to it has been read
+    read_upto = conn.execute(READ_UPTO_SQL, {'chat_id': chat_id, 'user_id': user_id}).scalar() or 0
+    return messages, read_upto
+
+def delete_listing_rows(conn, listing_id):
+    """
+    Delete a listing with its chats, their messages and everyone's saves of it,
+    taking its unread messages off the participants' counters. The image files
+    are left for maintenance.py, which removes them once no listing uses them.
+    The caller takes the write lock first (begin_write) and commits.
+    """
+    lock_chats(conn, 'listing_id = :id', {'id': listing_id})
+    # Take the listing's unread messages off both participants' unread counters
+    conn.execute("""
+        UPDATE users
+        SET unread_count = unread_count
+            - COALESCE((SELECT SUM(buyer_unread) FROM chats WHERE listing_id = :id AND buyer_id = users.id), 0)
+            - COALESCE((SELECT SUM(seller_unread) FROM chats WHERE listing_id = :id AND seller_id = users.id), 0)
+        WHERE id IN (
+            SELECT buyer_id FROM chats WHERE listing_id = :id
+            UNION
+            SELECT seller_id FROM chats WHERE listing_id = :id
+        )
+    """, {'id': listing_id})
+
+    # Then, delete messages linked to the chats associated with this listing
+    conn.execute(DELETE_LISTING_MESSAGES_SQL, {'id': listing_id})
+
+    # Then the chats associated with the listing
+    conn.execute('DELETE FROM chats WHERE listing_id = :id', {'id': listing_id})
+
+    # And everyone's saves of it
+    conn.execute(DELETE_LISTING_SAVES_SQL, {'id': listing_id})
+
+    # Its similar listings, and its place among other listings' similar listings
+    conn.execute('DELETE FROM similar_listings WHERE listing_id = :id', {'id': listing_id})
+    conn.execute(DELETE_SIMILAR_TO_LISTING_SQL, {'id': listing_id})
+
+    # Finally, delete the listing itself
+    conn.execute('DELETE FROM listings WHERE id = :id', {'id': listing_id})
+
+def delete_chat_rows(conn, chat_id):
+    """
+    Delete a chat and its messages, taking its unread messages off the
+    participants' counters. The caller takes the write lock first (begin_write)
+    and commits.
+    """
+    lock_chats(conn, 'chat_id = :chat_id', {'chat_id': chat_id})
+    conn.execute("""
+        UPDATE users
+        SET unread_count = unread_count
+            - COALESCE((SELECT buyer_unread FROM chats WHERE chat_id = :chat_id AND buyer_id = users.id), 0)
+            - COALESCE((SELECT seller_unread FROM chats WHERE chat_id = :chat_id AND seller_id = users.id), 0)
+        WHERE id IN (
+            SELECT buyer_id FROM chats WHERE chat_id = :chat_id
+            UNION
+            SELECT seller_id FROM chats WHERE chat_id = :chat_id
+        )
+    """, {'chat_id': chat_id})
+    conn.execute('DELETE FROM messages WHERE chat_id = :chat_id', {'chat_id': chat_id})
+    conn.execute('DELETE FROM chats WHERE chat_id = :chat_id', {'chat_id': chat_id})
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
@@ -104,100 +736,100 @@ def page_not_found(e):
 def show_user_profile(username):
     conn = get_db_connection()
     user = conn.execute("SELECT * FROM users WHERE username = :username", {'username': username}).fetchone()
-    # Sort listings by 'is_sold' (unsold first) and then by 'dateposted' (most recent first)
-    listings = conn.execute("SELECT * FROM listings WHERE seller_id = :seller_id ORDER BY is_sold ASC, dateposted DESC", {'seller_id': user['id']}).fetchall()
+    if not user:
+        conn.close()
+        abort(404)
+    listings, next_cursor = fetch_feed_page(conn, seller_id=user['id'])
     conn.close()
-    return render_template('userpage.html', user=user, listings=listings)
+    return render_template('userpage.html', user=user, listings=listings, next_cursor=next_cursor, feed_url=url_for('listings_page', seller=username))
 
 
 @app.route('/listing/<id>')
 @login_required
 def show_listing(id):
     conn = get_db_connection()
-    listing = conn.execute("SELECT * FROM listings WHERE id = :id", {'id': id}).fetchone()
-    seller = conn.execute("SELECT * FROM users WHERE id = :id", {'id': listing['seller_id']}).fetchone()
-    saved = conn.execute("SELECT * FROM saves WHERE user_id = :user_id AND listing_id = :listing_id", {'user_id': current_user.id, 'listing_id': id}).fetchone()
-    chat = conn.execute("""
-        SELECT c.chat_id
-        FROM chats c
-        WHERE (listing_id = :listing_id AND seller_id = :seller_id AND buyer_id = :buyer_id) OR (listing_id = :listing_id AND seller_id = :buyer_id AND buyer_id = :seller_id)
-    """, {'listing_id': id, 'seller_id': seller['id'], 'buyer_id': current_user.id}).fetchone()
+    listing = get_listing_detail(conn, id, current_user.id)
+    if not listing:
+        conn.close()
+        abort(404)
+    similar_items = fetch_similar_listings(conn, listing['id'])
     conn.close()
-
-    return render_template('listing.html', listing=listing, sellerusername=seller.username, chat=chat, saved=saved)
+    return render_template('listing.html', listing=listing, sellerusername=listing['seller_username'], chat_id=listing['chat_id'], saved=listing['saved'], similar_listings=similar_items)
 
 @app.route('/listing/<id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_listing(id):
     conn = get_db_connection()
-    listing = conn.execute("SELECT * FROM listings WHERE id = :id", {'id': id}).fetchone()
-    seller = conn.execute("SELECT * FROM users WHERE id = :id", {'id': listing['seller_id']}).fetchone()
-    if current_user.id != seller['id']:
+    listing = get_listing_with_seller(conn, id)
+    conn.close()
+    if not listing:
+        abort(404)
+    if current_user.id != listing['seller_id']:
         return redirect(url_for('show_listing', id=id))
     if request.method == 'POST':
         name = request.form['name']
         description = request.form['description']
         price = request.form['price']
         image = request.files['image']
+        # Store the upload before taking the write connection
         if image and allowed_file(image.filename):
-            filename = secure_filename(image.filename)
-            image_path = os.path.join(app.config['UPLOADED_IMAGES_DEST'], filename)
-            compressed_image = compress_image(image)
-            # Save the compressed image to the filesystem
-            with open(os.path.join('static', image_path), 'wb') as f:
-                f.write(compressed_image.read())
-            conn.execute('UPDATE listings SET name = :name, description = :description, price = :price, image_path = :image_path WHERE id = :id', {'name': name, 'description': description, 'price': price, 'image_path': image_path, 'id': id})
+            try:
+                key, image_path, ready = save_upload(image)
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('edit_listing', id=id))
         else:
-            conn.execute('UPDATE listings SET name = :name, description = :description, price = :price WHERE id = :id', {'name': name, 'description': description, 'price': price, 'id': id})
+            image_path, ready = None, True
+        conn = get_db_connection(write=True)
+        if image_path:
+            conn.execute('UPDATE listings SET name = :name, description = :description, price = :price, image_path = :image_path, image_key = :image_key, version = version + 1 WHERE id = :id', {'name': name, 'description': description, 'price': price, 'image_path': image_path, 'image_key': key if ready else None, 'id': id})
+        else:
+            conn.execute('UPDATE listings SET name = :name, description = :description, price = :price, version = version + 1 WHERE id = :id', {'name': name, 'description': description, 'price': price, 'id': id})
         conn.commit()
         conn.close()
+        if not ready:
+            queue_listing_image(id, key, image_path)
+        queue_similar_listings(listing['id'])
         return redirect(url_for('show_listing', id=id))
-    return render_template('edit_listing.html', listing=listing, sellerusername=seller.username)
+    return render_template('edit_listing.html', listing=listing, sellerusername=listing['seller_username'])
 
 
 @app.route('/listing/<id>/delete', methods=['POST'])
 @login_required
 def delete_listing(id):
-    conn = get_db_connection()
-    listing = conn.execute("SELECT * FROM listings WHERE id = :id", {'id': id}).fetchone()
+    conn = get_db_connection(write=True)
+    begin_write(conn)
+    listing = get_listing(conn, id)
     if not listing:
         # If listing does not exist, redirect to index or another appropriate page
         return redirect(url_for('index'))
 
-    seller = conn.execute("SELECT * FROM users WHERE id = :id", {'id': listing['seller_id']}).fetchone()
-    if current_user.id != seller['id']:
+    if current_user.id != listing['seller_id']:
         # If the current user is not the seller of the listing, redirect to listing page
         return redirect(url_for('show_listing', id=id))
 
-    # First, delete messages linked to the chats associated with this listing
-    conn.execute("""
-        DELETE FROM messages WHERE chat_id IN (
-            SELECT chat_id FROM chats WHERE listing_id = :id
-        )
-    """, {'id': id})
-
-    # Then, delete the chats associated with the listing
-    conn.execute('DELETE FROM chats WHERE listing_id = :id', {'id': id})
-
-    # Finally, delete the listing itself
-    conn.execute('DELETE FROM listings WHERE id = :id', {'id': id})
+    delete_listing_rows(conn, id)
     conn.commit()
     conn.close()
+    fragment_cache.invalidate(listing_card_key(listing))
     return redirect(url_for('index'))
 
 
 @app.route('/listing/<id>/mark-as-sold', methods=['POST'])
 @login_required
 def mark_as_sold(id):
-    conn = get_db_connection()
-    listing = conn.execute("SELECT * FROM listings WHERE id = :id", {'id': id}).fetchone()
-    seller = conn.execute("SELECT * FROM users WHERE id = :id", {'id': listing['seller_id']}).fetchone()
-    if current_user.id != seller['id']:
+    conn = get_db_connection(write=True)
+    listing = get_listing(conn, id)
+    if not listing:
+        conn.close()
+        abort(404)
+    if current_user.id != listing['seller_id']:
         return redirect(url_for('show_listing', id=id))
     if listing['is_sold']:
-        conn.execute('UPDATE listings SET is_sold = FALSE WHERE id = :id', {'id': id})
+        conn.execute('UPDATE listings SET is_sold = FALSE, sold_at = NULL, version = version + 1 WHERE id = :id', {'id': id})
     else:
-        conn.execute('UPDATE listings SET is_sold = TRUE WHERE id = :id', {'id': id})
+        conn.execute('UPDATE listings SET is_sold = TRUE, sold_at = :sold_at, version = version + 1 WHERE id = :id',
+                     {'id': id, 'sold_at': get_utc_now().strftime("%Y-%m-%d %H:%M:%S")})
     conn.commit()
     conn.close()
     return redirect(url_for('show_listing', id=id))
@@ -207,7 +839,7 @@ def mark_as_sold(id):
 @login_required
 def save_listing(listing_id):
     #if the listing is already saved, unsave it
-    conn = get_db_connection()
+    conn = get_db_connection(write=True)
     saved = conn.execute("SELECT * FROM saves WHERE user_id = :user_id AND listing_id = :listing_id", {'user_id': current_user.id, 'listing_id': listing_id}).fetchone()
     if saved:
         conn.execute("DELETE FROM saves WHERE user_id = :user_id AND listing_id = :listing_id", {'user_id': current_user.id, 'listing_id': listing_id})
@@ -216,7 +848,7 @@ def save_listing(listing_id):
         #redirect to the same page
         return redirect(url_for('show_listing', id=listing_id))
     saved_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn.execute("INSERT INTO saves (user_id, listing_id, saved_at) VALUES (:user_id, :listing_id, :saved_at)", {'user_id': current_user.id, 'listing_id': listing_id, 'saved_at': saved_at})
+    conn.execute("INSERT INTO saves (user_id, listing_id, saved_at) VALUES (:user_id, :listing_id, :saved_at) ON CONFLICT DO NOTHING", {'user_id': current_user.id, 'listing_id': listing_id, 'saved_at': saved_at})
     conn.commit()
     conn.close()
     return redirect(url_for('show_listing', id=listing_id))
@@ -226,13 +858,7 @@ def save_listing(listing_id):
 @login_required
 def saved_listings():
     conn = get_db_connection()
-    saved_listings = conn.execute("""
-        SELECT l.id, l.name, l.description, l.price, l.dateposted, s.saved_at, l.image_path, l.is_sold
-        FROM saves s
-        JOIN listings l ON s.listing_id = l.id
-        WHERE s.user_id = :user_id
-        ORDER BY s.saved_at DESC
-    """, {'user_id': current_user.id}).fetchall()
+    saved_listings = conn.execute(SAVED_LISTINGS_SQL, {'user_id': current_user.id}).fetchall()
     conn.close()
     return render_template('saved_listings.html', listings=saved_listings)
 
@@ -240,30 +866,21 @@ def saved_listings():
 @login_required
 def inbox():
     conn = get_db_connection()
-    # Use an improved SQL query with grouping to avoid duplicates
-    chats = conn.execute("""
-        SELECT c.chat_id, l.name AS listing_name, u.username AS sender_username, m.message_content, m.sent_at, l.image_path,
-        (SELECT COUNT(*) FROM messages WHERE chat_id = c.chat_id AND read_status = 0 AND sender_id != :user_id) AS unread_count,
-        seller.name_first AS seller_first_name
-        FROM chats c
-        JOIN listings l ON c.listing_id = l.id
-        JOIN users seller ON l.seller_id = seller.id
-        JOIN (
-            SELECT chat_id, sender_id, message_content, sent_at
-            FROM messages
-            WHERE sent_at IN (
-                SELECT MAX(sent_at)
-                FROM messages
-                GROUP BY chat_id
-            )
-        ) m ON c.chat_id = m.chat_id
-        JOIN users u ON m.sender_id = u.id
-        WHERE c.buyer_id = :user_id OR c.seller_id = :user_id
-        GROUP BY c.chat_id
-        ORDER BY m.sent_at DESC;
-    """, {'user_id': current_user.id}).fetchall()
+    # Each chat carries a pointer to its latest message and per-participant
+    # unread counts, so this is one indexed query, newest activity first.
+    params = {'user_id': current_user.id, 'limit': INBOX_PAGE_SIZE + 1}
+    keyset = ''
+    after = decode_cursor(request.args.get('cursor'), datetime.datetime, int)
+    if after:
+        keyset = INBOX_KEYSET
+        params.update(last_activity=after[0], chat_id=after[1])
+    chats = conn.execute(INBOX_SQL.format(keyset=keyset), params).fetchall()
     conn.close()
-    return render_template('inbox.html', chats=chats)
+    next_cursor = None
+    if len(chats) > INBOX_PAGE_SIZE:
+        chats = chats[:INBOX_PAGE_SIZE]
+        next_cursor = encode_cursor(chats[-1]['last_activity'], chats[-1]['chat_id'])
+    return render_template('inbox.html', chats=chats, next_cursor=next_cursor)
 
 
 
@@ -273,10 +890,13 @@ def inbox():
 @login_required
 def message_seller(listing_id):
     if request.method == 'POST':
-        conn = get_db_connection()
+        conn = get_db_connection(write=True)
         message_content = request.form['message']
         sender_id = current_user.id
-        listing = conn.execute("SELECT * FROM listings WHERE id = :id", {'id': listing_id}).fetchone()
+        listing = get_listing(conn, listing_id)
+        if not listing:
+            conn.close()
+            abort(404)
         seller_id = listing['seller_id']
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -286,60 +906,51 @@ def message_seller(listing_id):
             WHERE (listing_id = :listing_id AND seller_id = :seller_id AND buyer_id = :buyer_id) OR (listing_id = :listing_id AND seller_id = :buyer_id AND buyer_id = :seller_id)
         """, {'listing_id': listing_id, 'seller_id': seller_id, 'buyer_id': current_user.id}).fetchone()
         if not chat:
-            conn.execute("INSERT INTO chats (listing_id, seller_id, buyer_id, created_at) VALUES (:listing_id, :seller_id, :buyer_id, :created_at)", {'listing_id': listing_id, 'seller_id': seller_id, 'buyer_id': sender_id, 'created_at': current_time})
-            chat_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            chat_id = conn.execute("INSERT INTO chats (listing_id, seller_id, buyer_id, created_at) VALUES (:listing_id, :seller_id, :buyer_id, :created_at) RETURNING chat_id", {'listing_id': listing_id, 'seller_id': seller_id, 'buyer_id': sender_id, 'created_at': current_time}).scalar()
         else:
             chat_id = chat['chat_id']
-        sent_at = get_utc_now().strftime("%Y-%m-%d %H:%M:%S")
-        conn.execute('INSERT INTO messages (chat_id, sender_id, message_content, sent_at) VALUES (:chat_id, :sender_id, :message_content, :sent_at)', {'chat_id': chat_id, 'sender_id': sender_id, 'message_content': message_content, 'sent_at': sent_at})
+        send_message(conn, chat_id, sender_id, message_content)
         conn.commit()
         conn.close()
+        message_notifier.notify(chat_id)
         return redirect(url_for('index'))
 
 
-@app.route('/chat/<chat_id>', methods=['GET', 'POST'])
+@app.route('/chat/<int:chat_id>', methods=['GET', 'POST'])
 @login_required
 def chat(chat_id):
+    if request.method == 'POST':
+        data = request.get_json()
+        message_content = data['message']
+        conn = get_db_connection(write=True)
+        if not send_message(conn, chat_id, current_user.id, message_content):
+            conn.close()
+            abort(404)
+        conn.commit()
+        conn.close()
+        message_notifier.notify(chat_id)
+        return '', 204  # Return an empty response for AJAX
+
+    # The page itself only needs the listing; messages are fetched by get_messages
     conn = get_db_connection()
-    messages = conn.execute("""
-        SELECT m.message_content, m.sent_at, u.username, m.read_status
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE m.chat_id = :chat_id
-        ORDER BY m.sent_at
-    """, {'chat_id': chat_id}).fetchall()
     listing_info = conn.execute("""
-        SELECT l.name , l.price, l.image_path, l.id
+        SELECT l.name , l.price, l.image_path, l.image_key, l.id
         FROM chats c
         JOIN listings l ON c.listing_id = l.id
         WHERE c.chat_id = :chat_id
     """, {'chat_id': chat_id}).fetchone()
-    conn.execute("""
-        UPDATE messages
-        SET read_status = TRUE
-        WHERE chat_id = :chat_id AND sender_id != :user_id
-    """, {'chat_id': chat_id, 'user_id': current_user.id})
-    conn.commit()
+    marked = mark_chat_read(conn, chat_id, current_user.id)
     conn.close()
-
-    if request.method == 'POST':
-        data = request.get_json()
-        message_content = data['message']
-        sender_id = current_user.id
-        sent_at = get_utc_now().strftime("%Y-%m-%d %H:%M:%S")
-        conn = get_db_connection()
-        conn.execute('INSERT INTO messages (chat_id, sender_id, message_content, sent_at) VALUES (:chat_id, :sender_id, :message_content, :sent_at)', {'chat_id': chat_id, 'sender_id': sender_id, 'message_content': message_content, 'sent_at': sent_at})
-        conn.commit()
-        conn.close()
-        return '', 204  # Return an empty response for AJAX
-    return render_template('chat.html', messages=messages, chat_id=chat_id, listing_info=listing_info)
+    if marked:
+        message_notifier.notify(chat_id)
+    return render_template('chat.html', chat_id=chat_id, listing_info=listing_info, chat_ws_url=app.config['CHAT_WS_URL'])
 
 @app.route('/chat/<chat_id>/info', methods=['GET', 'POST'])
 @login_required
 def chat_info(chat_id):
     conn = get_db_connection()
     chat_info = conn.execute("""
-        SELECT u1.username AS buyer, u2.username AS seller, l.name, l.price, l.image_path, l.id, c.chat_id
+        SELECT u1.username AS buyer, u2.username AS seller, l.name, l.price, l.image_path, l.image_key, l.id, c.chat_id
         FROM chats c
         JOIN users u1 ON c.buyer_id = u1.id
         JOIN users u2 ON c.seller_id = u2.id
@@ -351,25 +962,39 @@ def chat_info(chat_id):
     conn.close()
     return render_template('chat_info.html', chat_info=chat_info)
 
-@app.route('/get_messages/<chat_id>', methods=['GET'])
+#messages after ?after=<message_id>; with ?wait=<seconds> the request is held
+#open until a message arrives or ?read=<message_id> (the client's read receipt) moves
+@app.route('/get_messages/<int:chat_id>', methods=['GET'])
+@login_required
 def get_messages(chat_id):
+    after = min(max(request.args.get('after', 0, type=int), 0), MAX_MESSAGE_ID)
+    known_read_upto = min(max(request.args.get('read', 0, type=int), 0), MAX_MESSAGE_ID)
+    wait = request.args.get('wait', 0, type=float)
+    # nan gets through min() and max() unchanged, and would wait forever
+    wait = min(max(wait, 0), LONG_POLL_TIMEOUT) if math.isfinite(wait) else 0
     conn = get_db_connection()
-    messages = conn.execute("""
-        SELECT m.message_content, m.sent_at, u.username, m.read_status
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE m.chat_id = :chat_id
-        ORDER BY m.sent_at
-    """, {'chat_id': chat_id}).fetchall()
-    conn.execute("""
-        UPDATE messages
-        SET read_status = TRUE
-        WHERE chat_id = :chat_id AND sender_id != :user_id
-    """, {'chat_id': chat_id, 'user_id': current_user.id})
-    conn.commit()
+    chat = conn.execute("SELECT buyer_id, seller_id FROM chats WHERE chat_id = :chat_id", {'chat_id': chat_id}).fetchone()
+    if not chat or current_user.id not in (chat['buyer_id'], chat['seller_id']):
+        conn.close()
+        abort(404)
+    # Read the version before querying so a message committed in between still wakes us
+    version = message_notifier.version(chat_id)
+    messages, read_upto = fetch_new_messages(conn, chat_id, after, current_user.id)
+    if not messages and read_upto == known_read_upto and wait:
+        conn.close()  # don't hold a connection while waiting
+        if message_notifier.wait(chat_id, version, wait):
+            conn = get_db_connection()
+            messages, read_upto = fetch_new_messages(conn, chat_id, after, current_user.id)
+    marked = False
+    if any(message['sender_id'] != current_user.id for message in messages):
+        marked = mark_chat_read(conn, chat_id, current_user.id)
     conn.close()
-    messages_dict = [dict(message) for message in messages]
-    return jsonify(messages_dict)
+    if marked:
+        message_notifier.notify(chat_id)
+    return jsonify({
+        'messages': [dict(message) for message in messages],
+        'read_upto': read_upto,
+    })
 
 
 
@@ -388,7 +1013,7 @@ def register():
             return redirect(url_for('register'))
         
         
-        conn = get_db_connection()
+        conn = get_db_connection(write=True)
         if conn.execute('SELECT * FROM users WHERE username = :username', {'username': username}).fetchone():
             flash('Username is already taken.', 'error')
             conn.close()
@@ -410,38 +1035,91 @@ def create_listing():
         date_posted = get_utc_now().strftime("%Y-%m-%d %H:%M:%S")
         seller = str(current_user.id)
 
-        # Handle image upload
+        # Handle image upload: store the original now, resize in the background
         image = request.files['image']
+        key = image_path = None
+        ready = True
         if image and allowed_file(image.filename):
-            # Generate a unique filename by appending a timestamp
-            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            filename = secure_filename(f"{timestamp}_{image.filename}")
-            # Save the image in the 'uploads' folder inside the 'static' directory
-            image_path = os.path.join('uploads', filename)
-            # compress the image before saving
-            compressed_image = compress_image(image)
-            # Save the compressed image to the filesystem
-            with open(os.path.join('static', image_path), 'wb') as f:
-                f.write(compressed_image.read())
-
-        conn = get_db_connection()
-        conn.execute('INSERT INTO listings (name, description, price, dateposted, seller_id, image_path) VALUES (:name, :description, :price, :date_posted, :seller, :image_path)', {'name': name, 'description': description, 'price': price, 'date_posted': date_posted, 'seller': seller, 'image_path': image_path})
+            try:
+                key, image_path, ready = save_upload(image)
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('create_listing'))
+
+        conn = get_db_connection(write=True)
+        listing_id = conn.execute('INSERT INTO listings (name, description, price, dateposted, seller_id, image_path, image_key) VALUES (:name, :description, :price, :date_posted, :seller, :image_path, :image_key) RETURNING id', {'name': name, 'description': description, 'price': price, 'date_posted': date_posted, 'seller': seller, 'image_path': image_path, 'image_key': key if ready else None}).scalar()
         conn.commit()
         conn.close()
+        if not ready:
+            queue_listing_image(listing_id, key, image_path)
+        queue_similar_listings(listing_id)
 
         return redirect(url_for('index'))
     return render_template('create_listing.html')
 
+@app.route('/listings/import', methods=['POST'])
+@login_required
+def import_listings():
+    """
+    Bulk-create the current user's listings from a CSV or JSON Lines file
+    ('rows') and an optional zip of the photos it names ('images'). The
+    response streams bulk.import_listings() events as JSON Lines.
+    """
+    rows = request.files.get('rows')
+    if not rows:
+        abort(400)
+    fmt = request.form.get('format') or bulk.format_for(rows.filename or '')
+    if fmt not in bulk.FORMATS:
+        abort(400)
+    images = request.files.get('images')
+    try:
+        archive = zipfile.ZipFile(images.stream) if images else None
+    except zipfile.BadZipFile:
+        abort(400)
+    events = bulk.import_listings(
+        bulk.read_rows(rows.stream, fmt), current_user.id,
+        get_db_connection=get_db_connection, store_image=store_image_file,
+        make_variants=generate_image_variants, image_dir=image_dir, image_lock=image_lock, archive=archive,
+        workers=int(os.environ.get('HAWKSWAP_IMPORT_WORKERS', 0)) or None,
+        posted_at=get_utc_now().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    return Response(stream_with_context(json.dumps(event) + '\n' for event in events), mimetype='application/x-ndjson')
+
+@app.route('/listings/export')
+@login_required
+def export_listings():
+    """The current user's listings as a CSV or JSON Lines download, streamed."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk.FORMATS:
+        abort(400)
+    conn = get_db_connection()
+
+    def chunks():
+        try:
+            yield from bulk.export_listings(conn, fmt, current_user.id,
+                                            image_url=lambda path: url_for('static', filename=path) if path else '')
+        finally:
+            conn.close()
+    return Response(stream_with_context(chunks()), mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename=listings.{fmt}'})
+
 @app.route('/search', methods=['GET', 'POST'])
 @login_required
 def search():
-    if request.method == 'POST':
-        search_query = request.form['search_query']
-        conn = get_db_connection()
-        listings = conn.execute('SELECT * FROM listings WHERE name LIKE :search_query', {'search_query': '%' + search_query + '%'}).fetchall()
-        conn.close()
-        return render_template('search.html', listings=listings)
-    return render_template('search.html')
+    search_query = request.values.get('search_query', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    if page > MAX_SEARCH_PAGE:
+        abort(404)
+    to_query, sql = SEARCH_QUERIES[engine.dialect.name]
+    query = to_query(search_query)
+    if not query:
+        return render_template('search.html', search_query=search_query)
+    conn = get_db_connection()
+    # One extra row is fetched to know whether there is a next page
+    listings = conn.execute(sql, {'query': query, 'limit': SEARCH_PAGE_SIZE + 1, 'offset': (page - 1) * SEARCH_PAGE_SIZE}).fetchall()
+    conn.close()
+    has_next = len(listings) > SEARCH_PAGE_SIZE and page < MAX_SEARCH_PAGE
+    return render_template('search.html', listings=listings[:SEARCH_PAGE_SIZE], search_query=search_query, page=page, has_next=has_next)
 
 
 
@@ -454,7 +1132,7 @@ def login():
         user = session.execute('SELECT * FROM users WHERE username = :username AND password = :password', {'username': username, 'password': password}).fetchone()
         session.close()  # Close the session
         if user:
-            login_user(User(user['id'], user['username'], user['name_first']))
+            login_user(user_cache.get_or_load(user['id'], lambda: User(user['id'], user['username'], user['name_first'])))
             return redirect(url_for('index'))
         flash('Invalid username or password')
     return render_template('login.html')
@@ -464,6 +1142,7 @@ def login():
 @app.route('/logout', methods=['GET', 'POST'])
 @login_required
 def logout():
+    user_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('login'))
 
@@ -471,9 +1150,66 @@ def logout():
 @login_required
 def index():
     conn = get_db_connection()
-    listings = conn.execute ('SELECT * FROM listings where is_sold = "0" ORDER BY dateposted DESC').fetchall()
+    listings, next_cursor = fetch_feed_page(conn)
     conn.close()
-    return render_template('index.html', listings=listings)
+    return render_template('index.html', listings=listings, next_cursor=next_cursor, feed_url=url_for('listings_page'))
+
+#further pages of the home feed or a profile, fetched by the grid as the user scrolls
+@app.route('/api/listings')
+@login_required
+def listings_page():
+    conn = get_db_connection()
+    seller_id = None
+    username = request.args.get('seller')
+    if username:
+        seller = conn.execute("SELECT id FROM users WHERE username = :username", {'username': username}).fetchone()
+        if not seller:
+            conn.close()
+            abort(404)
+        seller_id = seller['id']
+    listings, next_cursor = fetch_feed_page(conn, request.args.get('cursor'), seller_id)
+    conn.close()
+    return jsonify({
+        'listings': [dict(listing) for listing in listings],
+        'html': render_template('listings-grid-items.html', listings=listings),
+        'next_cursor': next_cursor,
+    })
+
+def browse_results():
+    """Filters, listings and next cursor for /browse and /api/browse."""
+    try:
+        filters = browse_filters(request.args)
+    except ValueError:
+        abort(400)
+    conn = get_db_connection()
+    seller_id = None
+    listings, next_cursor = [], None
+    if filters['seller']:
+        seller_id = conn.execute("SELECT id FROM users WHERE username = :username", {'username': filters['seller']}).scalar()
+    if seller_id is not None or not filters['seller']:
+        listings, next_cursor = fetch_browse_page(conn, filters, seller_id, request.args.get('cursor'))
+    conn.close()
+    return filters, listings, next_cursor
+
+#listings filtered by price, sold state, seller and date posted, sorted by date or price
+@app.route('/browse')
+@login_required
+def browse():
+    filters, listings, next_cursor = browse_results()
+    feed_args = {name: value for name, value in request.args.items() if name != 'cursor'}
+    return render_template('browse.html', filters=filters, listings=listings,
+                           next_cursor=next_cursor, feed_url=url_for('browse_page', **feed_args))
+
+#further pages of /browse for the grid, or the same results for any other client
+@app.route('/api/browse')
+@login_required
+def browse_page():
+    filters, listings, next_cursor = browse_results()
+    return jsonify({
+        'listings': [dict(listing) for listing in listings],
+        'html': render_template('listings-grid-items.html', listings=listings),
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/')
 def home():
@@ -482,21 +1218,16 @@ def home():
     return redirect(url_for('login'))
 
 #get the number of unread messages and give that info to the header.html
+#the count is kept up to date by send_message() and mark_chat_read(). It changes with every message, so it is read fresh
+#(one primary-key lookup per page) rather than from user_cache, whose copies in other processes can't be invalidated;
+#the read is only shared with load_user when user_cache missed and fetch_user loaded the row in this request
 @app.context_processor
 def unread_message_count():
     if current_user.is_authenticated:
         conn = get_db_connection()
-        unread_count = conn.execute("""
-            SELECT COUNT(*) AS unread_count
-            FROM messages
-            WHERE chat_id IN (
-                SELECT chat_id
-                FROM chats
-                WHERE (buyer_id = :user_id OR seller_id = :user_id)
-            ) AND read_status = "0" AND sender_id != :user_id
-        """, {'user_id': current_user.id}).fetchone()
+        user = get_user(conn, current_user.id)
         conn.close()
-        return (unread_count)
+        return {'unread_count': user['unread_count'] if user else 0}
     return {'unread_count': 0}
 
     
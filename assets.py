@@ -0,0 +1,169 @@
+"""
+Static asset pipeline for HawkSwap.
+
+    python assets.py build
+
+copies every file under static/ (apart from user uploads) to static/build/
+under a name carrying a hash of its contents, e.g. style.3f2a9c1b04d7.css,
+minifying CSS on the way. Next to every text file it writes a .gz and, with
+the brotli package installed, a .br, each at the highest compression level,
+and keeps them only if they are smaller. static/build/manifest.json maps
+each original name to its fingerprinted copy.
+
+StaticAssets(app) then points url_for('static', filename='style.css') at
+the fingerprinted copy and serves it with a year-long immutable
+Cache-Control, sending the .br or .gz variant as it is when the client
+accepts one. A changed file gets a new name, so nobody is served a stale
+copy. Without a build, static/ is served as before. Run the build again
+after changing a static file; older copies are kept for pages still
+cached somewhere.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import request, send_from_directory
+
+from compression import is_compressible
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+# Directories under static/ that aren't part of the site's code
+SKIP_DIRS = {BUILD_DIR, 'uploads'}
+# A year, the longest lifetime caches honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Precompressed variants, in order of preference
+VARIANTS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def minify_css(css):
+    """Drop comments and the whitespace CSS doesn't need. Good enough for hand-written stylesheets."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def fingerprinted_name(path, data):
+    root, extension = os.path.splitext(path)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+
+
+def compressed_variants(data):
+    """(extension, bytes) of each precompressed variant worth keeping."""
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    return [(extension, compressed) for extension, compressed in variants if len(compressed) < len(data)]
+
+
+def build(static_dir):
+    """Fingerprint, minify and precompress static_dir into static_dir/build. Returns the manifest."""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir:
+            dirs[:] = [name for name in dirs if name not in SKIP_DIRS]
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            path = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            if name.endswith('.css'):
+                data = minify_css(data.decode()).encode()
+            target = fingerprinted_name(path, data)
+            destination = os.path.join(build_dir, target)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            files_out = [('', data)]
+            if is_compressible(mimetypes.guess_type(name)[0]):
+                files_out += compressed_variants(data)
+            for extension, content in files_out:
+                with open(destination + extension + '.tmp', 'wb') as f:
+                    f.write(content)
+                os.replace(destination + extension + '.tmp', destination + extension)
+            manifest[path] = f'{BUILD_DIR}/{target}'
+    os.makedirs(build_dir, exist_ok=True)
+    manifest_path = os.path.join(build_dir, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+class StaticAssets:
+    """Serves the output of build() in place of the files under static/."""
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.variants = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.load()
+        app.url_defaults(self._fingerprint)
+        app.view_functions['static'] = self.send_static
+
+    def load(self):
+        """Read the manifest and note which precompressed variants exist."""
+        build_dir = os.path.join(self.static_folder, BUILD_DIR)
+        try:
+            with open(os.path.join(build_dir, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        self.variants = {
+            os.path.relpath(os.path.join(root, name), self.static_folder).replace(os.sep, '/')
+            for root, dirs, files in os.walk(build_dir) for name in files
+            if name.endswith(tuple(extension for encoding, extension in VARIANTS))
+        }
+
+    def _fingerprint(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def send_static(self, filename):
+        if not filename.startswith(BUILD_DIR + '/'):
+            return send_from_directory(self.static_folder, filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+        for encoding, extension in VARIANTS:
+            if accepted[encoding] and filename + extension in self.variants:
+                response = send_from_directory(self.static_folder, filename + extension, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.static_folder, filename)
+        if any(filename + extension in self.variants for encoding, extension in VARIANTS):
+            response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build fingerprinted, minified and precompressed static files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='write static/build and its manifest')
+    build_parser.add_argument('--static-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    args = parser.parse_args()
+    manifest = build(args.static_dir)
+    for path, target in sorted(manifest.items()):
+        print(f'{path} -> {target}')
+
+
+if __name__ == '__main__':
+    main()
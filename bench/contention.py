@@ -0,0 +1,141 @@
+"""
+Mixed read/write load against the app, with the rollback journal and with WAL.
+
+Each mode runs in its own process against a fresh copy of the same seeded
+database. Worker threads log in as chat buyers and loop over a mix of page
+views (home, inbox, a listing, the chat poll) and writes (sending a chat
+message, toggling a save) for a fixed time. Latency percentiles are printed
+per mode and, with --output, written as JSON.
+
+    python bench/contention.py [--threads 16] [--seconds 20] [--write-ratio 0.2]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = {'rollback': '0', 'wal': '1'}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(latencies):
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': max(latencies) if latencies else None,
+    }
+
+
+def run_load(threads, seconds, write_ratio):
+    """Runs inside the child process, with the database chosen by the environment."""
+    os.chdir(ROOT)
+    from app import app, engine
+    app.config['TESTING'] = True
+    chats = engine.execute('SELECT chat_id, buyer_id, listing_id FROM chats ORDER BY chat_id LIMIT :n', {'n': threads * 4}).fetchall()
+    results = {'read': [], 'write': [], 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def worker(index):
+        rng = random.Random(index)
+        chat_id, buyer_id, listing_id = chats[index % len(chats)]
+        client = app.test_client()
+        client.post('/login', data={'username': f'user{buyer_id}', 'password': 'password'})
+        reads = [
+            '/home',
+            '/inbox',
+            f'/listing/{listing_id}',
+            f'/get_messages/{chat_id}?after=999999999',
+        ]
+        while time.monotonic() < deadline:
+            write = rng.random() < write_ratio
+            start = time.perf_counter()
+            if write:
+                if rng.random() < 0.5:
+                    response = client.post(f'/chat/{chat_id}', json={'message': 'still available?'})
+                else:
+                    response = client.post(f'/save-listing/{listing_id}')
+            else:
+                response = client.get(rng.choice(reads))
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                if response.status_code >= 400:
+                    results['errors'] += 1
+                else:
+                    results['write' if write else 'read'].append(elapsed)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return {
+        'read': summarize(results['read']),
+        'write': summarize(results['write']),
+        'all': summarize(results['read'] + results['write']),
+        'errors': results['errors'],
+        'throughput_rps': (len(results['read']) + len(results['write'])) / seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--listings', type=int, default=20000)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', choices=sorted(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_load(args.threads, args.seconds, args.write_ratio)))
+        return
+
+    from bench.seed import seed
+    report = {'threads': args.threads, 'seconds': args.seconds, 'write_ratio': args.write_ratio, 'modes': {}}
+    with tempfile.TemporaryDirectory() as work:
+        seeded = os.path.join(work, 'seeded.db')
+        seed(seeded, listings=args.listings, chats=args.listings // 4, messages=args.listings * 2)
+        for mode, wal in MODES.items():
+            path = os.path.join(work, f'{mode}.db')
+            shutil.copy(seeded, path)
+            env = dict(os.environ, HAWKSWAP_DATABASE_URI=f'sqlite:///{path}', HAWKSWAP_SQLITE_WAL=wal)
+            output = subprocess.run(
+                [sys.executable, '-W', 'ignore', __file__, '--child', mode, '--threads', str(args.threads),
+                 '--seconds', str(args.seconds), '--write-ratio', str(args.write_ratio)],
+                env=env, check=True, capture_output=True, text=True,
+            ).stdout
+            report['modes'][mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"{'mode':>9} {'kind':>6} {'requests':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode, result in report['modes'].items():
+        for kind in ('read', 'write', 'all'):
+            row = result[kind]
+            print(f"{mode:>9} {kind:>6} {row['requests']:>9} " + ' '.join(
+                f'{row[key]:>8.1f}' if row[key] is not None else f"{'-':>8}" for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')))
+        print(f"{mode:>9} errors {result['errors']}, {result['throughput_rps']:.0f} req/s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Peak memory and latency of processing a phone-sized upload.
+
+Each case runs in a fresh process so its peak RSS is its own. "baseline" is
+the old request-time path (full-resolution decode, rotate, re-encode into a
+BytesIO); "variants" is generate_image_variants() as the upload workers run it.
+
+    python bench/images.py [--megapixels 12 48] [--repeat 3]
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ExifTags  # noqa: E402
+
+# Width x height of typical 4:3 phone sensors by megapixel count
+SENSORS = {12: (4032, 3024), 48: (8064, 6048)}
+
+
+def make_photo(path, megapixels):
+    """A rotated (EXIF orientation 6) JPEG with enough detail to compress like a photo."""
+    width, height = SENSORS[megapixels]
+    img = Image.effect_mandelbrot((width, height), (-2.0, -1.2, 1.0, 1.2), 64).convert('RGB')
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    img.save(path, 'JPEG', quality=90, exif=exif)
+
+
+def baseline(source, dest_dir):
+    img = Image.open(source)
+    for orientation in ExifTags.TAGS.keys():
+        if ExifTags.TAGS[orientation] == 'Orientation':
+            break
+    exif = dict(img._getexif().items())
+    if exif.get(orientation) == 6:
+        img = img.rotate(270, expand=True)
+    img_io = io.BytesIO()
+    img.save(img_io, 'JPEG', quality=65)
+    img_io.seek(0)
+    with open(os.path.join(dest_dir, 'out.jpg'), 'wb') as f:
+        f.write(img_io.read())
+
+
+def variants(source, dest_dir):
+    from app import generate_image_variants
+    generate_image_variants(source, dest_dir)
+
+
+def run_case(case, source, queue):
+    import app  # noqa: F401  (import cost is not part of the measurement)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as dest_dir:
+        start = time.perf_counter()
+        {'baseline': baseline, 'variants': variants}[case](source, dest_dir)
+        elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    queue.put((elapsed, (peak - before) / 1024, peak / 1024))
+
+
+def measure(case, source):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case, args=(case, source, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--megapixels', type=int, nargs='+', default=[12, 48], choices=sorted(SENSORS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn')
+    print(f"{'photo':>6} {'case':>9} {'latency ms':>11} {'peak growth MiB':>16} {'peak RSS MiB':>13}")
+    with tempfile.TemporaryDirectory() as work:
+        for megapixels in args.megapixels:
+            source = os.path.join(work, f'{megapixels}mp.jpg')
+            # Linux carries peak RSS across fork and exec, so keep this process small
+            maker = multiprocessing.Process(target=make_photo, args=(source, megapixels))
+            maker.start()
+            maker.join()
+            for case in ('baseline', 'variants'):
+                runs = [measure(case, source) for _ in range(args.repeat)]
+                elapsed = sorted(run[0] for run in runs)[len(runs) // 2]
+                growth = max(run[1] for run in runs)
+                peak = max(run[2] for run in runs)
+                print(f'{megapixels:>4}MP {case:>9} {elapsed * 1000:>11.0f} {growth:>16.1f} {peak:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Throughput and latency of the main routes under a mixed load.
+
+Seeds a database at the chosen scale (or copies --db), serves the app from it
+with a threaded WSGI server in a child process, and drives it over HTTP from
+--clients threads for --seconds. Each client logs in as a chat buyer and
+picks requests from a weighted mix of the home feed, search, the inbox, a
+chat page, a chat poll and creating a listing with a photo, accepting the
+compression in --accept-encoding. Prints requests, throughput, p50/p95/p99
+latency and bytes on the wire per endpoint and, with --output, saves them as
+JSON. --compare prints the change against an earlier JSON run.
+
+    python bench/routes.py [--scale 100k] [--clients 8] [--seconds 30] [--output results.json]
+    python bench/routes.py --compare before.json [--output after.json]
+"""
+import argparse
+import datetime
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.contention import summarize  # noqa: E402
+from bench.seed import add_scale_arguments, scale_from_args, seed  # noqa: E402
+
+# Relative weight of each endpoint in the mix
+MIX = {
+    'index': 30,
+    'search': 15,
+    'inbox': 10,
+    'chat': 10,
+    'get_messages': 30,
+    'create_listing': 5,
+}
+SEARCH_TERMS = ['chair', 'desk lamp', 'bike', 'mini fridge', 'vintage', 'blue couch', 'textbook', 'guitar amp']
+
+
+def serve(port, workdir):
+    """
+    Runs inside the child process, with the database chosen by the environment.
+    The app writes uploads under ./static, so it runs from the work directory
+    and the benchmark's photos never land in the checkout.
+    """
+    os.makedirs(os.path.join(workdir, 'static', 'uploads'), exist_ok=True)
+    os.chdir(workdir)
+    from werkzeug.serving import make_server
+    from app import app
+    app.logger.disabled = True
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def wait_for_server(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url + '/login').read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def photo_bytes():
+    """A phone-sized JPEG to upload."""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.effect_mandelbrot((1600, 1200), (-2.0, -1.2, 1.0, 1.2), 32).convert('RGB').save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, mimetype) in files.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                   f'Content-Type: {mimetype}\r\n\r\n'.encode())
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time the route itself, not the page it redirects to."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def run_load(url, chats, clients, seconds, photo, accept_encoding=None):
+    results = {endpoint: [] for endpoint in MIX}
+    received = {endpoint: 0 for endpoint in MIX}
+    errors = {endpoint: 0 for endpoint in MIX}
+    lock = threading.Lock()
+    endpoints = list(MIX)
+    weights = [MIX[endpoint] for endpoint in endpoints]
+    ready = threading.Barrier(clients)
+    deadline = []
+
+    def worker(index):
+        rng = random.Random(index)
+        chat_id, buyer_id, listing_id = chats[index % len(chats)]
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+        login = urllib.parse.urlencode({'username': f'user{buyer_id}', 'password': 'password'}).encode()
+        try:
+            opener.open(url + '/login', login)
+        except urllib.error.HTTPError as e:
+            if e.code != 302:
+                raise
+        if ready.wait() == 0:
+            deadline.append(time.monotonic() + seconds)
+        ready.wait()
+        while time.monotonic() < deadline[0]:
+            endpoint = rng.choices(endpoints, weights)[0]
+            data, headers = None, {}
+            if accept_encoding:
+                headers['Accept-Encoding'] = accept_encoding
+            if endpoint == 'index':
+                path = '/home'
+            elif endpoint == 'search':
+                path = '/search?' + urllib.parse.urlencode({'search_query': rng.choice(SEARCH_TERMS)})
+            elif endpoint == 'inbox':
+                path = '/inbox'
+            elif endpoint == 'chat':
+                path = f'/chat/{chat_id}'
+            elif endpoint == 'get_messages':
+                path = f'/get_messages/{chat_id}?after=999999999'
+            else:
+                path = '/create-listing'
+                data, content_type = multipart(
+                    {'name': 'bench chair', 'description': 'barely used', 'price': str(rng.randrange(5, 200))},
+                    {'image': ('photo.jpg', photo, 'image/jpeg')},
+                )
+                headers['Content-Type'] = content_type
+            start = time.perf_counter()
+            try:
+                with opener.open(urllib.request.Request(url + path, data, headers)) as response:
+                    size = len(response.read())
+                failed = False
+            except urllib.error.HTTPError as e:
+                size = len(e.read())
+                failed = e.code >= 400
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                if failed:
+                    errors[endpoint] += 1
+                else:
+                    results[endpoint].append(elapsed)
+                    received[endpoint] += size
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = {}
+    for endpoint in endpoints:
+        report[endpoint] = summarize(results[endpoint])
+        report[endpoint]['errors'] = errors[endpoint]
+        report[endpoint]['throughput_rps'] = len(results[endpoint]) / seconds
+        report[endpoint]['bytes_per_request'] = received[endpoint] / len(results[endpoint]) if results[endpoint] else None
+    everything = [value for values in results.values() for value in values]
+    report['all'] = summarize(everything)
+    report['all']['errors'] = sum(errors.values())
+    report['all']['throughput_rps'] = len(everything) / seconds
+    report['all']['bytes_per_request'] = sum(received.values()) / len(everything) if everything else None
+    return report
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(endpoints, previous=None):
+    columns = ('p50_ms', 'p95_ms', 'p99_ms', 'bytes_per_request')
+    print(f"{'endpoint':>15} {'requests':>9} {'req/s':>8} " + ' '.join(f"{column.replace('_per_request', '/req'):>8}" for column in columns) + f" {'errors':>7}")
+    for endpoint, row in endpoints.items():
+        cells = [f'{row[column]:>8.1f}' if row[column] is not None else f"{'-':>8}" for column in columns]
+        print(f"{endpoint:>15} {row['requests']:>9} {row['throughput_rps']:>8.1f} " + ' '.join(cells) + f" {row['errors']:>7}")
+        before = (previous or {}).get(endpoint)
+        if before:
+            changes = []
+            for column in ('throughput_rps',) + columns:
+                if before.get(column) and row.get(column) is not None:
+                    changes.append(f'{(row[column] / before[column] - 1) * 100:>+7.0f}%')
+                else:
+                    changes.append(f"{'-':>8}")
+            print(f"{'vs before':>15} {'':>9} " + ' '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_scale_arguments(parser)
+    parser.add_argument('--db', help='benchmark a copy of this seeded database instead of seeding one')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--accept-encoding', default='br, gzip', help='Accept-Encoding the clients send ("" for none)')
+    parser.add_argument('--serve', metavar='WORKDIR', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.serve)
+        return
+
+    scale = scale_from_args(args)
+    with tempfile.TemporaryDirectory() as work:
+        path = os.path.join(work, 'bench.db')
+        start = time.perf_counter()
+        if args.db:
+            shutil.copy(args.db, path)
+        else:
+            seed(path, **scale)
+        seed_seconds = time.perf_counter() - start
+
+        import sqlite3
+        conn = sqlite3.connect(path)
+        chats = conn.execute('SELECT chat_id, buyer_id, listing_id FROM chats ORDER BY chat_id LIMIT ?', (args.clients * 4,)).fetchall()
+        conn.close()
+
+        env = dict(os.environ, HAWKSWAP_DATABASE_URI=f'sqlite:///{path}')
+        server = subprocess.Popen([sys.executable, '-W', 'ignore', __file__, '--serve', work, '--port', str(args.port)],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{args.port}'
+        try:
+            wait_for_server(url)
+            endpoints = run_load(url, chats, args.clients, args.seconds, photo_bytes(), args.accept_encoding)
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'revision': git_revision(),
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'scale': args.scale if args.db is None else None,
+        'rows': scale if args.db is None else None,
+        'database': args.db,
+        'seed_seconds': seed_seconds,
+        'clients': args.clients,
+        'accept_encoding': args.accept_encoding,
+        'seconds': args.seconds,
+        'mix': MIX,
+        'endpoints': endpoints,
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['endpoints']
+    print_report(endpoints, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Fill a database with synthetic HawkSwap data for benchmarks.
+
+    python bench/seed.py bench.db --scale 100k [--listings 250000]
+
+Every user's password is "password". --scale picks row counts by listing
+count, from 1k to 1m (default 10k, a small campus); the per-table options
+override single counts. The denormalized counters are rebuilt with
+init_db.backfill() at the end.
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import init_db  # noqa: E402
+
+WORDS = (
+    'desk lamp chair couch sofa table bike helmet lock textbook calculator '
+    'monitor keyboard mouse laptop stand mini fridge microwave rug mirror '
+    'shelf dresser mattress futon poster jacket boots skis board guitar '
+    'amp speaker headphones printer kettle blender fan heater plant vintage '
+    'wooden metal blue red black white large small used new barely comfy'
+).split()
+BATCH_SIZE = 10000
+START = datetime.datetime(2024, 1, 1)
+# Row counts per table for each --scale, named by listing count
+SCALES = {
+    '1k': {'users': 200, 'listings': 1000, 'chats': 500, 'messages': 5000, 'saves': 1000},
+    '10k': {'users': 1000, 'listings': 10000, 'chats': 5000, 'messages': 50000, 'saves': 10000},
+    '100k': {'users': 10000, 'listings': 100000, 'chats': 50000, 'messages': 500000, 'saves': 100000},
+    '1m': {'users': 100000, 'listings': 1000000, 'chats': 500000, 'messages': 5000000, 'saves': 1000000},
+}
+
+
+def phrase(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def timestamp(rng, days=365):
+    return (START + datetime.timedelta(seconds=rng.randrange(days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def insert_batched(conn, sql, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+
+
+def seed(path, users=1000, listings=10000, chats=5000, messages=50000, saves=10000, random_seed=0):
+    rng = random.Random(random_seed)
+    conn = sqlite3.connect(path, isolation_level=None)
+    init_db.create_tables(conn)
+    init_db.migrate(conn)
+    conn.execute('BEGIN')
+    insert_batched(conn, 'INSERT INTO users (username, name_first, name_last, password, email) VALUES (?, ?, ?, ?, ?)', (
+        (f'user{i}', f'First{i}', f'Last{i}', 'password', f'user{i}@ku.edu') for i in range(1, users + 1)
+    ))
+    insert_batched(conn, 'INSERT INTO listings (name, description, price, image_path, dateposted, is_sold, seller_id) VALUES (?, ?, ?, ?, ?, ?, ?)', (
+        (phrase(rng, 3), phrase(rng, 20), rng.randrange(1, 500), 'hawkswap.png', timestamp(rng), int(rng.random() < 0.3), rng.randrange(1, users + 1))
+        for _ in range(listings)
+    ))
+    conn.execute('UPDATE listings SET sold_at = dateposted WHERE is_sold = 1')
+    sellers = [row[0] for row in conn.execute('SELECT seller_id FROM listings ORDER BY id')]
+
+    def chat_rows():
+        for _ in range(chats):
+            listing_id = rng.randrange(1, listings + 1)
+            seller_id = sellers[listing_id - 1]
+            buyer_id = rng.randrange(1, users + 1)
+            if buyer_id == seller_id:
+                buyer_id = buyer_id % users + 1
+            yield timestamp(rng), listing_id, seller_id, buyer_id
+    insert_batched(conn, 'INSERT INTO chats (created_at, listing_id, seller_id, buyer_id) VALUES (?, ?, ?, ?)', chat_rows())
+    participants = conn.execute('SELECT buyer_id, seller_id FROM chats ORDER BY chat_id').fetchall()
+    if participants:
+        insert_batched(conn, 'INSERT INTO messages (chat_id, sender_id, message_content, sent_at) VALUES (?, ?, ?, ?)', (
+            (chat_id, rng.choice(participants[chat_id - 1]), phrase(rng, 8), timestamp(rng))
+            for chat_id in sorted(rng.randrange(1, len(participants) + 1) for _ in range(messages))
+        ))
+        # Most participants have read their whole chat, the rest part of it
+        spans = conn.execute('SELECT chat_id, MIN(message_id), MAX(message_id) FROM messages GROUP BY chat_id').fetchall()
+
+        def last_read(first, last):
+            return last if rng.random() < 0.8 else rng.randrange(first - 1, last)
+        insert_batched(conn, 'UPDATE chats SET buyer_last_read = ?, seller_last_read = ? WHERE chat_id = ?', (
+            (last_read(first, last), last_read(first, last), chat_id) for chat_id, first, last in spans
+        ))
+    insert_batched(conn, 'INSERT INTO saves (user_id, listing_id, saved_at) VALUES (?, ?, ?) ON CONFLICT DO NOTHING', (
+        (rng.randrange(1, users + 1), rng.randrange(1, listings + 1), timestamp(rng)) for _ in range(saves)
+    ))
+    conn.execute('COMMIT')
+    init_db.backfill(conn)
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def add_scale_arguments(parser):
+    parser.add_argument('--scale', choices=SCALES, default='10k')
+    for table in SCALES['10k']:
+        parser.add_argument(f'--{table}', type=int, help=f'number of {table} (overrides --scale)')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def scale_from_args(args):
+    scale = {table: count if getattr(args, table) is None else getattr(args, table)
+             for table, count in SCALES[args.scale].items()}
+    scale['random_seed'] = args.seed
+    return scale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill a database with synthetic HawkSwap data.')
+    parser.add_argument('path')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        sys.exit(f'{args.path} already exists')
+    seed(args.path, **scale_from_args(args))
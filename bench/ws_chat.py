@@ -0,0 +1,166 @@
+"""
+Many open chat tabs against the WebSocket chat service (chat_ws.py).
+
+Seeds a fresh database, starts chat_ws.py on it, and opens --tabs sockets,
+one per participant of --tabs / 2 chats, authenticated with session cookies
+signed by the app's secret key. While the tabs sit open, senders push
+messages at --rate per second through random sockets and the other
+participant's socket times how long each one takes to arrive. Prints the
+delivery latency percentiles and the service's memory per open socket and,
+with --output, writes them as JSON.
+
+    python bench/ws_chat.py [--tabs 2000] [--seconds 20] [--rate 50]
+
+Needs the websockets package.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Origin the simulated chat pages are served from
+ORIGIN = 'http://127.0.0.1:5000'
+sys.path.insert(0, ROOT)
+
+
+def rss_kib(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run_tabs(url, chats, cookie, seconds, rate, server_pid):
+    from websockets.asyncio.client import connect
+    from bench.contention import summarize
+
+    latencies = []
+    sent = {}
+    errors = 0
+
+    async def reader(socket, user_id):
+        nonlocal errors
+        try:
+            async for frame in socket:
+                for message in json.loads(frame)['messages']:
+                    content = message['message_content']
+                    if message['sender_id'] != user_id and content in sent:
+                        latencies.append((time.perf_counter() - sent.pop(content)) * 1000)
+        except Exception:
+            errors += 1
+
+    idle_rss = rss_kib(server_pid)
+    start = time.perf_counter()
+    tabs = []
+    for chat_id, buyer_id, seller_id, last_message_id in chats:
+        for user_id in (buyer_id, seller_id):
+            # Like a chat page that has already rendered the history
+            socket = await connect(f'{url}/chat/{chat_id}?after={last_message_id}', additional_headers={'Cookie': cookie(user_id)},
+                                   origin=ORIGIN, open_timeout=30, ping_interval=None)
+            tabs.append((socket, user_id, asyncio.ensure_future(reader(socket, user_id))))
+    connect_seconds = time.perf_counter() - start
+    await asyncio.sleep(2)  # let the first refresh of every socket settle
+    open_rss = rss_kib(server_pid)
+
+    rng = random.Random(0)
+    deadline = time.monotonic() + seconds
+    count = 0
+    while time.monotonic() < deadline:
+        socket, user_id, _ = rng.choice(tabs)
+        content = f'bench {count}'
+        sent[content] = time.perf_counter()
+        await socket.send(json.dumps({'message': content}))
+        count += 1
+        await asyncio.sleep(1 / rate)
+    await asyncio.sleep(3)  # stragglers
+
+    for socket, _, task in tabs:
+        await socket.close()
+        task.cancel()
+    return {
+        'tabs': len(tabs),
+        'connect_seconds': connect_seconds,
+        'server_rss_kib_idle': idle_rss,
+        'server_rss_kib_open': open_rss,
+        'server_kib_per_tab': (open_rss - idle_rss) / len(tabs) if idle_rss and open_rss else None,
+        'messages_sent': count,
+        'messages_lost': len(sent),
+        'delivery': summarize(latencies),
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tabs', type=int, default=2000)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--rate', type=float, default=50, help='messages sent per second, across all tabs')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    raise_file_limit()
+
+    from bench.seed import seed
+    with tempfile.TemporaryDirectory() as work:
+        path = os.path.join(work, 'bench.db')
+        chat_count = max(args.tabs // 2, 1)
+        seed(path, users=max(chat_count, 100), listings=chat_count, chats=chat_count, messages=chat_count * 4)
+        env = dict(os.environ, HAWKSWAP_DATABASE_URI=f'sqlite:///{path}')
+        os.environ.update(env)
+        os.chdir(ROOT)
+        from app import app, engine
+        serializer = app.session_interface.get_signing_serializer(app)
+
+        def cookie(user_id):
+            return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'_user_id': str(user_id), '_fresh': True})}"
+
+        chats = engine.execute('SELECT chat_id, buyer_id, seller_id, COALESCE(last_message_id, 0) FROM chats ORDER BY chat_id LIMIT :n', {'n': chat_count}).fetchall()
+        server = subprocess.Popen([sys.executable, '-W', 'ignore', os.path.join(ROOT, 'chat_ws.py'), '--port', str(args.port), '--origin', ORIGIN],
+                                  env=env, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_for_port('127.0.0.1', args.port))
+            report = asyncio.run(run_tabs(f'ws://127.0.0.1:{args.port}', chats, cookie, args.seconds, args.rate, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+
+    delivery = report['delivery']
+    print(f"{report['tabs']} tabs open in {report['connect_seconds']:.1f}s, "
+          f"{report['server_kib_per_tab'] or 0:.1f} KiB per tab in the service")
+    print(f"{report['messages_sent']} messages sent, {report['messages_lost']} not delivered, {report['errors']} socket errors")
+    print('delivery ms: ' + ', '.join(
+        f"{key[:-3]} {delivery[key]:.1f}" for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms') if delivery[key] is not None))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
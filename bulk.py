@@ -0,0 +1,287 @@
+"""
+Bulk listing import and export for HawkSwap.
+
+Rows are CSV with a header line or JSON Lines, one listing each:
+
+    name, description, price, image, is_sold
+
+Only name and price are required. image names a file in the accompanying zip
+archive of photos; is_sold takes 1/0, true/false or yes/no.
+
+Imports run in batches. Each batch's photos are stored and resized in
+parallel on a process pool, then the batch's listings go into the database
+with one executemany in one transaction. A bad row, or a row whose photo
+can't be used, is reported and skipped, and the rest still go in. Progress
+and per-row errors are yielded as events, which /listings/import streams back
+as JSON Lines and the command line prints:
+
+    python bulk.py import rows.csv --images photos.zip --seller user1
+    python bulk.py export [--seller user1] [--format csv] > listings.jsonl
+
+Exports stream every listing (or one seller's) in id order in either format.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+FIELDS = ['name', 'description', 'price', 'image', 'is_sold']
+EXPORT_FIELDS = ['id', 'name', 'description', 'price', 'is_sold', 'dateposted', 'seller', 'image']
+FORMATS = ('csv', 'jsonl')
+# Listings inserted per transaction, and photos resized per round of the pool
+BATCH_SIZE = 500
+EXPORT_CHUNK_SIZE = 1000
+# Largest photo read out of an archive, uncompressed
+MAX_ARCHIVE_IMAGE_BYTES = 40 * 1024 * 1024
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+FALSE_VALUES = {'', '0', 'false', 'no', 'n', 'f'}
+
+
+def format_for(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, dict) for every row of a binary CSV or JSON Lines stream."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = {'_error': f'invalid JSON: {e}'}
+        yield line_number, row if isinstance(row, dict) else {'_error': 'expected a JSON object'}
+
+
+def clean_row(row):
+    """The listing fields of a row, or raise ValueError saying what is wrong with it."""
+    if '_error' in row:
+        raise ValueError(row['_error'])
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    try:
+        price = float(row.get('price'))
+    except (TypeError, ValueError):
+        raise ValueError('price must be a number')
+    if not 0 <= price < 1e9:
+        raise ValueError('price out of range')
+    is_sold = str(row.get('is_sold') if row.get('is_sold') is not None else '').strip().lower()
+    if is_sold not in TRUE_VALUES | FALSE_VALUES:
+        raise ValueError('is_sold must be true or false')
+    return {
+        'name': name,
+        'description': str(row.get('description') or '').strip(),
+        'price': price,
+        'is_sold': is_sold in TRUE_VALUES,
+        'image': str(row.get('image') or '').strip() or None,
+    }
+
+
+def open_archive_image(archive, name):
+    """A file object for a photo in the archive. Raises ValueError if it is missing or too big."""
+    if archive is None:
+        raise ValueError(f'image {name!r} given but no image archive was uploaded')
+    try:
+        info = archive.getinfo(name)
+    except KeyError:
+        raise ValueError(f'image {name!r} is not in the archive')
+    if info.file_size > MAX_ARCHIVE_IMAGE_BYTES:
+        raise ValueError(f'image {name!r} is larger than {MAX_ARCHIVE_IMAGE_BYTES // (1024 * 1024)} MB')
+    return archive.open(info)
+
+
+def import_listings(rows, seller_id, *, get_db_connection, store_image, make_variants, image_dir, image_lock,
+                    archive=None, workers=None, posted_at, batch_size=BATCH_SIZE):
+    """
+    Import (line number, row) pairs as listings of seller_id, yielding events:
+    {"event": "error", "line", "error"} for each skipped row, {"event":
+    "progress", "rows", "imported", "failed"} after each batch and {"event":
+    "done", ...} at the end.
+
+    store_image(file, filename) stores a photo and returns (key, path, ready)
+    like app.save_upload(); make_variants(source, dest_dir) is
+    app.generate_image_variants, run on the process pool for photos that are
+    not ready, each under image_lock(key) (app.image_lock) so the app's own
+    image jobs for the same photo wait their turn.
+    """
+    totals = {'rows': 0, 'imported': 0, 'failed': 0}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for line_number, row in rows:
+            batch.append((line_number, row))
+            if len(batch) >= batch_size:
+                yield from import_batch(batch, seller_id, totals, get_db_connection, store_image, make_variants,
+                                        image_dir, image_lock, archive, pool, posted_at)
+                batch = []
+        if batch:
+            yield from import_batch(batch, seller_id, totals, get_db_connection, store_image, make_variants,
+                                    image_dir, image_lock, archive, pool, posted_at)
+    yield dict(totals, event='done')
+
+
+def import_batch(batch, seller_id, totals, get_db_connection, store_image, make_variants, image_dir, image_lock,
+                 archive, pool, posted_at):
+    listings = []
+    errors = []
+    originals = {}
+    for line_number, row in batch:
+        try:
+            listing = clean_row(row)
+            listing['line'] = line_number
+            listing['key'] = listing['image_path'] = None
+            if listing['image']:
+                with open_archive_image(archive, listing['image']) as image:
+                    key, path, ready = store_image(image, listing['image'])
+                listing['key'], listing['image_path'] = key, path
+                if not ready:
+                    # The same photo may come more than once, under different extensions
+                    originals.setdefault(key, []).append(path)
+            listings.append(listing)
+        except (ValueError, OSError, zipfile.BadZipFile) as e:
+            errors.append((line_number, str(e)))
+
+    # Photos that were new to us: build their variants, then point at full.jpg.
+    # Each photo's lock is held until its original is gone, so an app job for
+    # the same photo neither writes the same files nor needs the original
+    # afterwards. Locks are taken in key order so two imports can't deadlock.
+    failed_keys = set()
+    with ExitStack() as locks:
+        jobs = {}
+        for key in sorted(originals):
+            locks.enter_context(image_lock(key))
+            # An app job may have finished this photo before we got the lock
+            if not os.path.exists(os.path.join('static', image_dir(key), 'full.jpg')):
+                jobs[key] = pool.submit(make_variants, os.path.join('static', originals[key][0]), os.path.join('static', image_dir(key)))
+        for key, original_paths in originals.items():
+            try:
+                if key in jobs:
+                    jobs[key].result()
+            except Exception as e:
+                failed_keys.add(key)
+                errors.extend((listing['line'], f"image {listing['image']!r} could not be processed: {e}")
+                              for listing in listings if listing['key'] == key)
+            for original_path in original_paths:
+                try:
+                    os.remove(os.path.join('static', original_path))
+                except FileNotFoundError:
+                    pass
+    for listing in listings:
+        if listing['key'] in originals and listing['key'] not in failed_keys:
+            listing['image_path'] = os.path.join(image_dir(listing['key']), 'full.jpg')
+    listings = [listing for listing in listings if listing['key'] not in failed_keys]
+
+    if listings:
+        conn = get_db_connection(write=True)
+        conn.execute(
+            'INSERT INTO listings (name, description, price, dateposted, is_sold, sold_at, seller_id, image_path, image_key) '
+            'VALUES (:name, :description, :price, :dateposted, :is_sold, :sold_at, :seller_id, :image_path, :image_key)',
+            [{'name': listing['name'], 'description': listing['description'], 'price': listing['price'],
+              'dateposted': posted_at, 'is_sold': listing['is_sold'], 'sold_at': posted_at if listing['is_sold'] else None,
+              'seller_id': seller_id,
+              'image_path': listing['image_path'], 'image_key': listing['key']} for listing in listings],
+        )
+        conn.commit()
+        conn.close()
+
+    for line_number, error in sorted(errors):
+        yield {'event': 'error', 'line': line_number, 'error': error}
+    totals['rows'] += len(batch)
+    totals['imported'] += len(listings)
+    totals['failed'] += len(batch) - len(listings)
+    yield dict(totals, event='progress')
+
+
+def export_listings(conn, fmt, seller_id=None, image_url=None):
+    """
+    Yield the listings as CSV or JSON Lines text, a chunk of rows at a time,
+    walking the primary key so memory stays flat however many there are.
+    """
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+    after = 0
+    while True:
+        sql = ('SELECT l.id, l.name, l.description, l.price, l.is_sold, l.dateposted, u.username AS seller, l.image_path '
+               'FROM listings l JOIN users u ON u.id = l.seller_id WHERE l.id > :after')
+        params = {'after': after, 'limit': EXPORT_CHUNK_SIZE}
+        if seller_id is not None:
+            sql += ' AND l.seller_id = :seller_id'
+            params['seller_id'] = seller_id
+        rows = conn.execute(sql + ' ORDER BY l.id LIMIT :limit', params).fetchall()
+        if not rows:
+            return
+        after = rows[-1]['id']
+        buffer = io.StringIO()
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+        for row in rows:
+            values = [row['id'], row['name'], row['description'], row['price'], bool(row['is_sold']),
+                      str(row['dateposted']), row['seller'], image_url(row['image_path']) if image_url else row['image_path']]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, values))) + '\n')
+        yield buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import and export HawkSwap listings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='import listings from CSV or JSON Lines')
+    import_parser.add_argument('rows', help='CSV or JSON Lines file (- for stdin)')
+    import_parser.add_argument('--images', help='zip archive of the photos the rows name')
+    import_parser.add_argument('--seller', required=True, help='username the listings belong to')
+    import_parser.add_argument('--format', choices=FORMATS, help='default: from the file extension')
+    import_parser.add_argument('--workers', type=int, help='image processes (default: one per CPU)')
+    export_parser = commands.add_parser('export', help='write listings to stdout')
+    export_parser.add_argument('--seller', help='only this username\'s listings')
+    export_parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    args = parser.parse_args()
+
+    import app
+
+    conn = app.get_db_connection()
+    seller_id = None
+    if args.seller:
+        seller_id = conn.execute('SELECT id FROM users WHERE username = :username', {'username': args.seller}).scalar()
+        if seller_id is None:
+            sys.exit(f'no user named {args.seller}')
+    if args.command == 'export':
+        for chunk in export_listings(conn, args.format, seller_id):
+            sys.stdout.write(chunk)
+        conn.close()
+        return
+    conn.close()
+
+    stream = sys.stdin.buffer if args.rows == '-' else open(args.rows, 'rb')
+    archive = zipfile.ZipFile(args.images) if args.images else None
+    events = import_listings(
+        read_rows(stream, args.format or format_for(args.rows)), seller_id,
+        get_db_connection=app.get_db_connection, store_image=app.store_image_file,
+        make_variants=app.generate_image_variants, image_dir=app.image_dir, image_lock=app.image_lock,
+        archive=archive, workers=args.workers, posted_at=app.get_utc_now().strftime('%Y-%m-%d %H:%M:%S'),
+    )
+    for event in events:
+        if event['event'] == 'error':
+            print(f"line {event['line']}: {event['error']}", file=sys.stderr)
+        else:
+            print(f"{event['rows']} rows, {event['imported']} imported, {event['failed']} failed", file=sys.stderr)
+    app.image_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
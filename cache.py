@@ -0,0 +1,157 @@
+"""
+In-process caches for HawkSwap.
+
+TTLCache is a bounded, thread-safe LRU map whose entries also expire after a
+fixed number of seconds. Each process has its own copy, so anything cached
+here must either be safe to serve slightly stale for up to the TTL or be
+invalidated explicitly by the code that changes it.
+
+RedisCache has the same interface backed by a Redis-compatible server, for
+values worth sharing between app processes. It needs the redis package, which
+is only imported when one is configured.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from query_metrics import METRIC_PREFIX
+
+
+class TTLCache:
+    def __init__(self, name, maxsize=1024, ttl=60.0, clock=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_load(self, key, load):
+        """Cached value for key, or load() it and cache the result unless it is None."""
+        value = self.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return self.hits, self.misses, len(self._entries)
+
+
+class RedisCache:
+    """
+    TTLCache's interface on top of Redis. Values must be str. A Redis that is
+    down or slow counts as a miss rather than failing the request.
+    """
+
+    def __init__(self, name, url, ttl=60.0, timeout=0.05):
+        import redis
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._errors = redis.RedisError
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout, decode_responses=True)
+        self._prefix = f'hawkswap:{name}:'
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        try:
+            value = self._client.get(self._prefix + str(key))
+        except self._errors as e:
+            logging.getLogger(__name__).warning('Redis cache %s unavailable: %s', self.name, e)
+            value = None
+        self._count(value is not None)
+        return default if value is None else value
+
+    def set(self, key, value):
+        try:
+            self._client.set(self._prefix + str(key), value, ex=max(int(self.ttl), 1))
+        except self._errors:
+            pass
+
+    def invalidate(self, key):
+        try:
+            self._client.delete(self._prefix + str(key))
+        except self._errors:
+            pass
+
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return self.hits, self.misses, 0
+
+
+def create_cache(name, url=None, maxsize=1024, ttl=60.0):
+    """A RedisCache when url is given (redis://...), otherwise an in-process TTLCache."""
+    if url:
+        return RedisCache(name, url, ttl=ttl)
+    return TTLCache(name, maxsize=maxsize, ttl=ttl)
+
+
+def cache_metrics(*caches):
+    """Prometheus text lines describing the given caches, for QueryMetrics.add_collector()."""
+    stats = [(cache.name, *cache.stats()) for cache in caches]
+    lines = []
+
+    def family(name, kind, help_text, values):
+        lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+        for cache_name, value in values:
+            lines.append(f'{METRIC_PREFIX}_{name}{{cache="{cache_name}"}} {value}')
+
+    family('cache_hits_total', 'counter', 'Cache lookups answered from memory.',
+           [(name, hits) for name, hits, misses, size in stats])
+    family('cache_misses_total', 'counter', 'Cache lookups that had to load the value.',
+           [(name, misses) for name, hits, misses, size in stats])
+    family('cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits.',
+           [(name, '%.4f' % (hits / (hits + misses) if hits + misses else 0)) for name, hits, misses, size in stats])
+    family('cache_entries', 'gauge', 'Entries held in process memory (0 for Redis).',
+           [(name, size) for name, hits, misses, size in stats])
+    return lines
@@ -0,0 +1,288 @@
+"""
+WebSocket chat service for HawkSwap.
+
+An asyncio sidecar to app.py that keeps one WebSocket open per chat tab and
+pushes new messages and read receipts the moment they happen, instead of each
+tab holding a long-poll against the Flask app. An idle socket costs a little
+memory and no queries, so one process holds thousands of them.
+
+It shares the database, the login session and the chat helpers with app.py:
+
+    ws://<host>:<port>/chat/<chat_id>?after=<message_id>&read=<message_id>
+
+authenticates with the Flask session cookie, sends {"messages": [...],
+"read_upto": n} frames shaped like /get_messages responses, and accepts
+{"message": "..."} frames to send a message.
+
+Changes made anywhere are picked up in one of two ways:
+
+- with HAWKSWAP_PUBSUB_URL set (a Redis-compatible server), app.py and every
+  chat_ws process publish each chat change and every chat_ws process
+  subscribes, so any number of app and sidecar processes can run;
+- otherwise one batched query per second checks the chats this process has
+  sockets open for.
+
+    python chat_ws.py --origin https://hawkswap.example [--host 127.0.0.1] [--port 8765]
+
+Sockets are authenticated by the session cookie, which a browser sends
+whatever page opens the socket, so only pages from the --origin sites
+(or HAWKSWAP_CHAT_WS_ORIGINS, comma-separated) may connect. The service
+refuses to start without one.
+
+Needs the websockets package (14 or later), and redis for pub/sub.
+"""
+import argparse
+import asyncio
+import json
+import os
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs, urlsplit
+
+from sqlalchemy import bindparam, text
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+from app import (
+    CHAT_CHANNEL_PREFIX, MAX_MESSAGE_ID, app, db_session, db_write_session, fetch_new_messages, get_db_connection,
+    mark_chat_read, message_notifier, send_message,
+)
+
+# Seconds between checks of the chats table when there is no pub/sub server
+WATCH_INTERVAL = 1.0
+# Longest chat message accepted over a socket, in characters
+MAX_MESSAGE_LENGTH = 4000
+
+logger = app.logger
+
+
+def run_db(function, *args):
+    """Call a database helper on a worker thread's sessions, then release them."""
+    try:
+        return function(*args)
+    finally:
+        db_session.remove()
+        db_write_session.remove()
+
+
+def session_user_id(cookie_header):
+    """The logged-in user id in a Flask session cookie, or None."""
+    cookie = SimpleCookie()
+    try:
+        cookie.load(cookie_header or '')
+    except Exception:
+        return None
+    morsel = cookie.get(app.config['SESSION_COOKIE_NAME'])
+    serializer = app.session_interface.get_signing_serializer(app)
+    if morsel is None or serializer is None:
+        return None
+    try:
+        session = serializer.loads(morsel.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        return int(session['_user_id'])
+    except Exception:
+        return None
+
+
+def chat_participants(chat_id):
+    conn = get_db_connection()
+    chat = conn.execute('SELECT buyer_id, seller_id FROM chats WHERE chat_id = :chat_id', {'chat_id': chat_id}).fetchone()
+    conn.close()
+    return (chat['buyer_id'], chat['seller_id']) if chat else ()
+
+
+def read_updates(chat_id, after, user_id):
+    """New messages for the socket, marking the chat read if the other side sent any."""
+    conn = get_db_connection()
+    messages, read_upto = fetch_new_messages(conn, chat_id, after, user_id)
+    marked = False
+    if any(message['sender_id'] != user_id for message in messages):
+        marked = mark_chat_read(conn, chat_id, user_id)
+    conn.close()
+    return [dict(message) for message in messages], read_upto, marked
+
+
+def store_message(chat_id, user_id, content):
+    conn = get_db_connection(write=True)
+    sent = send_message(conn, chat_id, user_id, content)
+    if sent:
+        conn.commit()
+    conn.close()
+    return sent
+
+
+def chat_signatures(chat_ids):
+    """(latest message, unread counts) per chat: any new message or read changes it."""
+    conn = get_db_connection()
+    rows = conn.execute(
+        text('SELECT chat_id, last_message_id, buyer_unread, seller_unread FROM chats WHERE chat_id IN :ids')
+        .bindparams(bindparam('ids', expanding=True)),
+        {'ids': list(chat_ids)},
+    ).fetchall()
+    conn.close()
+    return {row['chat_id']: tuple(row[1:]) for row in rows}
+
+
+class ChatSocket:
+    """One open chat tab: who it is, and how much of the chat it has been sent."""
+
+    def __init__(self, connection, chat_id, user_id, after, read_upto):
+        self.connection = connection
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.after = after
+        self.read_upto = read_upto
+        self.lock = asyncio.Lock()
+
+    async def refresh(self, hub):
+        # One refresh at a time per socket, so frames go out in order
+        async with self.lock:
+            messages, read_upto, marked = await asyncio.to_thread(run_db, read_updates, self.chat_id, self.after, self.user_id)
+            if messages or read_upto != self.read_upto:
+                if messages:
+                    self.after = messages[-1]['message_id']
+                self.read_upto = read_upto
+                try:
+                    await self.connection.send(json.dumps({'messages': messages, 'read_upto': read_upto}, default=str))
+                except ConnectionClosed:
+                    pass
+        if marked:
+            hub.changed(self.chat_id)
+
+
+class ChatHub:
+    """Open sockets by chat id, and how they hear about changes."""
+
+    def __init__(self, pubsub_url=None):
+        self.pubsub_url = pubsub_url
+        self.sockets = {}
+        self._refreshes = set()
+
+    def add(self, socket):
+        self.sockets.setdefault(socket.chat_id, set()).add(socket)
+
+    def remove(self, socket):
+        sockets = self.sockets.get(socket.chat_id)
+        if sockets is not None:
+            sockets.discard(socket)
+            if not sockets:
+                del self.sockets[socket.chat_id]
+
+    def changed(self, chat_id, local=True):
+        """
+        Something in the chat changed. A change made by this process is also
+        announced to the others; with pub/sub the announcement comes back here
+        too, so it is not handled twice.
+        """
+        if local:
+            # notify() may publish to Redis, which blocks
+            asyncio.get_running_loop().run_in_executor(None, message_notifier.notify, chat_id)
+            if self.pubsub_url:
+                return
+        for socket in list(self.sockets.get(chat_id, ())):
+            task = asyncio.ensure_future(socket.refresh(self))
+            # The event loop only keeps weak references to tasks
+            self._refreshes.add(task)
+            task.add_done_callback(self._refreshes.discard)
+
+    async def watch(self):
+        if self.pubsub_url:
+            await self.subscribe()
+        else:
+            await self.poll()
+
+    async def subscribe(self):
+        import redis.asyncio as redis
+        client = redis.Redis.from_url(self.pubsub_url)
+        while True:
+            try:
+                pubsub = client.pubsub()
+                await pubsub.psubscribe(CHAT_CHANNEL_PREFIX + '*')
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.changed(int(message['channel'][len(CHAT_CHANNEL_PREFIX):]), local=False)
+            except redis.RedisError as e:
+                logger.warning('Chat pub/sub connection lost: %s', e)
+                await asyncio.sleep(WATCH_INTERVAL)
+
+    async def poll(self):
+        signatures = {}
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            chat_ids = set(self.sockets)
+            if not chat_ids:
+                signatures.clear()
+                continue
+            try:
+                current = await asyncio.to_thread(run_db, chat_signatures, chat_ids)
+            except Exception:
+                logger.exception('Checking chats for changes failed')
+                continue
+            # A chat seen for the first time counts as changed: something may
+            # have happened between its socket's first refresh and now
+            for chat_id, signature in current.items():
+                if signatures.get(chat_id) != signature:
+                    self.changed(chat_id, local=False)
+            signatures = current
+
+    async def handle(self, connection):
+        request = connection.request
+        url = urlsplit(request.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'chat' or not parts[1].isdigit():
+            await connection.close(4404, 'no such chat')
+            return
+        chat_id = int(parts[1])
+        user_id = session_user_id(request.headers.get('Cookie'))
+        if user_id is None:
+            await connection.close(4401, 'not logged in')
+            return
+        if user_id not in await asyncio.to_thread(run_db, chat_participants, chat_id):
+            await connection.close(4404, 'no such chat')
+            return
+        query = parse_qs(url.query)
+
+        def int_arg(name):
+            try:
+                return min(max(int(query.get(name, ['0'])[0]), 0), MAX_MESSAGE_ID)
+            except ValueError:
+                return 0
+
+        socket = ChatSocket(connection, chat_id, user_id, int_arg('after'), int_arg('read'))
+        self.add(socket)
+        try:
+            await socket.refresh(self)
+            async for frame in connection:
+                try:
+                    content = str(json.loads(frame)['message']).strip()
+                except (ValueError, TypeError, KeyError):
+                    continue
+                if content and len(content) <= MAX_MESSAGE_LENGTH:
+                    if await asyncio.to_thread(run_db, store_message, chat_id, user_id, content):
+                        self.changed(chat_id)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.remove(socket)
+
+
+async def main(host, port, origins):
+    hub = ChatHub(os.environ.get('HAWKSWAP_PUBSUB_URL'))
+    watcher = asyncio.ensure_future(hub.watch())
+    async with serve(hub.handle, host, port, origins=origins, ping_interval=30, max_size=16 * 1024):
+        logger.warning('Chat WebSocket service listening on ws://%s:%d', host, port)
+        await asyncio.Future()
+    watcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WebSocket chat service for HawkSwap.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--origin', action='append', dest='origins',
+                        help='allowed Origin of the pages connecting, e.g. https://hawkswap.example (repeatable; '
+                             'default: $HAWKSWAP_CHAT_WS_ORIGINS, comma-separated)')
+    args = parser.parse_args()
+    if not args.origins:
+        args.origins = [origin.strip() for origin in os.environ.get('HAWKSWAP_CHAT_WS_ORIGINS', '').split(',') if origin.strip()]
+    if not args.origins:
+        parser.error('give the site the chat pages are served from with --origin (or HAWKSWAP_CHAT_WS_ORIGINS)')
+    asyncio.run(main(args.host, args.port, args.origins))
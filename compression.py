@@ -0,0 +1,139 @@
+"""
+Compression of dynamic responses for HawkSwap.
+
+Compression hooks the app's responses and, when the client accepts it,
+encodes text bodies (HTML, JSON, CSS, CSV, JSON Lines...) with Brotli or
+gzip. Bodies under COMPRESS_MIN_SIZE bytes are sent as they are, since the
+saving would not pay for the work. Streamed responses (the bulk import and
+export) are compressed chunk by chunk, with a flush after each chunk so
+progress still reaches the client as it happens.
+
+Brotli needs the brotli package; without it only gzip is offered. Static
+files are left alone here: assets.py serves those precompressed.
+"""
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'application/x-ndjson', 'application/xml', 'image/svg+xml',
+}
+
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES)
+
+
+def available_encodings(gzip_level, brotli_quality):
+    """Encodings this process can produce, most preferred first, with their compressor factories."""
+    encodings = []
+    if brotli is not None:
+        encodings.append(('br', lambda: BrotliStream(brotli_quality)))
+    encodings.append(('gzip', lambda: GzipStream(gzip_level)))
+    return encodings
+
+
+class GzipStream:
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class Compression:
+    """
+    Compresses responses in an after_request hook.
+
+    Config keys read from the app:
+    COMPRESS_MIN_SIZE        smallest body, in bytes, worth compressing (500)
+    COMPRESS_GZIP_LEVEL      zlib level for gzip (6)
+    COMPRESS_BROTLI_QUALITY  Brotli quality; 4 is about as fast as gzip 6 and smaller (4)
+
+    Register it before any hook that sets an ETag, so that hook runs first and
+    answers 304s before anything is compressed: Flask runs after_request hooks
+    in reverse order of registration.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.encodings = available_encodings(app.config['COMPRESS_GZIP_LEVEL'], app.config['COMPRESS_BROTLI_QUALITY'])
+        app.after_request(self._compress_response)
+
+    def choose_encoding(self):
+        """The encoding to use for this request and a factory for its compressor, or (None, None)."""
+        accepted = request.accept_encodings
+        best = (None, None)
+        best_quality = 0
+        for name, factory in self.encodings:
+            quality = accepted[name]
+            if quality > best_quality:
+                best, best_quality = (name, factory), quality
+        return best
+
+    def _compress_response(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or not is_compressible(response.mimetype) or request.method == 'HEAD'):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding, factory = self.choose_encoding()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = self._stream(response.response, factory())
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = factory()
+            response.set_data(compressor.compress(data) + compressor.finish())
+        response.headers['Content-Encoding'] = encoding
+        # The body now differs byte for byte from the one the ETag was taken
+        # of; a weak ETag still lets If-None-Match revalidate it
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    @staticmethod
+    def _stream(chunks, compressor):
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                if chunk:
+                    yield compressor.compress(chunk)
+            yield compressor.finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
@@ -1,9 +1,27 @@
+import argparse
+import itertools
 import sqlite3
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from queries import (
+    BROWSE_SORTS, DELETE_LISTING_MESSAGES_SQL, DELETE_LISTING_SAVES_SQL, DELETE_SIMILAR_TO_LISTING_SQL,
+    IMAGE_KEY_IN_USE_SQL, IMAGE_PATH_IN_USE_SQL, INBOX_KEYSET, INBOX_SQL, LISTING_DETAIL_SQL, MARK_CHAT_READ_SQL,
+    NEW_MESSAGES_SQL, READ_UPTO_SQL, SAVED_LISTING_IDS_SQL, SAVED_LISTINGS_SQL, SEARCH_SQL, SIMILAR_LISTINGS_SQL,
+    SOLD_LISTINGS_SQL, STALE_CHATS_SQL, USER_SQL, browse_query, feed_query, profile_query,
+)
+from schema import create_postgres_search_index, metadata
+from storage import database_settings
 
 DATABASE = 'marketplace.db'
 
 def create_tables(conn):
     cursor = conn.cursor()
+    # Lets maintenance.py hand free pages back a few at a time. Only takes
+    # effect on a new, empty database; see maintenance.py for older ones.
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -64,7 +82,383 @@ def create_tables(conn):
 
     conn.commit()
 
+def create_search_index(cursor):
+    """
+    Full-text index over listing name and description. The triggers keep it in
+    sync with every INSERT, UPDATE and DELETE on listings, so the routes never
+    have to touch it directly.
+    """
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+            name,
+            description,
+            content='listings',
+            content_rowid='id',
+            tokenize='porter unicode61'
+        );
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+            INSERT INTO listings_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+            INSERT INTO listings_fts (listings_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF name, description ON listings BEGIN
+            INSERT INTO listings_fts (listings_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO listings_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END;
+    """)
+    # Index listings that were created before the search index existed
+    cursor.execute("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')")
+
+def add_access_path_indexes(cursor):
+    """
+    Secondary indexes for the lookups every route makes, and a UNIQUE constraint
+    on saves so a listing can only be saved once per user.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_feed ON listings (is_sold, dateposted, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_seller ON listings (seller_id, is_sold, dateposted, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_buyer ON chats (buyer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_seller ON chats (seller_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_listing ON chats (listing_id, seller_id, buyer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, sent_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages (chat_id, read_status, sender_id)")
+    # Drop duplicate saves (keeping the first) before enforcing uniqueness
+    cursor.execute("""
+        DELETE FROM saves WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM saves GROUP BY user_id, listing_id
+        )
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_saves_user_listing ON saves (user_id, listing_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_saves_user_saved_at ON saves (user_id, saved_at)")
+
+def index_messages_by_id(cursor):
+    """Chat history is read in message_id order, which also breaks sent_at ties."""
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_chat")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, message_id)")
+
+def add_unread_counters(cursor):
+    """Per-user count of unread messages, maintained by the app on send and read."""
+    cursor.execute("ALTER TABLE users ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0")
+    backfill_unread_counts_by_status(cursor)
+
+def backfill_unread_counts_by_status(cursor):
+    """Migration 4's backfill, from the read_status flags that migration 9 replaced."""
+    cursor.execute("""
+        UPDATE users SET unread_count = (
+            SELECT COUNT(*)
+            FROM messages m
+            JOIN chats c ON m.chat_id = c.chat_id
+            WHERE (c.buyer_id = users.id OR c.seller_id = users.id)
+            AND m.read_status = FALSE AND m.sender_id != users.id
+        )
+    """)
+
+def add_chat_activity(cursor):
+    """
+    Denormalized per-chat state for the inbox: the latest message, when it was
+    sent, and each participant's unread count. Maintained by the app on send and
+    read; backfill_chat_activity() recomputes it.
+    """
+    cursor.execute("ALTER TABLE chats ADD COLUMN last_message_id INTEGER REFERENCES messages(message_id)")
+    cursor.execute("ALTER TABLE chats ADD COLUMN last_activity DATETIME")
+    cursor.execute("ALTER TABLE chats ADD COLUMN buyer_unread INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE chats ADD COLUMN seller_unread INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("DROP INDEX IF EXISTS idx_chats_buyer")
+    cursor.execute("DROP INDEX IF EXISTS idx_chats_seller")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_buyer_activity ON chats (buyer_id, last_activity, chat_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_seller_activity ON chats (seller_id, last_activity, chat_id)")
+    backfill_chat_activity_by_status(cursor)
+
+def backfill_chat_activity_by_status(cursor):
+    """Migration 5's backfill, from the read_status flags that migration 9 replaced."""
+    cursor.execute("""
+        UPDATE chats SET last_message_id = (
+            SELECT MAX(message_id) FROM messages WHERE chat_id = chats.chat_id
+        )
+    """)
+    cursor.execute("""
+        UPDATE chats SET
+            last_activity = COALESCE((SELECT sent_at FROM messages WHERE message_id = chats.last_message_id), created_at),
+            buyer_unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = chats.chat_id AND read_status = FALSE AND sender_id != chats.buyer_id
+            ),
+            seller_unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = chats.chat_id AND read_status = FALSE AND sender_id != chats.seller_id
+            )
+    """)
+
+def backfill_chat_activity(cursor):
+    """Recompute every chat's latest message pointer, and its unread counts from the read watermarks."""
+    cursor.execute("""
+        UPDATE chats SET last_message_id = (
+            SELECT MAX(message_id) FROM messages WHERE chat_id = chats.chat_id
+        )
+    """)
+    cursor.execute("""
+        UPDATE chats SET
+            last_activity = COALESCE((SELECT sent_at FROM messages WHERE message_id = chats.last_message_id), created_at),
+            buyer_unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = chats.chat_id AND message_id > chats.buyer_last_read AND sender_id != chats.buyer_id
+            ),
+            seller_unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = chats.chat_id AND message_id > chats.seller_last_read AND sender_id != chats.seller_id
+            )
+    """)
+
+def backfill_unread_counts(cursor):
+    """Recompute every user's unread counter from the per-chat counts."""
+    cursor.execute("""
+        UPDATE users SET unread_count =
+            COALESCE((SELECT SUM(buyer_unread) FROM chats WHERE buyer_id = users.id), 0)
+            + COALESCE((SELECT SUM(seller_unread) FROM chats WHERE seller_id = users.id), 0)
+    """)
+
+def backfill(conn):
+    """Rebuild all denormalized counters and pointers, e.g. after editing the database by hand."""
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    backfill_chat_activity(cursor)
+    backfill_unread_counts(cursor)
+    cursor.execute('COMMIT')
+
+def add_image_key(cursor):
+    """
+    Key of the listing's generated image variants (static/uploads/ab/cd/<key>/<size>.jpg).
+    NULL while an upload is still being processed, and for older listings.
+    """
+    cursor.execute("ALTER TABLE listings ADD COLUMN image_key TEXT")
+
+def add_listing_version(cursor):
+    """
+    Counter bumped by every change to a listing that alters how it renders.
+    Cached listing fragments are keyed by (id, version).
+    """
+    cursor.execute("ALTER TABLE listings ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+def add_maintenance_indexes(cursor):
+    """
+    Lookups made when listings are deleted and by maintenance.py: saves by
+    listing, listings by image key, and chats by last activity.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_saves_listing ON saves (listing_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_image_key ON listings (image_key)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_activity ON chats (last_activity)")
+
+def add_read_watermarks(cursor):
+    """
+    Read state as a per-participant watermark on the chat, the id of the last
+    message each side has read, instead of a flag on every message. Marking a
+    chat read becomes one conditional row update; unread counts are the other
+    side's messages past the watermark.
+    """
+    cursor.execute("ALTER TABLE chats ADD COLUMN buyer_last_read INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE chats ADD COLUMN seller_last_read INTEGER NOT NULL DEFAULT 0")
+    # Caught up: everything so far. Otherwise: the latest message marked read.
+    for side in ('buyer', 'seller'):
+        cursor.execute(f"""
+            UPDATE chats SET {side}_last_read = CASE WHEN {side}_unread = 0 THEN COALESCE(last_message_id, 0) ELSE COALESCE((
+                SELECT MAX(message_id) FROM messages
+                WHERE chat_id = chats.chat_id AND read_status = TRUE AND sender_id != chats.{side}_id
+            ), 0) END
+        """)
+    backfill_chat_activity(cursor)
+    backfill_unread_counts(cursor)
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_unread")
+    cursor.execute("ALTER TABLE messages DROP COLUMN read_status")
+
+def add_price_indexes(cursor):
+    """Listings by sold state and price, overall and per seller, for /browse sorted by price."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_price ON listings (is_sold, price, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_seller_price ON listings (seller_id, is_sold, price, id)")
+
+def add_similar_listings(cursor):
+    """
+    The precomputed nearest neighbours of each listing, best first (see
+    similar.py), so the listing page reads them with one key lookup.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS similar_listings (
+            listing_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            similar_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (listing_id, rank)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_similar_listings_similar ON similar_listings (similar_id)")
+
+def add_sold_at(cursor):
+    """
+    When each listing was marked sold, which is what sold-listing retention in
+    maintenance.py counts from. Listings already sold start their clock now.
+    """
+    cursor.execute("ALTER TABLE listings ADD COLUMN sold_at TEXT")
+    cursor.execute("UPDATE listings SET sold_at = strftime('%Y-%m-%d %H:%M:%S', 'now') WHERE is_sold = TRUE")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_sold ON listings (is_sold, sold_at, id)")
+
+def order_seller_index_newest_first(cursor):
+    """
+    A seller's listings in the order their profile pages them: unsold first,
+    each newest first. ORDER BY is_sold ASC, dateposted DESC can't be read off
+    the all-ascending idx_listings_seller in one direction, so every profile
+    page sorted the seller's listings in a temp b-tree.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_seller_newest ON listings (seller_id, is_sold, dateposted DESC, id DESC)")
+    cursor.execute("DROP INDEX IF EXISTS idx_listings_seller")
+
+def add_image_path_index(cursor):
+    """
+    Listings by image path. Before removing an image directory, maintenance.py
+    checks that no listing still shows one of its originals, which scanned
+    every listing once per original.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_listings_image_path ON listings (image_path)")
+
+# Schema changes applied on top of create_tables(), in order. The database's
+# PRAGMA user_version records the last one applied, so running this script
+# again upgrades an existing marketplace.db in place. Never edit or reorder an
+# entry once it has shipped; append a new one instead.
+MIGRATIONS = [
+    (1, 'full-text search index on listings', create_search_index),
+    (2, 'indexes for route access paths, unique saves', add_access_path_indexes),
+    (3, 'index messages by (chat_id, message_id)', index_messages_by_id),
+    (4, 'per-user unread message counters', add_unread_counters),
+    (5, 'latest message pointer and unread counts on chats', add_chat_activity),
+    (6, 'image variant key on listings', add_image_key),
+    (7, 'render version on listings', add_listing_version),
+    (8, 'indexes for listing deletes and maintenance', add_maintenance_indexes),
+    (9, 'per-participant read watermarks on chats', add_read_watermarks),
+    (10, 'price indexes on listings', add_price_indexes),
+    (11, 'precomputed similar listings', add_similar_listings),
+    (12, 'sold time on listings', add_sold_at),
+    (13, 'seller index in profile order', order_seller_index_newest_first),
+    (14, 'image path index on listings', add_image_path_index),
+]
+
+def migrate(conn):
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f'Applying migration {version}: {description}')
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            apply(cursor)
+            cursor.execute(f'PRAGMA user_version = {version:d}')
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+
+def page(query, limit=25):
+    """A keyset-paginated route query from queries.py, with its page size."""
+    sql, params = query
+    return sql, dict(params, limit=limit), True
+
+def browse_route_queries():
+    """Every /browse sort with every combination of the seller, price and date filters."""
+    for sort, (column, *_) in BROWSE_SORTS.items():
+        for seller_id, prices, since in itertools.product((None, 1), (False, True), (False, True)):
+            filters = {'sort': sort, 'sold': False, 'min_price': 10 if prices else None,
+                       'max_price': 50 if prices else None, 'since': '2024-01-01' if since else None}
+            name = 'browse.' + sort + '+seller' * (seller_id is not None) + '+price' * prices + '+since' * since
+            yield name, page(browse_query(filters, seller_id, ('9999' if column == 'dateposted' else 0, 0)))
+
+# The queries the routes run on every hit, as (sql, params, paginated), checked
+# with EXPLAIN QUERY PLAN. The SQL is the routes' own, from queries.py.
+ROUTE_QUERIES = {
+    'index': page(feed_query(('9999', 0))),
+    'show_user_profile': page(profile_query(1, (False, '9999', 0))),
+    'search': (SEARCH_SQL['sqlite'], {'query': '"chair"*', 'limit': 25, 'offset': 0}, False),
+    'show_listing': (LISTING_DETAIL_SQL, {'id': 1, 'user_id': 2}, False),
+    'show_listing.similar': (SIMILAR_LISTINGS_SQL, {'id': 1, 'limit': 6}, False),
+    'saved_listings': (SAVED_LISTINGS_SQL, {'user_id': 1}, False),
+    'get_messages': (NEW_MESSAGES_SQL, {'chat_id': 1, 'after': 0}, True),
+    'get_messages.read_upto': (READ_UPTO_SQL, {'chat_id': 1, 'user_id': 1}, False),
+    'mark_chat_read': (MARK_CHAT_READ_SQL.format(last_read='buyer_last_read', unread='buyer_unread'), {'chat_id': 1}, False),
+    'delete_listing.messages': (DELETE_LISTING_MESSAGES_SQL, {'id': 1}, False),
+    'delete_listing.saves': (DELETE_LISTING_SAVES_SQL, {'id': 1}, False),
+    'delete_listing.similar': (DELETE_SIMILAR_TO_LISTING_SQL, {'id': 1}, False),
+    'inbox': page((INBOX_SQL.format(keyset=INBOX_KEYSET), {'user_id': 1, 'last_activity': '9999', 'chat_id': 0}), 31),
+    **dict(browse_route_queries()),
+    'maintenance.sold_listings': page((SOLD_LISTINGS_SQL, {'cutoff': '2024-01-01', 'sold_at': '0001', 'id': 0}), 100),
+    'maintenance.stale_chats': page((STALE_CHATS_SQL, {'cutoff': '2024-01-01', 'last_activity': '0001', 'chat_id': 0}), 100),
+    'maintenance.saves': page((SAVED_LISTING_IDS_SQL, {'after': 0}), 1000),
+    'maintenance.image_key': (IMAGE_KEY_IN_USE_SQL, {'key': '0' * 64}, False),
+    'maintenance.image_path': (IMAGE_PATH_IN_USE_SQL, {'path': 'uploads/00/00/original.jpg'}, False),
+    'unread_message_count': (USER_SQL, {'id': 1}, False),
+}
+
+def plan_problems(conn, sql, params, paginated=False):
+    """
+    Return the EXPLAIN QUERY PLAN steps that read a whole table and, for a
+    paginated query, those that sort the rows instead of reading them off an
+    index in order (each page would sort every match).
+    """
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    return [row[3] for row in plan
+            if row[3].startswith('SCAN ') and 'VIRTUAL TABLE' not in row[3]
+            or paginated and row[3].startswith('USE TEMP B-TREE')]
+
+def check_query_plans(conn):
+    """Fail if any route query falls back to a full table scan, or a paginated one to a sort."""
+    failures = {name: problems for name, (sql, params, paginated) in ROUTE_QUERIES.items()
+                if (problems := plan_problems(conn, sql, params, paginated))}
+    for name, problems in failures.items():
+        print(f'{name}: {"; ".join(problems)}')
+    return not failures
+
+def create_database(url):
+    """
+    Create the schema on a non-SQLite database (PostgreSQL) from schema.py.
+    Tables and indexes that already exist are left alone.
+    """
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        metadata.create_all(connection)
+        if engine.dialect.name == 'postgresql':
+            create_postgres_search_index(connection)
+    return engine
+
+def backfill_database(engine):
+    with engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        backfill_chat_activity(cursor)
+        backfill_unread_counts(cursor)
+
 if __name__ == '__main__':
-    conn = sqlite3.connect(DATABASE)
+    parser = argparse.ArgumentParser(description='Create or upgrade the HawkSwap database.')
+    parser.add_argument('--database-url', default=database_settings()['uri'],
+                        help='SQLAlchemy URL of the database (default: $HAWKSWAP_DATABASE_URI or sqlite:///marketplace.db)')
+    parser.add_argument('--backfill', action='store_true', help='recompute denormalized counters and pointers')
+    parser.add_argument('--check-plans', action='store_true', help='fail if a route query does a full table scan, or a paginated one a sort (SQLite only)')
+    args = parser.parse_args()
+    url = make_url(args.database_url)
+    if url.get_backend_name() != 'sqlite':
+        engine = create_database(url)
+        if args.backfill:
+            backfill_database(engine)
+        if args.check_plans:
+            sys.exit('--check-plans only supports SQLite')
+        sys.exit(0)
+    conn = sqlite3.connect(url.database or DATABASE, isolation_level=None)
     create_tables(conn)
+    migrate(conn)
+    if args.backfill:
+        backfill(conn)
+    if args.check_plans:
+        ok = check_query_plans(conn)
+        conn.close()
+        sys.exit(0 if ok else 1)
     conn.close()
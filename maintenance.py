@@ -0,0 +1,351 @@
+"""
+Background maintenance for HawkSwap: retention, orphan cleanup and compaction.
+
+Each run works through these steps, oldest first, until --max-seconds is up:
+
+- listings sold more than --sold-days ago, with their chats, messages and saves,
+  are written to gzip-compressed JSON Lines files under HAWKSWAP_ARCHIVE_DIR
+  (archive/) and then deleted;
+- chats with no activity for --chat-days are archived the same way;
+- saves of listings that no longer exist are deleted;
+- image directories no listing uses any more, and abandoned upload temp
+  files, are removed once they have been left alone for an hour;
+- on SQLite, free pages are handed back to the filesystem with
+  incremental_vacuum a few at a time, and PRAGMA optimize refreshes the
+  planner statistics. PostgreSQL's autovacuum does both there.
+
+Work happens in small batches, each its own short transaction with a pause
+after it, so the app's writers are never kept waiting for long. Rows are
+only deleted once their archive record is on disk; a record can appear
+twice if its rows changed while it was being archived. Read the archives
+with zcat archive/*.jsonl.gz.
+
+    python maintenance.py [--sold-days 180] [--chat-days 365] [--max-seconds 60] [--every 3600]
+
+Run it from cron, or with --every as a long-running process. Databases
+created before auto_vacuum was enabled need a one-off full VACUUM, which
+blocks writers while it runs, before incremental vacuuming can free space:
+
+    python maintenance.py --convert-vacuum
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import time
+
+from sqlalchemy import bindparam, text
+
+from app import (
+    app, begin_write, db_session, db_write_session, delete_chat_rows, delete_listing_rows, fragment_cache,
+    get_db_connection, get_utc_now, image_dir, listing_card_key, UPLOAD_TEMP_PREFIX, write_engine,
+)
+from queries import (
+    IMAGE_KEY_IN_USE_SQL, IMAGE_PATH_IN_USE_SQL, SAVED_LISTING_IDS_SQL, SOLD_LISTINGS_SQL, STALE_CHATS_SQL,
+)
+
+SOLD_RETENTION_DAYS = 180
+CHAT_RETENTION_DAYS = 365
+# Listings or chats archived per transaction
+BATCH_SIZE = 100
+# Distinct saved listings checked per query when looking for orphaned saves
+SAVES_CHUNK_SIZE = 1000
+# Seconds to sleep after each write transaction, so request writers get in
+PAUSE = 0.05
+# Pages freed per incremental_vacuum step
+VACUUM_STEP_PAGES = 256
+# Seconds an unused image directory or upload temp file is left before removal
+IMAGE_GRACE_SECONDS = 60 * 60
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# Keyset start: before any real timestamp
+EPOCH = '0001-01-01 00:00:00'
+
+
+def in_ids(sql, *names):
+    """A text() statement whose named parameters each take a list of values."""
+    return text(sql).bindparams(*(bindparam(name, expanding=True) for name in names))
+
+
+def append_archive(archive_dir, kind, records):
+    """Append records as JSON Lines to this month's archive of `kind` and flush them to disk."""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f'{kind}-{datetime.date.today():%Y-%m}.jsonl.gz')
+    # Every append is a gzip member of its own; gzip and zcat read them as one stream
+    with open(path, 'ab') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as archive:
+            for record in records:
+                archive.write((json.dumps(record, default=str) + '\n').encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def chat_records(conn, chats):
+    """{"chat": ..., "messages": [...]} for each chat row."""
+    if not chats:
+        return []
+    messages = {}
+    rows = conn.execute(
+        in_ids('SELECT * FROM messages WHERE chat_id IN :ids ORDER BY chat_id, message_id', 'ids'),
+        {'ids': [chat['chat_id'] for chat in chats]},
+    ).fetchall()
+    for row in rows:
+        messages.setdefault(row['chat_id'], []).append(dict(row))
+    return [{'chat': dict(chat), 'messages': messages.get(chat['chat_id'], [])} for chat in chats]
+
+
+def listing_signatures(conn, listing_ids):
+    """Each sold listing's sale time, chats and their latest messages: if this changes, archive it again."""
+    rows = conn.execute(in_ids("""
+        SELECT l.id, l.sold_at, c.chat_id, c.last_message_id FROM listings l LEFT JOIN chats c ON c.listing_id = l.id
+        WHERE l.id IN :ids AND l.is_sold = TRUE
+    """, 'ids'), {'ids': listing_ids}).fetchall()
+    signatures = {}
+    for row in rows:
+        signatures.setdefault(row['id'], set()).add((row['sold_at'], row['chat_id'], row['last_message_id']))
+    return signatures
+
+
+def archive_sold_listings(archive_dir, cutoff, deadline):
+    """Archive and delete listings sold before cutoff. Returns how many were archived."""
+    archived = 0
+    after = (EPOCH, 0)
+    while time.monotonic() < deadline:
+        conn = get_db_connection()
+        listings = conn.execute(SOLD_LISTINGS_SQL, {'cutoff': cutoff, 'sold_at': after[0], 'id': after[1], 'limit': BATCH_SIZE}).fetchall()
+        if not listings:
+            conn.close()
+            break
+        after = (listings[-1]['sold_at'], listings[-1]['id'])
+        listing_ids = [listing['id'] for listing in listings]
+        chats = conn.execute(in_ids('SELECT * FROM chats WHERE listing_id IN :ids ORDER BY chat_id', 'ids'),
+                             {'ids': listing_ids}).fetchall()
+        saves = conn.execute(in_ids('SELECT * FROM saves WHERE listing_id IN :ids', 'ids'), {'ids': listing_ids}).fetchall()
+        signatures = listing_signatures(conn, listing_ids)
+        records = {listing['id']: {'listing': dict(listing), 'chats': [], 'saves': []} for listing in listings}
+        for record in chat_records(conn, chats):
+            records[record['chat']['listing_id']]['chats'].append(record)
+        for save in saves:
+            records[save['listing_id']]['saves'].append(dict(save))
+        conn.close()
+        append_archive(archive_dir, 'listings', records.values())
+
+        conn = get_db_connection(write=True)
+        begin_write(conn)
+        current = listing_signatures(conn, listing_ids)
+        unchanged = [listing for listing in listings if listing['id'] in current and current[listing['id']] == signatures.get(listing['id'])]
+        for listing in unchanged:
+            delete_listing_rows(conn, listing['id'])
+        conn.commit()
+        conn.close()
+        for listing in unchanged:
+            fragment_cache.invalidate(listing_card_key(listing))
+        archived += len(unchanged)
+        time.sleep(PAUSE)
+    return archived
+
+
+def archive_stale_chats(archive_dir, cutoff, deadline):
+    """Archive and delete chats with no activity since cutoff. Returns how many were archived."""
+    archived = 0
+    after = (EPOCH, 0)
+    while time.monotonic() < deadline:
+        conn = get_db_connection()
+        chats = conn.execute(STALE_CHATS_SQL, {'cutoff': cutoff, 'last_activity': after[0], 'chat_id': after[1], 'limit': BATCH_SIZE}).fetchall()
+        if not chats:
+            conn.close()
+            break
+        after = (chats[-1]['last_activity'], chats[-1]['chat_id'])
+        records = chat_records(conn, chats)
+        conn.close()
+        append_archive(archive_dir, 'chats', records)
+
+        conn = get_db_connection(write=True)
+        begin_write(conn)
+        # Only chats nobody has written in since they were read
+        unchanged = conn.execute(in_ids("""
+            SELECT chat_id FROM chats WHERE chat_id IN :ids AND last_activity < :cutoff
+        """, 'ids'), {'ids': [chat['chat_id'] for chat in chats], 'cutoff': cutoff}).fetchall()
+        for row in unchanged:
+            delete_chat_rows(conn, row['chat_id'])
+        conn.commit()
+        conn.close()
+        archived += len(unchanged)
+        time.sleep(PAUSE)
+    return archived
+
+
+def delete_orphan_saves(deadline):
+    """Delete saves whose listing is gone. Returns how many listings' saves were deleted."""
+    deleted = 0
+    after = 0
+    while time.monotonic() < deadline:
+        conn = get_db_connection()
+        saved = [row[0] for row in conn.execute(SAVED_LISTING_IDS_SQL, {'after': after, 'limit': SAVES_CHUNK_SIZE}).fetchall()]
+        if not saved:
+            conn.close()
+            break
+        after = saved[-1]
+        existing = {row[0] for row in conn.execute(in_ids('SELECT id FROM listings WHERE id IN :ids', 'ids'), {'ids': saved})}
+        conn.close()
+        orphans = [listing_id for listing_id in saved if listing_id not in existing]
+        if orphans:
+            conn = get_db_connection(write=True)
+            begin_write(conn)
+            # A listing id is never reused, so one that is gone stays gone
+            conn.execute(in_ids('DELETE FROM saves WHERE listing_id IN :ids', 'ids'), {'ids': orphans})
+            conn.commit()
+            conn.close()
+            deleted += len(orphans)
+            time.sleep(PAUSE)
+    return deleted
+
+
+def image_in_use(conn, key, directory):
+    if conn.execute(IMAGE_KEY_IN_USE_SQL, {'key': key}).fetchone():
+        return True
+    # A listing whose variants aren't built yet (or failed) still shows the original
+    for name in os.listdir(directory):
+        if name.startswith('original.'):
+            path = os.path.join(image_dir(key), name)
+            if conn.execute(IMAGE_PATH_IN_USE_SQL, {'path': path}).fetchone():
+                return True
+    return False
+
+
+def remove_orphan_images(deadline):
+    """
+    Remove content-addressed image directories that no listing uses and upload
+    temp files that were never claimed, once untouched for IMAGE_GRACE_SECONDS.
+    Starts at a random shard so runs cut short by the deadline still get
+    round the whole tree. Returns how many directories and files were removed.
+    """
+    root = os.path.join('static', app.config['UPLOADED_IMAGES_DEST'])
+    if not os.path.isdir(root):
+        return 0
+    stale = time.time() - IMAGE_GRACE_SECONDS
+    removed = 0
+    shards = sorted(entry.name for entry in os.scandir(root) if entry.is_dir() and len(entry.name) == 2)
+    for entry in os.scandir(root):
+        # Only save_upload()'s own temp files: other loose files may be older uploads still in use
+        if entry.is_file() and entry.name.startswith(UPLOAD_TEMP_PREFIX) and entry.stat().st_mtime < stale:
+            os.remove(entry.path)
+            removed += 1
+    if shards:
+        start = random.randrange(len(shards))
+        shards = shards[start:] + shards[:start]
+    conn = get_db_connection()
+    try:
+        for shard in shards:
+            for middle in sorted(os.listdir(os.path.join(root, shard))):
+                for key in os.listdir(os.path.join(root, shard, middle)):
+                    if time.monotonic() >= deadline:
+                        return removed
+                    directory = os.path.join(root, shard, middle, key)
+                    if not KEY_PATTERN.match(key) or os.stat(directory).st_mtime >= stale:
+                        continue
+                    if not image_in_use(conn, key, directory):
+                        shutil.rmtree(directory, ignore_errors=True)
+                        removed += 1
+                try:
+                    os.rmdir(os.path.join(root, shard, middle))
+                except OSError:
+                    pass  # not empty
+    finally:
+        conn.close()
+    return removed
+
+
+def compact(deadline):
+    """
+    SQLite only: free pages with incremental_vacuum, a step at a time, then
+    checkpoint the WAL and refresh the planner statistics. Returns the number
+    of pages freed.
+    """
+    if write_engine.dialect.name != 'sqlite':
+        return 0
+    # The raw connection: incremental_vacuum frees one page per row it steps
+    # through, and only executescript() steps a statement to the end
+    connection = write_engine.raw_connection()
+    freed = 0
+    try:
+        if connection.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            while time.monotonic() < deadline:
+                free = connection.execute('PRAGMA freelist_count').fetchone()[0]
+                if not free:
+                    break
+                connection.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES:d})')
+                freed += min(free, VACUUM_STEP_PAGES)
+                time.sleep(PAUSE)
+            connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+        else:
+            app.logger.warning('auto_vacuum is off for this database; run maintenance.py --convert-vacuum once to enable it')
+        connection.executescript('PRAGMA analysis_limit = 400; PRAGMA optimize;')
+    finally:
+        connection.close()
+    return freed
+
+
+def convert_vacuum():
+    """Switch an existing SQLite database to incremental auto_vacuum. Rewrites the whole file."""
+    connection = write_engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+    finally:
+        connection.close()
+
+
+def run(archive_dir, sold_days=SOLD_RETENTION_DAYS, chat_days=CHAT_RETENTION_DAYS, max_seconds=60):
+    """One maintenance pass. Returns what each step did."""
+    deadline = time.monotonic() + max_seconds
+    now = get_utc_now()
+
+    def cutoff(days):
+        return (now - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    try:
+        return {
+            'archived_listings': archive_sold_listings(archive_dir, cutoff(sold_days), deadline),
+            'archived_chats': archive_stale_chats(archive_dir, cutoff(chat_days), deadline),
+            'orphaned_saves': delete_orphan_saves(deadline),
+            'orphaned_images': remove_orphan_images(deadline),
+            # Always leave compaction a little time, even when the rest used it all
+            'vacuumed_pages': compact(max(deadline, time.monotonic() + 1)),
+        }
+    finally:
+        db_session.remove()
+        db_write_session.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old data, clean up orphans and compact the HawkSwap database.')
+    parser.add_argument('--sold-days', type=int, default=SOLD_RETENTION_DAYS, help='archive listings sold this many days ago')
+    parser.add_argument('--chat-days', type=int, default=CHAT_RETENTION_DAYS, help='archive chats idle this many days')
+    parser.add_argument('--max-seconds', type=float, default=60, help='time budget for one run')
+    parser.add_argument('--every', type=float, help='keep running, starting a run every this many seconds')
+    parser.add_argument('--archive-dir', default=os.environ.get('HAWKSWAP_ARCHIVE_DIR', 'archive'))
+    parser.add_argument('--convert-vacuum', action='store_true', help='enable incremental auto_vacuum with a full VACUUM, then exit')
+    args = parser.parse_args()
+
+    if args.convert_vacuum:
+        if write_engine.dialect.name != 'sqlite':
+            sys.exit('--convert-vacuum only applies to SQLite')
+        convert_vacuum()
+        return
+    while True:
+        started = time.monotonic()
+        results = run(args.archive_dir, args.sold_days, args.chat_days, args.max_seconds)
+        print(', '.join(f'{count} {name.replace("_", " ")}' for name, count in results.items()), file=sys.stderr)
+        if args.every is None:
+            return
+        time.sleep(max(args.every - (time.monotonic() - started), 0))
+
+
+if __name__ == '__main__':
+    main()
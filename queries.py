@@ -0,0 +1,275 @@
+"""
+Shared row lookups for HawkSwap routes.
+
+Each function takes the session to run on and returns the row (or None).
+Rows are kept in a per-request identity cache on flask.g, so a user or
+listing fetched once (by load_user, a route and the header's context
+processor, say) costs one query per request, not one per caller. The cache is
+dropped whenever the write session commits, so nothing stale is served after
+a change.
+
+The SQL of the routes' hot queries lives here too, as constants or as
+functions that build a query and its parameters. init_db.ROUTE_QUERIES runs
+EXPLAIN QUERY PLAN over these same strings (python3 init_db.py --check-plans),
+so the plan check can't drift from what the routes run.
+"""
+import datetime
+
+from flask import g, has_request_context
+
+from schema import POSTGRES_SEARCH_DOCUMENT
+
+# Columns of the seller joined onto a listing by the *_with_seller lookups
+SELLER_COLUMNS = 'u.username AS seller_username, u.name_first AS seller_name_first'
+# Only the columns single-listing.html actually renders
+LISTING_CARD_COLUMNS = 'id, name, price, image_path, image_key, dateposted, is_sold, version'
+
+USER_SQL = 'SELECT * FROM users WHERE id = :id'
+
+LISTING_DETAIL_SQL = f"""
+    SELECT l.*, {SELLER_COLUMNS},
+        EXISTS (
+            SELECT 1 FROM saves s WHERE s.user_id = :user_id AND s.listing_id = l.id
+        ) AS saved,
+        (
+            SELECT c.chat_id FROM chats c
+            WHERE (c.listing_id = l.id AND c.seller_id = l.seller_id AND c.buyer_id = :user_id)
+            OR (c.listing_id = l.id AND c.seller_id = :user_id AND c.buyer_id = l.seller_id)
+            LIMIT 1
+        ) AS chat_id
+    FROM listings l
+    JOIN users u ON u.id = l.seller_id
+    WHERE l.id = :id
+"""
+
+# Full-text search has no portable SQL, so each backend gets its own ranked query
+SEARCH_SQL = {
+    # Ranked by bm25, with matches in the name weighted above the description
+    'sqlite': """
+        SELECT l.*
+        FROM listings_fts
+        JOIN listings l ON l.id = listings_fts.rowid
+        WHERE listings_fts MATCH :query
+        ORDER BY bm25(listings_fts, 10.0, 1.0)
+        LIMIT :limit OFFSET :offset
+    """,
+    # Served by the GIN index on the same expression; name is weight A, description B
+    'postgresql': f"""
+        SELECT l.*
+        FROM listings l, to_tsquery('english', :query) q
+        WHERE ({POSTGRES_SEARCH_DOCUMENT}) @@ q
+        ORDER BY ts_rank({POSTGRES_SEARCH_DOCUMENT}, q) DESC, l.id DESC
+        LIMIT :limit OFFSET :offset
+    """,
+}
+
+SIMILAR_LISTINGS_SQL = """
+    SELECT l.id, l.name, l.price, l.image_path, l.image_key, l.dateposted, l.is_sold, l.version
+    FROM similar_listings s
+    JOIN listings l ON l.id = s.similar_id
+    WHERE s.listing_id = :id AND l.is_sold = FALSE
+    ORDER BY s.rank LIMIT :limit
+"""
+
+SAVED_LISTINGS_SQL = """
+    SELECT l.id, l.name, l.description, l.price, l.dateposted, s.saved_at, l.image_path, l.image_key, l.is_sold, l.version
+    FROM saves s
+    JOIN listings l ON s.listing_id = l.id
+    WHERE s.user_id = :user_id
+    ORDER BY s.saved_at DESC
+"""
+
+# Newest activity first. A user's chats as buyer and as seller are read in two
+# branches, each walking its (buyer_id or seller_id, last_activity, chat_id)
+# index in order, and UNION ALL merges them without sorting every chat the user
+# has. {keyset} is empty on the first page, else INBOX_KEYSET.
+INBOX_SQL = """
+    SELECT c.chat_id AS chat_id, l.name AS listing_name, u.username AS sender_username, m.message_content, m.sent_at,
+    l.image_path, l.image_key, c.buyer_unread AS unread_count, seller.name_first AS seller_first_name,
+    c.last_activity AS last_activity
+    FROM chats c
+    JOIN messages m ON m.message_id = c.last_message_id
+    JOIN users u ON m.sender_id = u.id
+    JOIN listings l ON c.listing_id = l.id
+    JOIN users seller ON l.seller_id = seller.id
+    WHERE c.buyer_id = :user_id {keyset}
+    UNION ALL
+    SELECT c.chat_id AS chat_id, l.name AS listing_name, u.username AS sender_username, m.message_content, m.sent_at,
+    l.image_path, l.image_key, c.seller_unread AS unread_count, seller.name_first AS seller_first_name,
+    c.last_activity AS last_activity
+    FROM chats c
+    JOIN messages m ON m.message_id = c.last_message_id
+    JOIN users u ON m.sender_id = u.id
+    JOIN listings l ON c.listing_id = l.id
+    JOIN users seller ON l.seller_id = seller.id
+    WHERE c.seller_id = :user_id AND c.buyer_id <> :user_id {keyset}
+    ORDER BY last_activity DESC, chat_id DESC
+    LIMIT :limit
+"""
+INBOX_KEYSET = 'AND (c.last_activity, c.chat_id) < (:last_activity, :chat_id)'
+
+NEW_MESSAGES_SQL = """
+    SELECT m.message_id, m.message_content, m.sent_at, u.username, m.sender_id
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.chat_id = :chat_id AND m.message_id > :after
+    ORDER BY m.message_id
+"""
+
+# The other participant's read watermark in a chat
+READ_UPTO_SQL = """
+    SELECT CASE WHEN buyer_id = :user_id THEN seller_last_read ELSE buyer_last_read END
+    FROM chats WHERE chat_id = :chat_id
+"""
+
+# {last_read} and {unread} are the reader's columns (buyer_* or seller_*)
+MARK_CHAT_READ_SQL = """
+    UPDATE chats SET {last_read} = last_message_id, {unread} = 0
+    WHERE chat_id = :chat_id AND {unread} > 0
+"""
+
+DELETE_LISTING_MESSAGES_SQL = """
+    DELETE FROM messages WHERE chat_id IN (
+        SELECT chat_id FROM chats WHERE listing_id = :id
+    )
+"""
+DELETE_LISTING_SAVES_SQL = 'DELETE FROM saves WHERE listing_id = :id'
+DELETE_SIMILAR_TO_LISTING_SQL = 'DELETE FROM similar_listings WHERE similar_id = :id'
+
+# Sold listings past retention and idle chats, a keyset batch at a time (maintenance.py)
+SOLD_LISTINGS_SQL = """
+    SELECT * FROM listings
+    WHERE is_sold = TRUE AND sold_at < :cutoff AND (sold_at, id) > (:sold_at, :id)
+    ORDER BY sold_at, id LIMIT :limit
+"""
+STALE_CHATS_SQL = """
+    SELECT * FROM chats
+    WHERE last_activity < :cutoff AND (last_activity, chat_id) > (:last_activity, :chat_id)
+    ORDER BY last_activity, chat_id LIMIT :limit
+"""
+SAVED_LISTING_IDS_SQL = """
+    SELECT DISTINCT listing_id FROM saves WHERE listing_id > :after ORDER BY listing_id LIMIT :limit
+"""
+IMAGE_KEY_IN_USE_SQL = 'SELECT 1 FROM listings WHERE image_key = :key LIMIT 1'
+IMAGE_PATH_IN_USE_SQL = 'SELECT 1 FROM listings WHERE image_path = :path LIMIT 1'
+
+# Sort orders of /browse: (column, direction, cursor type of the column). Every
+# order ends with id as a tie-breaker, so (column, id) is a unique keyset cursor.
+BROWSE_SORTS = {
+    'newest': ('dateposted', 'DESC', datetime.datetime),
+    'price_low': ('price', 'ASC', float),
+    'price_high': ('price', 'DESC', float),
+}
+
+
+def identity_cache():
+    """This request's rows by (table, id); a throwaway dict outside of requests."""
+    if not has_request_context():
+        return {}
+    if 'identity_cache' not in g:
+        g.identity_cache = {}
+    return g.identity_cache
+
+
+def forget_cached_rows(session=None):
+    if has_request_context():
+        g.pop('identity_cache', None)
+
+
+def cached_row(table, row_id, load):
+    cache = identity_cache()
+    key = (table, str(row_id))
+    if key not in cache:
+        cache[key] = load()
+    return cache[key]
+
+
+def get_user(conn, user_id):
+    return cached_row('users', user_id, lambda: conn.execute(USER_SQL, {'id': user_id}).fetchone())
+
+
+def get_listing(conn, listing_id):
+    return cached_row('listings', listing_id, lambda: conn.execute(
+        'SELECT * FROM listings WHERE id = :id', {'id': listing_id}
+    ).fetchone())
+
+
+def get_listing_with_seller(conn, listing_id):
+    """The listing plus its seller's username and first name, in one query."""
+    return cached_row('listings+seller', listing_id, lambda: conn.execute(f"""
+        SELECT l.*, {SELLER_COLUMNS}
+        FROM listings l
+        JOIN users u ON u.id = l.seller_id
+        WHERE l.id = :id
+    """, {'id': listing_id}).fetchone())
+
+
+def get_listing_detail(conn, listing_id, user_id):
+    """
+    Everything the listing page shows, in one query: the listing, its seller,
+    whether user_id has saved it, and the chat between user_id and the seller
+    about it (chat_id, or NULL).
+    """
+    return cached_row('listing-detail', (listing_id, user_id), lambda: conn.execute(
+        LISTING_DETAIL_SQL, {'id': listing_id, 'user_id': user_id}
+    ).fetchone())
+
+
+def feed_query(after=None):
+    """
+    The home feed, unsold listings newest first, and its parameters. `after`
+    is the (dateposted, id) of the last listing on the previous page.
+    """
+    sql = f'SELECT {LISTING_CARD_COLUMNS} FROM listings WHERE is_sold = FALSE'
+    params = {}
+    if after:
+        sql += ' AND (dateposted, id) < (:dateposted, :id)'
+        params.update(dateposted=after[0], id=after[1])
+    return sql + ' ORDER BY dateposted DESC, id DESC LIMIT :limit', params
+
+
+def profile_query(seller_id, after=None):
+    """
+    A seller's listings, unsold first and then sold, each newest first, and
+    the parameters. `after` is the previous page's last (is_sold, dateposted, id).
+    """
+    sql = f'SELECT {LISTING_CARD_COLUMNS} FROM listings WHERE seller_id = :seller_id'
+    params = {'seller_id': seller_id}
+    if after:
+        sql += ' AND (is_sold > :is_sold OR (is_sold = :is_sold AND (dateposted, id) < (:dateposted, :id)))'
+        params.update(is_sold=after[0], dateposted=after[1], id=after[2])
+    return sql + ' ORDER BY is_sold ASC, dateposted DESC, id DESC LIMIT :limit', params
+
+
+def browse_query(filters, seller_id=None, after=None, dialect='sqlite'):
+    """
+    The /browse query for these filters and its parameters. Sold state always
+    narrows the query and the sort column leads the index behind it:
+    idx_listings_feed / idx_listings_price, or with a seller
+    idx_listings_seller_newest / idx_listings_seller_price. So each page is one
+    range scan in sort order, with the other filters checked along the way.
+    SQLite would rather search a narrow price or date range on its own index and
+    sort the matches in a temp b-tree, so there the filter columns that aren't
+    the sort column get a unary + to keep them off the index.
+    """
+    column, direction, kind = BROWSE_SORTS[filters['sort']]
+    def filtered(name):
+        return '+' + name if name != column and dialect == 'sqlite' else name
+    sql = f"SELECT {LISTING_CARD_COLUMNS} FROM listings WHERE is_sold = {'TRUE' if filters['sold'] else 'FALSE'}"
+    params = {}
+    if seller_id is not None:
+        sql += ' AND seller_id = :seller_id'
+        params['seller_id'] = seller_id
+    if filters['min_price'] is not None:
+        sql += f" AND {filtered('price')} >= :min_price"
+        params['min_price'] = filters['min_price']
+    if filters['max_price'] is not None:
+        sql += f" AND {filtered('price')} <= :max_price"
+        params['max_price'] = filters['max_price']
+    if filters['since']:
+        sql += f" AND {filtered('dateposted')} >= :since"
+        params['since'] = filters['since']
+    if after:
+        sql += f" AND ({column}, id) {'<' if direction == 'DESC' else '>'} (:after_value, :after_id)"
+        params.update(after_value=after[0], after_id=after[1])
+    return sql + f' ORDER BY {column} {direction}, id {direction} LIMIT :limit', params
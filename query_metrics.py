@@ -0,0 +1,233 @@
+"""
+Per-request SQL instrumentation for HawkSwap.
+
+QueryMetrics hooks the SQLAlchemy engine and records, for every endpoint, how
+many statements it ran and how long they took, plus cumulative time per
+distinct statement. Slow statements are logged. The numbers are served in the
+Prometheus text format at /metrics, and optionally as a Server-Timing header
+on every response.
+
+The report command reads /metrics from a running app and lists the statements
+that cost the most database time overall:
+
+    python query_metrics.py report [http://127.0.0.1:5000/metrics] [--top 20]
+"""
+import argparse
+import re
+import threading
+import time
+import urllib.request
+
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event
+
+METRIC_PREFIX = 'hawkswap'
+
+
+def normalize_statement(statement):
+    """Collapse whitespace so the same query always maps to the same key."""
+    return ' '.join(statement.split())
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'queries', 'db_seconds', 'slow_queries')
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slow_queries = 0
+
+
+class StatementStats:
+    __slots__ = ('calls', 'seconds', 'max_seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+
+class QueryMetrics:
+    """
+    Collects query counts and timings per endpoint and per statement.
+
+    Config keys read from the app:
+    SLOW_QUERY_SECONDS  statements slower than this are counted and logged (0.1)
+    SERVER_TIMING       add a Server-Timing header to every response (False)
+    METRICS_ALLOW       client addresses allowed to read /metrics (loopback only)
+    """
+
+    def __init__(self, app=None, *engines, max_statements=500):
+        self.max_statements = max_statements
+        self.endpoints = {}
+        self.statements = {}
+        self.extra_collectors = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, *engines)
+
+    def init_app(self, app, *engines):
+        app.config.setdefault('SLOW_QUERY_SECONDS', 0.1)
+        app.config.setdefault('SERVER_TIMING', False)
+        app.config.setdefault('METRICS_ALLOW', ['127.0.0.1', '::1'])
+        self.slow_threshold = app.config['SLOW_QUERY_SECONDS']
+        self.server_timing = app.config['SERVER_TIMING']
+        self.metrics_allow = app.config['METRICS_ALLOW']
+        self.logger = app.logger
+        for engine in engines:
+            self.instrument(engine)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def instrument(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def add_collector(self, collect):
+        """Register a callable returning extra Prometheus text lines for /metrics."""
+        self.extra_collectors.append(collect)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        endpoint = 'background'
+        if has_request_context():
+            endpoint = request.endpoint or 'unknown'
+            g.query_count = g.get('query_count', 0) + 1
+            g.query_seconds = g.get('query_seconds', 0.0) + elapsed
+        key = normalize_statement(statement)
+        slow = elapsed >= self.slow_threshold
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None and len(self.statements) < self.max_statements:
+                stats = self.statements[key] = StatementStats()
+            if stats is not None:
+                stats.calls += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+            if slow:
+                if endpoint == 'background':
+                    self._endpoint('background').slow_queries += 1
+                else:
+                    g.slow_queries = g.get('slow_queries', 0) + 1
+        if slow:
+            self.logger.warning('Slow query in %s (%.1f ms): %s', endpoint, elapsed * 1000, key)
+
+    def _handle_error(self, context):
+        # A failed statement never reaches after_cursor_execute; drop its start
+        # time, or the next statement on this connection would pop the wrong one
+        if context.connection is None or context.execution_context is None:
+            return  # failed before reaching the cursor
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+    def _endpoint(self, name):
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = EndpointStats()
+        return stats
+
+    def _start_request(self):
+        g.query_count = 0
+        g.query_seconds = 0.0
+        g.slow_queries = 0
+
+    def _finish_request(self, response):
+        if request.endpoint == 'metrics':
+            return response
+        with self._lock:
+            stats = self._endpoint(request.endpoint or 'unknown')
+            stats.requests += 1
+            stats.queries += g.query_count
+            stats.db_seconds += g.query_seconds
+            stats.slow_queries += g.slow_queries
+        if self.server_timing:
+            response.headers.add('Server-Timing', 'db;dur=%.2f;desc="%d queries"' % (g.query_seconds * 1000, g.query_count))
+        return response
+
+    def metrics_view(self):
+        if self.metrics_allow and request.remote_addr not in self.metrics_allow:
+            abort(404)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label(str(val))}"' for key, val in labels.items())
+                lines.append(f'{METRIC_PREFIX}_{name}{{{label_text}}} {value}')
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            statements = sorted(self.statements.items(), key=lambda item: -item[1].seconds)
+            family('requests_total', 'counter', 'Requests handled, by endpoint.',
+                   [({'endpoint': name}, stats.requests) for name, stats in endpoints])
+            family('db_queries_total', 'counter', 'SQL statements executed, by endpoint.',
+                   [({'endpoint': name}, stats.queries) for name, stats in endpoints])
+            family('db_seconds_total', 'counter', 'Time spent executing SQL, by endpoint.',
+                   [({'endpoint': name}, '%.6f' % stats.db_seconds) for name, stats in endpoints])
+            family('db_slow_queries_total', 'counter', 'SQL statements slower than the slow query threshold, by endpoint.',
+                   [({'endpoint': name}, stats.slow_queries) for name, stats in endpoints])
+            family('db_statement_calls_total', 'counter', 'Executions of each distinct SQL statement.',
+                   [({'statement': key}, stats.calls) for key, stats in statements])
+            family('db_statement_seconds_total', 'counter', 'Time spent in each distinct SQL statement.',
+                   [({'statement': key}, '%.6f' % stats.seconds) for key, stats in statements])
+            family('db_statement_max_seconds', 'gauge', 'Slowest single execution of each distinct SQL statement.',
+                   [({'statement': key}, '%.6f' % stats.max_seconds) for key, stats in statements])
+        for collect in self.extra_collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+SAMPLE_PATTERN = re.compile(r'^(\w+)\{statement="((?:[^"\\]|\\.)*)"\} (\S+)$')
+
+
+def parse_statement_samples(text):
+    """Per-statement calls, seconds and max seconds from /metrics output."""
+    stats = {}
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line)
+        if not match:
+            continue
+        name, statement, value = match.groups()
+        statement = statement.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+        field = name[len(METRIC_PREFIX) + 1:]
+        stats.setdefault(statement, {})[field] = float(value)
+    return stats
+
+
+def report(url, top):
+    with urllib.request.urlopen(url) as response:
+        stats = parse_statement_samples(response.read().decode())
+    rows = sorted(stats.items(), key=lambda item: -item[1].get('db_statement_seconds_total', 0))[:top]
+    print(f"{'total ms':>10} {'calls':>8} {'avg ms':>8} {'max ms':>8}  statement")
+    for statement, values in rows:
+        calls = values.get('db_statement_calls_total', 0)
+        total = values.get('db_statement_seconds_total', 0) * 1000
+        slowest = values.get('db_statement_max_seconds', 0) * 1000
+        average = total / calls if calls else 0
+        print(f'{total:>10.1f} {calls:>8.0f} {average:>8.2f} {slowest:>8.2f}  {statement[:120]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Top SQL statements by cumulative time, read from a running app.')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    report_parser = subcommands.add_parser('report')
+    report_parser.add_argument('url', nargs='?', default='http://127.0.0.1:5000/metrics')
+    report_parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    report(args.url, args.top)
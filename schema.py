@@ -0,0 +1,115 @@
+"""
+The HawkSwap schema as SQLAlchemy Core tables.
+
+init_db.py creates PostgreSQL (and any other non-SQLite) databases from this
+metadata. SQLite databases are built by init_db's own versioned migrations,
+which end up at the same schema plus the FTS5 search index; when a table
+changes, change it in both places.
+"""
+from sqlalchemy import (
+    Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, Table, Text, UniqueConstraint, false, text,
+)
+
+metadata = MetaData()
+
+users = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', Text, unique=True, nullable=False),
+    Column('name_first', Text, nullable=False),
+    Column('name_last', Text, nullable=False),
+    Column('password', Text, nullable=False),
+    Column('email', Text, nullable=False),
+    Column('unread_count', Integer, nullable=False, server_default=text('0')),
+)
+
+listings = Table(
+    'listings', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('description', Text),
+    Column('price', Float, nullable=False),
+    Column('image_path', Text),
+    Column('dateposted', DateTime, nullable=False),
+    Column('is_sold', Boolean, server_default=false()),
+    Column('seller_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('image_key', Text),
+    Column('version', Integer, nullable=False, server_default=text('0')),
+    # When the listing was marked sold; NULL while it is for sale
+    Column('sold_at', DateTime),
+    Index('idx_listings_feed', 'is_sold', 'dateposted', 'id'),
+    Index('idx_listings_image_key', 'image_key'),
+    Index('idx_listings_image_path', 'image_path'),
+    Index('idx_listings_price', 'is_sold', 'price', 'id'),
+    Index('idx_listings_seller_price', 'seller_id', 'is_sold', 'price', 'id'),
+    Index('idx_listings_sold', 'is_sold', 'sold_at', 'id'),
+)
+# A seller's listings in profile order: unsold first, each newest first
+Index('idx_listings_seller_newest', listings.c.seller_id, listings.c.is_sold,
+      listings.c.dateposted.desc(), listings.c.id.desc())
+
+chats = Table(
+    'chats', metadata,
+    Column('chat_id', Integer, primary_key=True),
+    Column('created_at', DateTime),
+    Column('listing_id', Integer, ForeignKey('listings.id')),
+    Column('seller_id', Integer, ForeignKey('users.id')),
+    Column('buyer_id', Integer, ForeignKey('users.id')),
+    # No database-level FK: chats and messages reference each other
+    Column('last_message_id', Integer),
+    Column('last_activity', DateTime),
+    Column('buyer_unread', Integer, nullable=False, server_default=text('0')),
+    Column('seller_unread', Integer, nullable=False, server_default=text('0')),
+    # Id of the last message each side has read
+    Column('buyer_last_read', Integer, nullable=False, server_default=text('0')),
+    Column('seller_last_read', Integer, nullable=False, server_default=text('0')),
+    Index('idx_chats_listing', 'listing_id', 'seller_id', 'buyer_id'),
+    Index('idx_chats_buyer_activity', 'buyer_id', 'last_activity', 'chat_id'),
+    Index('idx_chats_seller_activity', 'seller_id', 'last_activity', 'chat_id'),
+    Index('idx_chats_activity', 'last_activity'),
+)
+
+messages = Table(
+    'messages', metadata,
+    Column('message_id', Integer, primary_key=True),
+    Column('chat_id', Integer, ForeignKey('chats.chat_id')),
+    Column('sender_id', Integer, ForeignKey('users.id')),
+    Column('message_content', Text),
+    Column('sent_at', DateTime),
+    Index('idx_messages_chat_id', 'chat_id', 'message_id'),
+)
+
+saves = Table(
+    'saves', metadata,
+    Column('user_id', Integer, ForeignKey('users.id')),
+    Column('listing_id', Integer, ForeignKey('listings.id')),
+    Column('saved_at', DateTime),
+    UniqueConstraint('user_id', 'listing_id', name='idx_saves_user_listing'),
+    Index('idx_saves_user_saved_at', 'user_id', 'saved_at'),
+    Index('idx_saves_listing', 'listing_id'),
+)
+
+# Nearest neighbours of each listing, best first, written by similar.py.
+# No database-level FKs: rows are deleted along with either listing.
+similar_listings = Table(
+    'similar_listings', metadata,
+    Column('listing_id', Integer, primary_key=True, autoincrement=False),
+    Column('rank', Integer, primary_key=True, autoincrement=False),
+    Column('similar_id', Integer, nullable=False),
+    Column('score', Float, nullable=False),
+    Index('idx_similar_listings_similar', 'similar_id'),
+)
+
+# Full-text search document for a listing on PostgreSQL, name weighted above
+# description. app.py's search query must use the identical expression for the
+# GIN index to apply.
+POSTGRES_SEARCH_DOCUMENT = (
+    "setweight(to_tsvector('english', name), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def create_postgres_search_index(connection):
+    connection.exec_driver_sql(
+        f'CREATE INDEX IF NOT EXISTS idx_listings_search ON listings USING GIN (({POSTGRES_SEARCH_DOCUMENT}))'
+    )
@@ -0,0 +1,363 @@
+"""
+Similar listings for HawkSwap.
+
+The listing page shows the first few unsold listings from the
+similar_listings table, which holds the K nearest neighbours of every
+listing, best first. Serving them is one primary-key range scan joined to
+listings; nothing is scored per request.
+
+Neighbours are ranked by the cosine similarity of TF-IDF vectors built from
+a listing's name (counted NAME_WEIGHT times) and description, blended with
+how close the prices are: listings in the same power-of-two price band get
+the full PRICE_WEIGHT bonus, adjacent bands half of it. Only unsold
+listings are candidates, and only those sharing at least one term with the
+listing. Terms found in more than MAX_DF_SHARE of listings are left out.
+So that scoring a listing costs the same however big the site gets, each
+listing is matched on its QUERY_TERMS most distinctive terms, and each
+term only lists the MAX_POSTINGS candidates it weighs most in.
+
+    python similar.py build [--k 12]
+
+scores every listing in blocks with NumPy and rewrites the table. It also
+saves the candidate vectors to HAWKSWAP_SIMILAR_INDEX (similar-index.npz),
+which the app loads to keep the table current between builds: after a
+listing is created or edited, a background job scores it against the saved
+vectors plus the listings changed since, stores its neighbours and adds it
+to the neighbours' own lists where it ranks high enough. Run the build
+nightly from cron; the app runs one itself when there is no saved index yet
+or REBUILD_AFTER listings have changed since the last.
+
+Needs NumPy (pip install numpy). Without it the table is left as it is.
+"""
+import argparse
+import math
+import os
+import re
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Neighbours stored per listing, and shown on the listing page
+K = 12
+SHOWN = 6
+NAME_WEIGHT = 2.0
+# Share of a score that comes from price
+PRICE_WEIGHT = 0.25
+MAX_DF_SHARE = 0.5
+QUERY_TERMS = 8
+MAX_POSTINGS = 500
+# Listings scored per block of the build, and whose rows are rewritten per transaction
+BLOCK_SIZE = 500
+# Changed listings the app scores on top of the saved index before it rebuilds
+REBUILD_AFTER = 2000
+# Price band of a listing whose price can't be read: next to no other
+NO_BAND = -100
+WORD_PATTERN = re.compile(r'[a-z0-9]{2,}')
+
+
+def price_band(price):
+    try:
+        return int(math.log2(max(float(price), 0) + 1))
+    except (TypeError, ValueError):
+        return NO_BAND
+
+
+def price_bands(listings):
+    return np.array([price_band(listing['price']) for listing in listings], dtype=np.int64)
+
+
+def listing_terms(listing):
+    """(term, weight) for every word of a listing, repeats included."""
+    terms = [(word, NAME_WEIGHT) for word in WORD_PATTERN.findall((listing['name'] or '').lower())]
+    terms += [(word, 1.0) for word in WORD_PATTERN.findall((listing['description'] or '').lower())]
+    return terms
+
+
+def fit(listings):
+    """Vocabulary (term -> column) and the inverse document frequency of each column."""
+    document_frequency = {}
+    for listing in listings:
+        for term in {term for term, weight in listing_terms(listing)}:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    limit = MAX_DF_SHARE * len(listings)
+    terms = sorted(term for term, count in document_frequency.items() if count <= limit)
+    counts = np.array([document_frequency[term] for term in terms], dtype=np.float64)
+    idf = np.log((1 + len(listings)) / (1 + counts)) + 1
+    return {term: column for column, term in enumerate(terms)}, idf
+
+
+def vectorize(listings, vocabulary, idf):
+    """
+    L2-normalized TF-IDF vectors of the listings as sparse (row, column,
+    weight) arrays, sorted by row. Terms outside the vocabulary are dropped.
+    """
+    rows, columns, weights = [], [], []
+    for row, listing in enumerate(listings):
+        for term, weight in listing_terms(listing):
+            column = vocabulary.get(term)
+            if column is not None:
+                rows.append(row)
+                columns.append(column)
+                weights.append(weight)
+    width = max(len(vocabulary), 1)
+    # Add up repeated terms: one entry per (row, column)
+    keys, inverse = np.unique(np.array(rows, dtype=np.int64) * width + np.array(columns, dtype=np.int64), return_inverse=True)
+    tf = np.bincount(inverse, weights=np.array(weights, dtype=np.float64))
+    rows, columns = keys // width, keys % width
+    weights = np.log1p(tf) * idf[columns]
+    norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(listings)))
+    return rows, columns, weights / norms[rows]
+
+
+def rank_in_row(rows):
+    """Position of each entry within its row's run, for row-sorted entries."""
+    return np.arange(len(rows)) - np.searchsorted(rows, rows)
+
+
+def by_row_then_weight(rows, weights):
+    """Order of entries by row, then weight (0 to 1) descending, in one sort."""
+    return np.argsort(rows - weights / 2)
+
+
+def strongest_terms(rows, columns, weights, limit=QUERY_TERMS):
+    """Each row's `limit` highest-weighted entries."""
+    order = by_row_then_weight(rows, weights)
+    rows, columns, weights = rows[order], columns[order], weights[order]
+    keep = rank_in_row(rows) < limit
+    return rows[keep], columns[keep], weights[keep]
+
+
+def top_per_row(rows, ids, scores, count, k):
+    """Group (row, id, score) triples into `count` lists of the k best (id, score), best first."""
+    order = by_row_then_weight(rows, scores)
+    rows, ids, scores = rows[order], ids[order], scores[order]
+    keep = rank_in_row(rows) < k
+    rows, ids, scores = rows[keep], ids[keep], scores[keep]
+    bounds = np.searchsorted(rows, np.arange(count + 1))
+    return [list(zip(ids[lo:hi].tolist(), scores[lo:hi].tolist())) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def blend(dots, bands, other_bands):
+    """Final scores: text similarity, plus PRICE_WEIGHT for the same price band or half of it for the next."""
+    distance = np.abs(bands - other_bands)
+    closeness = np.where(distance == 0, 1.0, np.where(distance == 1, 0.5, 0.0))
+    return (1 - PRICE_WEIGHT) * dots + PRICE_WEIGHT * closeness
+
+
+class SimilarityIndex:
+    """
+    TF-IDF vectors of the candidate listings, stored by term: for column c,
+    postings[starts[c]:starts[c + 1]] are the positions (in ids) of the
+    candidates containing it, at most MAX_POSTINGS of them, and weights[...]
+    their weights.
+
+    Listings changed since the index was built are kept on the side in
+    `changed` and scored one by one; their stale positions are switched off
+    in `active`.
+    """
+
+    def __init__(self, terms, idf, ids, bands, starts, postings, weights):
+        self.terms = list(terms)
+        self.vocabulary = {term: column for column, term in enumerate(self.terms)}
+        self.idf = idf
+        self.ids = ids
+        self.bands = bands
+        self.positions = {listing_id: position for position, listing_id in enumerate(ids.tolist())}
+        self.starts = starts
+        self.postings = postings
+        self.weights = weights
+        self.active = np.ones(len(ids), dtype=bool)
+        self.changed = {}
+
+    @classmethod
+    def from_vectors(cls, vocabulary, idf, ids, bands, rows, columns, weights):
+        """Index the candidate vectors (rows indexing ids) by column, keeping each column's heaviest entries."""
+        order = by_row_then_weight(columns, weights)
+        rows, columns, weights = rows[order], columns[order], weights[order]
+        keep = rank_in_row(columns) < MAX_POSTINGS
+        starts = np.searchsorted(columns[keep], np.arange(len(vocabulary) + 1))
+        terms = sorted(vocabulary, key=vocabulary.get)
+        return cls(terms, idf, ids, bands, starts, rows[keep], weights[keep])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['terms'].tolist(), data['idf'], data['ids'], data['bands'],
+                       data['starts'], data['postings'], data['weights'])
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, terms=np.array(self.terms, dtype=str), idf=self.idf, ids=self.ids, bands=self.bands,
+                     starts=self.starts, postings=self.postings, weights=self.weights)
+        os.replace(path + '.tmp', path)
+
+    def matches(self, rows, columns, weights):
+        """(query row, candidate position, dot product) for every pair sharing at least one term."""
+        size = max(len(self.ids), 1)
+        lengths = self.starts[columns + 1] - self.starts[columns]
+        # Where in postings each (query term, candidate) pair is, gathered in one go
+        offsets = np.repeat(self.starts[columns] - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+        keys, inverse = np.unique(np.repeat(rows, lengths) * size + self.postings[offsets], return_inverse=True)
+        dots = np.bincount(inverse, weights=np.repeat(weights, lengths) * self.weights[offsets])
+        return keys // size, keys % size, dots
+
+    def neighbours(self, listing_ids, bands, rows, columns, weights, k=K):
+        """
+        The k best-scoring candidates for each query listing, as lists of
+        (listing id, score), best first. A listing is never its own neighbour.
+        """
+        rows, columns, weights = strongest_terms(rows, columns, weights)
+        query_rows, positions, dots = self.matches(rows, columns, weights)
+        own = np.array([self.positions.get(listing_id, -1) for listing_id in listing_ids], dtype=np.int64)
+        keep = self.active[positions] & (positions != own[query_rows])
+        query_rows, positions, dots = query_rows[keep], positions[keep], dots[keep]
+        result_ids, scores = self.ids[positions], blend(dots, bands[query_rows], self.bands[positions])
+        if self.changed:
+            extra = []
+            for row, listing_id in enumerate(listing_ids):
+                query = np.zeros(len(self.terms))
+                query[columns[rows == row]] = weights[rows == row]
+                for other, (other_columns, other_weights, other_band) in self.changed.items():
+                    dot = query[other_columns] @ other_weights
+                    if other != listing_id and dot > 0:
+                        extra.append((row, other, blend(dot, bands[row], other_band)))
+            if extra:
+                extra_rows, extra_ids, extra_scores = (np.array(values) for values in zip(*extra))
+                query_rows = np.concatenate([query_rows, extra_rows])
+                result_ids = np.concatenate([result_ids, extra_ids])
+                scores = np.concatenate([scores, extra_scores])
+        return top_per_row(query_rows, result_ids, scores, len(listing_ids), k)
+
+    def update(self, listing_id, columns, weights, band, candidate):
+        """Take a created or edited listing into account in later queries."""
+        position = self.positions.get(listing_id)
+        if position is not None:
+            self.active[position] = False
+        if candidate:
+            self.changed[listing_id] = (columns, weights, band)
+        else:
+            self.changed.pop(listing_id, None)
+
+
+def load_listings(conn):
+    return conn.execute('SELECT id, name, description, price, is_sold FROM listings ORDER BY id').fetchall()
+
+
+def store_neighbours(conn, neighbours):
+    """Replace the similar_listings rows of each listing in `neighbours` (listing id -> [(id, score)])."""
+    conn.execute('DELETE FROM similar_listings WHERE listing_id = :id', [{'id': listing_id} for listing_id in neighbours])
+    rows = [{'listing_id': listing_id, 'rank': rank, 'similar_id': similar_id, 'score': score}
+            for listing_id, similar in neighbours.items() for rank, (similar_id, score) in enumerate(similar)]
+    if rows:
+        conn.execute('INSERT INTO similar_listings (listing_id, rank, similar_id, score) '
+                     'VALUES (:listing_id, :rank, :similar_id, :score)', rows)
+
+
+def build(get_db_connection, path, k=K):
+    """Score every listing, rewrite similar_listings and save the index to path. Returns the index."""
+    conn = get_db_connection()
+    listings = load_listings(conn)
+    conn.close()
+    vocabulary, idf = fit(listings)
+    rows, columns, weights = vectorize(listings, vocabulary, idf)
+    ids = np.array([listing['id'] for listing in listings], dtype=np.int64)
+    bands = price_bands(listings)
+    candidates = np.array([not listing['is_sold'] for listing in listings], dtype=bool)
+    # Candidates are renumbered 0..n-1 in the index
+    positions = np.cumsum(candidates) - 1
+    keep = candidates[rows]
+    index = SimilarityIndex.from_vectors(vocabulary, idf, ids[candidates], bands[candidates],
+                                         positions[rows[keep]], columns[keep], weights[keep])
+
+    bounds = np.searchsorted(rows, np.arange(0, len(listings) + BLOCK_SIZE, BLOCK_SIZE))
+    for number, start in enumerate(range(0, len(listings), BLOCK_SIZE)):
+        lo, hi = bounds[number], bounds[number + 1]
+        block = ids[start:start + BLOCK_SIZE].tolist()
+        results = index.neighbours(block, bands[start:start + BLOCK_SIZE], rows[lo:hi] - start, columns[lo:hi], weights[lo:hi], k)
+        conn = get_db_connection(write=True)
+        store_neighbours(conn, dict(zip(block, results)))
+        conn.commit()
+        conn.close()
+    index.save(path)
+    return index
+
+
+class SimilarListings:
+    """
+    Keeps similar_listings current as listings change, from one worker
+    thread (its methods aren't thread-safe). The index saved by the last
+    build is loaded on first use and again whenever the file changes.
+    """
+
+    def __init__(self, path, k=K):
+        self.path = path
+        self.k = k
+        self.index = None
+        self.loaded_mtime = None
+
+    def current_index(self, get_db_connection):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime is None or (self.index is not None and len(self.index.changed) >= REBUILD_AFTER):
+            self.index = build(get_db_connection, self.path, self.k)
+            mtime = os.stat(self.path).st_mtime
+        elif mtime != self.loaded_mtime:
+            self.index = SimilarityIndex.load(self.path)
+        self.loaded_mtime = mtime
+        return self.index
+
+    def refresh(self, get_db_connection, listing_id):
+        """Recompute a created or edited listing's neighbours and offer it to theirs."""
+        index = self.current_index(get_db_connection)
+        # Read and score on the read connection; the writer is only taken to store the result
+        conn = get_db_connection()
+        listing = conn.execute('SELECT id, name, description, price, is_sold FROM listings WHERE id = :id',
+                               {'id': listing_id}).fetchone()
+        if listing is None:
+            conn.close()
+            return
+        rows, columns, weights = vectorize([listing], index.vocabulary, index.idf)
+        bands = price_bands([listing])
+        index.update(listing['id'], columns, weights, bands[0], candidate=not listing['is_sold'])
+        mine = index.neighbours([listing['id']], bands, rows, columns, weights, self.k)[0]
+        neighbours = {listing['id']: mine}
+        if not listing['is_sold']:
+            # Similarity is symmetric: this listing may now belong in its neighbours' lists
+            for similar_id, score in mine:
+                current = [(row['similar_id'], row['score']) for row in conn.execute(
+                    'SELECT similar_id, score FROM similar_listings WHERE listing_id = :id ORDER BY rank', {'id': similar_id}
+                ) if row['similar_id'] != listing['id']]
+                if len(current) >= self.k and score <= current[-1][1]:
+                    continue
+                neighbours[similar_id] = sorted(current + [(listing['id'], score)], key=lambda pair: -pair[1])[:self.k]
+        conn.close()
+        conn = get_db_connection(write=True)
+        store_neighbours(conn, neighbours)
+        conn.commit()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute similar listings for the HawkSwap listing page.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='rescore every listing and save the index the app updates from')
+    build_parser.add_argument('--k', type=int, default=K, help='neighbours stored per listing')
+    args = parser.parse_args()
+    if np is None:
+        sys.exit('similar.py needs numpy: pip install numpy')
+
+    import app
+
+    started = time.monotonic()
+    index = build(app.get_db_connection, app.SIMILAR_INDEX_PATH, args.k)
+    print(f'{len(index.ids)} candidates, {len(index.terms)} terms, {time.monotonic() - started:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
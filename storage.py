@@ -0,0 +1,92 @@
+"""
+Database engines for HawkSwap.
+
+Reads and writes go through separate engines. On SQLite the read engine is a
+pool of query_only connections, and the write engine holds exactly one
+connection, so writers in this process queue for it instead of fighting over
+the database lock (and failing with "database is locked" after the busy
+timeout). With WAL journaling, readers never block that writer and it never
+blocks them.
+
+Everything is configured from the environment:
+
+HAWKSWAP_DATABASE_URI         SQLAlchemy URL (sqlite:///marketplace.db)
+HAWKSWAP_SQLITE_WAL           1 for journal_mode=WAL, 0 for the rollback journal (1)
+HAWKSWAP_SQLITE_SYNCHRONOUS   PRAGMA synchronous; NORMAL is durable under WAL (NORMAL)
+HAWKSWAP_SQLITE_MMAP_SIZE     PRAGMA mmap_size in bytes (268435456)
+HAWKSWAP_SQLITE_CACHE_SIZE    PRAGMA cache_size, negative means KiB (-65536)
+HAWKSWAP_SQLITE_BUSY_TIMEOUT  seconds a connection waits on another process's lock (15)
+HAWKSWAP_DB_POOL_SIZE         pooled read connections (8)
+HAWKSWAP_DB_WRITE_TIMEOUT     seconds a writer waits for the write connection (30)
+"""
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_DATABASE_URI = 'sqlite:///marketplace.db'
+
+
+def env_setting(name, default, cast=str):
+    value = os.environ.get(name)
+    return default if value is None else cast(value)
+
+
+def database_settings():
+    return {
+        'uri': env_setting('HAWKSWAP_DATABASE_URI', DEFAULT_DATABASE_URI),
+        'wal': env_setting('HAWKSWAP_SQLITE_WAL', True, lambda value: value == '1'),
+        'synchronous': env_setting('HAWKSWAP_SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'mmap_size': env_setting('HAWKSWAP_SQLITE_MMAP_SIZE', 256 * 1024 * 1024, int),
+        'cache_size': env_setting('HAWKSWAP_SQLITE_CACHE_SIZE', -64 * 1024, int),
+        'busy_timeout': env_setting('HAWKSWAP_SQLITE_BUSY_TIMEOUT', 15.0, float),
+        'pool_size': env_setting('HAWKSWAP_DB_POOL_SIZE', 8, int),
+        'write_timeout': env_setting('HAWKSWAP_DB_WRITE_TIMEOUT', 30.0, float),
+    }
+
+
+def sqlite_pragmas(settings, read_only):
+    pragmas = [
+        'PRAGMA journal_mode = %s' % ('WAL' if settings['wal'] else 'DELETE'),
+        'PRAGMA synchronous = %s' % settings['synchronous'],
+        'PRAGMA mmap_size = %d' % settings['mmap_size'],
+        'PRAGMA cache_size = %d' % settings['cache_size'],
+        'PRAGMA temp_store = MEMORY',
+    ]
+    if read_only:
+        pragmas.append('PRAGMA query_only = ON')
+    return pragmas
+
+
+def create_sqlite_engine(settings, read_only):
+    pragmas = sqlite_pragmas(settings, read_only)
+    if read_only:
+        pool = {'pool_size': settings['pool_size'], 'max_overflow': settings['pool_size']}
+    else:
+        # One connection: writers wait their turn in the pool's queue
+        pool = {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': settings['write_timeout']}
+    engine = create_engine(
+        settings['uri'],
+        poolclass=QueuePool,
+        connect_args={'timeout': settings['busy_timeout'], 'check_same_thread': False},
+        **pool,
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+def create_engines(settings=None):
+    """Return (read_engine, write_engine) for the configured database."""
+    settings = settings or database_settings()
+    if make_url(settings['uri']).get_backend_name() != 'sqlite':
+        engine = create_engine(settings['uri'], pool_size=settings['pool_size'], pool_pre_ping=True)
+        return engine, engine
+    return create_sqlite_engine(settings, read_only=True), create_sqlite_engine(settings, read_only=False)
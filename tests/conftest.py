@@ -0,0 +1,128 @@
+"""
+Fixtures for the HawkSwap tests.
+
+Every test that uses `hawkswap` (or a client built on it) runs once per
+database backend: always against a fresh SQLite file, and against PostgreSQL
+when HAWKSWAP_TEST_POSTGRES_URI names a database the tests may empty, e.g.
+
+    HAWKSWAP_TEST_POSTGRES_URI=postgresql://localhost/hawkswap_test python3 -m pytest
+
+app.py binds its engines when it is imported, so the module is imported
+afresh for each backend with HAWKSWAP_DATABASE_URI pointing at it.
+"""
+import importlib
+import io
+import os
+import sqlite3
+import sys
+
+import pytest
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import init_db
+from schema import metadata
+
+POSTGRES_URI_VARIABLE = 'HAWKSWAP_TEST_POSTGRES_URI'
+PASSWORD = 'hunter2'
+
+
+def create_sqlite_database(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    init_db.create_tables(conn)
+    init_db.migrate(conn)
+    conn.close()
+    return f'sqlite:///{path}'
+
+
+def create_postgres_database(uri):
+    """Drop whatever an earlier run left behind and create the schema afresh."""
+    engine = create_engine(uri)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP INDEX IF EXISTS idx_listings_search')
+        metadata.drop_all(connection)
+    engine.dispose()
+    init_db.create_database(uri).dispose()
+    return uri
+
+
+def postgres_uri():
+    uri = os.environ.get(POSTGRES_URI_VARIABLE)
+    if not uri:
+        pytest.skip(f'set {POSTGRES_URI_VARIABLE} to run against PostgreSQL')
+    return uri
+
+
+@pytest.fixture(scope='session', params=['sqlite', 'postgresql'])
+def hawkswap(request, tmp_path_factory):
+    """app.py imported against an empty database of each backend."""
+    tmp_path = tmp_path_factory.mktemp(request.param)
+    if request.param == 'sqlite':
+        uri = create_sqlite_database(tmp_path / 'marketplace.db')
+    else:
+        uri = create_postgres_database(postgres_uri())
+    os.environ['HAWKSWAP_DATABASE_URI'] = uri
+    os.environ['HAWKSWAP_SIMILAR_INDEX'] = str(tmp_path / 'similar-index.npz')
+    sys.modules.pop('app', None)
+    module = importlib.import_module('app')
+    module.app.config.update(TESTING=True, UPLOADED_IMAGES_DEST=str(tmp_path / 'uploads'))
+    yield module
+    module.similar_executor.shutdown(wait=True)
+    module.image_executor.shutdown(wait=True)
+    module.db_session.remove()
+    module.db_write_session.remove()
+    module.engine.dispose()
+    module.write_engine.dispose()
+    del os.environ['HAWKSWAP_DATABASE_URI']
+    del os.environ['HAWKSWAP_SIMILAR_INDEX']
+
+
+@pytest.fixture
+def app_module(hawkswap):
+    """The app module with every table emptied before the test."""
+    # Background jobs from the previous test must not write into this one
+    hawkswap.similar_executor.submit(lambda: None).result()
+    with hawkswap.write_engine.begin() as connection:
+        for table in reversed(metadata.sorted_tables):
+            connection.execute(table.delete())
+    hawkswap.user_cache.clear()
+    hawkswap.fragment_cache.clear()
+    return hawkswap
+
+
+def register(client, username):
+    return client.post('/register', data={
+        'username': username, 'first': username.title(), 'last': 'Jayhawk',
+        'password': PASSWORD, 'email': f'{username}@ku.edu',
+    })
+
+
+def log_in(client, username):
+    return client.post('/login', data={'username': username, 'password': PASSWORD})
+
+
+@pytest.fixture
+def make_user(app_module):
+    """Register a user and return a test client logged in as them."""
+    def make_user(username):
+        client = app_module.app.test_client()
+        register(client, username)
+        response = log_in(client, username)
+        assert response.status_code == 302
+        return client
+    return make_user
+
+
+@pytest.fixture
+def create_listing(app_module):
+    """Post a listing (without a photo) as `client` and return its id."""
+    def create_listing(client, name, price=10, description='Barely used'):
+        response = client.post('/create-listing', data={
+            'name': name, 'description': description, 'price': str(price),
+            'image': (io.BytesIO(), ''),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 302
+        with app_module.engine.connect() as connection:
+            return connection.execute(text('SELECT max(id) FROM listings WHERE name = :name'), {'name': name}).scalar()
+    return create_listing
@@ -0,0 +1,51 @@
+import sqlite3
+
+from sqlalchemy import inspect, text
+
+import init_db
+from conftest import create_postgres_database, create_sqlite_database, postgres_uri
+from schema import metadata
+
+
+def test_sqlite_migrations_reach_latest_version(tmp_path):
+    create_sqlite_database(tmp_path / 'marketplace.db')
+    conn = sqlite3.connect(tmp_path / 'marketplace.db')
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == init_db.MIGRATIONS[-1][0]
+    conn.close()
+
+
+def test_sqlite_migrate_is_idempotent(tmp_path):
+    create_sqlite_database(tmp_path / 'marketplace.db')
+    conn = sqlite3.connect(tmp_path / 'marketplace.db', isolation_level=None)
+    init_db.create_tables(conn)
+    init_db.migrate(conn)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == init_db.MIGRATIONS[-1][0]
+    conn.close()
+
+
+def test_sqlite_route_queries_use_indexes(tmp_path):
+    create_sqlite_database(tmp_path / 'marketplace.db')
+    conn = sqlite3.connect(tmp_path / 'marketplace.db')
+    assert init_db.check_query_plans(conn)
+    conn.close()
+
+
+
+def test_plan_check_flags_sorted_pages(tmp_path):
+    create_sqlite_database(tmp_path / 'marketplace.db')
+    conn = sqlite3.connect(tmp_path / 'marketplace.db')
+    sql = 'SELECT * FROM listings WHERE seller_id = :seller_id ORDER BY name LIMIT 25'
+    assert init_db.plan_problems(conn, sql, {'seller_id': 1}, paginated=True) == ['USE TEMP B-TREE FOR ORDER BY']
+    assert init_db.plan_problems(conn, sql, {'seller_id': 1}) == []
+    conn.close()
+
+def test_postgres_schema():
+    uri = postgres_uri()
+    create_postgres_database(uri)
+    # Running it again over an existing schema is a no-op
+    engine = init_db.create_database(uri)
+    inspector = inspect(engine)
+    assert set(metadata.tables) <= set(inspector.get_table_names())
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'idx_listings_search'")).scalar()
+    engine.dispose()
@@ -0,0 +1,18 @@
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from query_metrics import QueryMetrics
+
+
+def test_failed_statements_leave_no_start_times():
+    engine = create_engine('sqlite://')
+    metrics = QueryMetrics(Flask(__name__), engine)
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text('SELECT * FROM missing'))
+        connection.execute(text('SELECT 1'))
+        assert connection.info['query_start'] == []
+    assert sum(stats.calls for stats in metrics.statements.values()) == 1
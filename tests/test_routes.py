@@ -0,0 +1,298 @@
+import datetime
+import html
+import io
+import re
+import threading
+
+from sqlalchemy import text
+
+
+def insert_listings(app_module, seller_id, count, is_sold=False):
+    """Insert `count` listings a minute apart, newest last, straight into the table."""
+    start = datetime.datetime(2024, 1, 1)
+    with app_module.write_engine.begin() as connection:
+        connection.execute(text("""
+            INSERT INTO listings (name, description, price, dateposted, seller_id, is_sold)
+            VALUES (:name, 'Bulk', :price, :dateposted, :seller_id, :is_sold)
+        """), [{'name': f'Item {n}', 'price': n, 'seller_id': seller_id, 'is_sold': is_sold,
+                'dateposted': (start + datetime.timedelta(minutes=n)).strftime('%Y-%m-%d %H:%M:%S')}
+               for n in range(count)])
+
+
+def user_id(app_module, username):
+    with app_module.engine.connect() as connection:
+        return connection.execute(text('SELECT id FROM users WHERE username = :username'),
+                                  {'username': username}).scalar()
+
+
+def walk_pages(client, url, **args):
+    """Follow next_cursor from `url` to the end; return the listing ids in order."""
+    ids = []
+    while True:
+        page = client.get(url, query_string=args).get_json()
+        ids += [listing['id'] for listing in page['listings']]
+        args['cursor'] = page['next_cursor']
+        if not args['cursor']:
+            return ids
+
+
+def test_pages_need_login(app_module):
+    client = app_module.app.test_client()
+    assert client.get('/').headers['Location'].endswith('/login')
+    assert client.get('/home').status_code == 302
+
+
+def test_register_rejects_other_domains(app_module):
+    client = app_module.app.test_client()
+    client.post('/register', data={'username': 'mallory', 'first': 'M', 'last': 'M',
+                                   'password': 'x', 'email': 'mallory@example.com'})
+    assert user_id(app_module, 'mallory') is None
+
+
+def test_login_rejects_wrong_password(make_user, app_module):
+    make_user('alice')
+    client = app_module.app.test_client()
+    response = client.post('/login', data={'username': 'alice', 'password': 'wrong'})
+    assert response.status_code == 200
+    assert client.get('/home').status_code == 302
+
+
+def test_created_listing_shows_everywhere(make_user, create_listing):
+    alice = make_user('alice')
+    listing_id = create_listing(alice, 'Desk lamp', price=15)
+    home = alice.get('/home')
+    assert home.status_code == 200
+    assert b'Desk lamp' in home.data
+    page = alice.get(f'/listing/{listing_id}')
+    assert page.status_code == 200
+    assert b'Desk lamp' in page.data
+    assert b'Desk lamp' in alice.get('/user/alice').data
+
+
+def test_missing_listing_is_404(make_user):
+    alice = make_user('alice')
+    assert alice.get('/listing/999999').status_code == 404
+
+
+def test_search(app_module, make_user, create_listing):
+    alice = make_user('alice')
+    create_listing(alice, 'Calculus textbook', description='Stewart, 8th edition')
+    create_listing(alice, 'Bike lock')
+    response = alice.get('/search', query_string={'search_query': 'textbooks'})
+    assert response.status_code == 200
+    assert b'Calculus textbook' in response.data
+    assert b'Bike lock' not in response.data
+    response = alice.get('/search', query_string={'search_query': 'textbooks', 'page': 2})
+    assert response.status_code == 200 and b'Calculus textbook' not in response.data
+    for page in (app_module.MAX_SEARCH_PAGE + 1, 10**21):
+        assert alice.get('/search', query_string={'search_query': 'textbooks', 'page': page}).status_code == 404
+
+
+def test_save_and_unsave(make_user, create_listing):
+    alice, bob = make_user('alice'), make_user('bob')
+    listing_id = create_listing(alice, 'Mini fridge')
+    bob.post(f'/save-listing/{listing_id}')
+    assert b'Mini fridge' in bob.get('/saved-listings').data
+    bob.post(f'/save-listing/{listing_id}')
+    assert b'Mini fridge' not in bob.get('/saved-listings').data
+
+
+def test_chat(app_module, make_user, create_listing):
+    alice, bob = make_user('alice'), make_user('bob')
+    listing_id = create_listing(alice, 'Couch')
+    bob.post(f'/message-seller/{listing_id}', data={'message': 'Is this available?'})
+    with app_module.engine.connect() as connection:
+        chat_id = connection.execute(text('SELECT chat_id FROM chats WHERE listing_id = :id'), {'id': listing_id}).scalar()
+    assert b'Is this available?' in alice.get('/inbox').data
+    messages = alice.get(f'/get_messages/{chat_id}').get_json()['messages']
+    assert [message['message_content'] for message in messages] == ['Is this available?']
+    assert alice.post(f'/chat/{chat_id}', json={'message': 'Yes!'}).status_code == 204
+    messages = bob.get(f'/get_messages/{chat_id}', query_string={'after': messages[-1]['message_id']}).get_json()['messages']
+    assert [message['message_content'] for message in messages] == ['Yes!']
+    assert alice.get(f'/chat/{chat_id}').status_code == 200
+
+    # Strangers can neither read nor post
+    carol = make_user('carol')
+    assert carol.get(f'/get_messages/{chat_id}').status_code == 404
+    assert carol.post(f'/chat/{chat_id}', json={'message': 'Hi'}).status_code == 404
+
+
+
+def test_get_messages_bounds_its_arguments(app_module, make_user, create_listing):
+    alice, bob = make_user('alice'), make_user('bob')
+    bob.post(f"/message-seller/{create_listing(alice, 'Couch')}", data={'message': 'Hi'})
+    with app_module.engine.connect() as connection:
+        chat_id = connection.execute(text('SELECT chat_id FROM chats')).scalar()
+    for wait in ('nan', 'inf', '-1'):
+        assert bob.get(f'/get_messages/{chat_id}', query_string={'after': 2**40, 'wait': wait}).status_code == 200
+    for name in ('after', 'read'):
+        response = bob.get(f'/get_messages/{chat_id}', query_string={name: 2**64})
+        assert response.status_code == 200
+
+def test_unread_count(app_module, make_user, create_listing):
+    alice, bob = make_user('alice'), make_user('bob')
+    listing_id = create_listing(alice, 'Couch')
+    bob.post(f'/message-seller/{listing_id}', data={'message': 'One'})
+    bob.post(f'/message-seller/{listing_id}', data={'message': 'Two'})
+    with app_module.engine.connect() as connection:
+        chat_id = connection.execute(text('SELECT chat_id FROM chats WHERE listing_id = :id'), {'id': listing_id}).scalar()
+        unread = connection.execute(text('SELECT unread_count FROM users WHERE username = :username'),
+                                    {'username': 'alice'}).scalar()
+    assert unread == 2
+    alice.get(f'/chat/{chat_id}')
+    with app_module.engine.connect() as connection:
+        unread = connection.execute(text('SELECT unread_count FROM users WHERE username = :username'),
+                                    {'username': 'alice'}).scalar()
+    assert unread == 0
+
+
+def test_latest_message_only_moves_forward(app_module, make_user, create_listing):
+    alice, bob = make_user('alice'), make_user('bob')
+    listing_id = create_listing(alice, 'Couch')
+    bob.post(f'/message-seller/{listing_id}', data={'message': 'One'})
+    # As if a send with a later id had committed first
+    with app_module.write_engine.begin() as connection:
+        connection.execute(text("UPDATE chats SET last_message_id = 1000000, last_activity = '2100-01-01 00:00:00'"))
+    bob.post(f'/message-seller/{listing_id}', data={'message': 'Two'})
+    with app_module.engine.connect() as connection:
+        chat = connection.execute(text('SELECT last_message_id, last_activity, seller_unread FROM chats')).fetchone()
+    assert chat[0] == 1000000 and str(chat[1]).startswith('2100-01-01')
+    assert chat[2] == 2
+
+
+def test_inbox_pages_merge_buying_and_selling(app_module, make_user, create_listing):
+    alice, bob = make_user('alice'), make_user('bob')
+    for n in range(app_module.INBOX_PAGE_SIZE // 2 + 3):
+        bob.post(f"/message-seller/{create_listing(alice, f'Alice item {n}')}", data={'message': 'Hi'})
+        alice.post(f"/message-seller/{create_listing(bob, f'Bob item {n}')}", data={'message': 'Hi'})
+    with app_module.engine.connect() as connection:
+        expected = [row[0] for row in connection.execute(text(
+            'SELECT chat_id FROM chats ORDER BY last_activity DESC, chat_id DESC'))]
+    shown, url = [], '/inbox'
+    while url:
+        page = alice.get(url).get_data(as_text=True)
+        shown += [int(chat_id) for chat_id in re.findall(r'href="/chat/(\d+)"', page)]
+        url = html.unescape(next(iter(re.findall(r'href="(/inbox\?cursor=[^"]+)"', page)), '')) or None
+    assert shown == expected
+
+
+def test_only_the_seller_can_change_a_listing(make_user, create_listing, app_module):
+    alice, bob = make_user('alice'), make_user('bob')
+    listing_id = create_listing(alice, 'Couch')
+    bob.post(f'/listing/{listing_id}/mark-as-sold')
+    bob.post(f'/listing/{listing_id}/delete')
+    with app_module.engine.connect() as connection:
+        row = connection.execute(text('SELECT is_sold FROM listings WHERE id = :id'), {'id': listing_id}).fetchone()
+    assert row is not None and not row[0]
+
+
+def test_edit_and_mark_as_sold(make_user, create_listing, app_module):
+    alice = make_user('alice')
+    listing_id = create_listing(alice, 'Couch', price=50)
+    alice.post(f'/listing/{listing_id}/edit', data={
+        'name': 'Leather couch', 'description': 'Comfy', 'price': '40', 'image': (io.BytesIO(), ''),
+    }, content_type='multipart/form-data')
+    assert b'Leather couch' in alice.get(f'/listing/{listing_id}').data
+
+    alice.post(f'/listing/{listing_id}/mark-as-sold')
+    with app_module.engine.connect() as connection:
+        row = connection.execute(text('SELECT is_sold, sold_at FROM listings WHERE id = :id'), {'id': listing_id}).fetchone()
+    assert row[0] and row[1] is not None
+    assert b'Leather couch' not in alice.get('/home').data
+
+    alice.post(f'/listing/{listing_id}/mark-as-sold')
+    with app_module.engine.connect() as connection:
+        row = connection.execute(text('SELECT is_sold, sold_at FROM listings WHERE id = :id'), {'id': listing_id}).fetchone()
+    assert not row[0] and row[1] is None
+
+
+def test_delete_listing_removes_its_chats(make_user, create_listing, app_module):
+    alice, bob = make_user('alice'), make_user('bob')
+    listing_id = create_listing(alice, 'Couch')
+    bob.post(f'/message-seller/{listing_id}', data={'message': 'Hi'})
+    bob.post(f'/save-listing/{listing_id}')
+    alice.post(f'/listing/{listing_id}/delete')
+    with app_module.engine.connect() as connection:
+        for table in ('listings', 'chats', 'saves'):
+            column = 'id' if table == 'listings' else 'listing_id'
+            count = connection.execute(text(f'SELECT count(*) FROM {table} WHERE {column} = :id'), {'id': listing_id}).scalar()
+            assert count == 0, table
+    assert alice.get('/inbox').status_code == 200
+
+
+def test_feed_pages(make_user, app_module):
+    alice = make_user('alice')
+    page_size = app_module.FEED_PAGE_SIZE
+    insert_listings(app_module, user_id(app_module, 'alice'), page_size * 2 + 5)
+    ids = walk_pages(alice, '/api/listings')
+    assert len(ids) == page_size * 2 + 5
+    assert ids == sorted(ids, reverse=True)
+
+
+def test_profile_pages_put_sold_listings_last(make_user, app_module):
+    alice = make_user('alice')
+    seller_id = user_id(app_module, 'alice')
+    insert_listings(app_module, seller_id, 20)
+    insert_listings(app_module, seller_id, 20, is_sold=True)
+    ids = walk_pages(alice, '/api/listings', seller='alice')
+    assert len(ids) == len(set(ids)) == 40
+    with app_module.engine.connect() as connection:
+        sold = {row[0] for row in connection.execute(text('SELECT id FROM listings WHERE is_sold = TRUE'))}
+    assert all(listing_id in sold for listing_id in ids[20:])
+    assert alice.get('/api/listings?seller=nobody').status_code == 404
+
+
+def test_browse(make_user, app_module):
+    alice, bob = make_user('alice'), make_user('bob')
+    insert_listings(app_module, user_id(app_module, 'alice'), 30)
+    insert_listings(app_module, user_id(app_module, 'bob'), 30)
+    assert alice.get('/browse').status_code == 200
+
+    prices = [listing['price'] for listing in
+              alice.get('/api/browse?sort=price_low&min_price=5&max_price=25').get_json()['listings']]
+    assert prices == sorted(prices) and min(prices) >= 5 and max(prices) <= 25
+
+    ids = walk_pages(alice, '/api/browse', sort='price_high', seller='bob')
+    assert len(ids) == 30
+    assert bob.get('/api/browse?sort=cheapest').status_code == 400
+    assert bob.get('/api/browse?seller=nobody').get_json()['listings'] == []
+
+
+def test_forged_cursors_serve_the_first_page(make_user, app_module):
+    alice = make_user('alice')
+    insert_listings(app_module, user_id(app_module, 'alice'), 30)
+    first_page = alice.get('/api/listings').get_json()['listings']
+    forged = [app_module.encode_cursor(*values) for values in
+              ([], [1], ['x', 'y'], [{}, []], ['2024-01-01 00:10:00', '5'], ['2024-01-01', 2**70],
+               [None, None, None], [True, 'not a date', 1], ['2024-01-01 00:10:00', 5, 6])]
+    for cursor in forged + ['!!!', 'bnVsbA==']:
+        for url, args in (('/api/listings', {}), ('/api/listings', {'seller': 'alice'}),
+                          ('/api/browse', {'sort': 'price_low'}), ('/api/browse', {'seller': 'alice'}),
+                          ('/inbox', {})):
+            response = alice.get(url, query_string=dict(args, cursor=cursor))
+            assert response.status_code == 200, (url, cursor)
+        assert alice.get('/api/listings', query_string={'cursor': cursor}).get_json()['listings'] == first_page
+
+
+def test_image_lock_is_kept_while_a_job_waits_for_it(app_module):
+    key = '0' * 64
+    acquired, release = threading.Event(), threading.Event()
+
+    def waiting_job():
+        with app_module.image_lock(key):
+            acquired.set()
+            release.wait(5)
+
+    with app_module.image_lock(key):
+        job = threading.Thread(target=waiting_job)
+        job.start()
+        while app_module._image_locks[key][1] < 2:
+            pass
+    assert acquired.wait(5)
+    # The waiting job now holds the same lock, so a third job must wait for it
+    with app_module._image_locks_guard:
+        lock = app_module._image_locks[key][0]
+    assert lock.locked()
+    release.set()
+    job.join()
+    assert key not in app_module._image_locks